@@ -0,0 +1,72 @@
+"""Registry of the heavy third-party extraction and NLP backends.
+
+Nothing here is imported until first use, so web workers, management commands
+and tests don't pay for PDF, OCR or spaCy imports they never need. Long-lived
+processes can call `preload()` up front instead: when that happens before
+forking (the ingestion worker's process pool, `gunicorn --preload`), the
+children share the already-loaded modules and model copy-on-write.
+"""
+import gc
+import importlib
+
+from django.conf import settings
+
+
+def _configure_pytesseract(module):
+    from .ocr import find_tesseract
+
+    tesseract_cmd = find_tesseract()
+    if tesseract_cmd:  # Otherwise pytesseract reports the missing binary when first called
+        module.pytesseract.tesseract_cmd = tesseract_cmd
+
+
+# Backend name -> (module to import, optional configuration hook run once after import)
+BACKENDS = {
+    'pdfplumber': ('pdfplumber', None),
+    'pdfium': ('pypdfium2', None),  # Installed with pdfplumber; renders pages for thumbnails
+    'textract': ('textract', None),
+    'docx2txt': ('docx2txt', None),
+    'pil': ('PIL.Image', None),
+    'pil_ops': ('PIL.ImageOps', None),
+    'pytesseract': ('pytesseract', _configure_pytesseract),
+    'numpy': ('numpy', None),  # Tag signatures for similar-file lookups
+}
+
+_loaded = {}
+
+
+def get_backend(name):
+    """Returns the module for a backend, importing and configuring it on first use."""
+    module = _loaded.get(name)
+    if module is None:
+        module_path, configure = BACKENDS[name]
+        module = importlib.import_module(module_path)
+        if configure is not None:
+            configure(module)
+        _loaded[name] = module
+    return module
+
+
+def preload(names=None):
+    """Imports the given backends now; 'nlp' also loads the spaCy model.
+
+    Defaults to every backend plus the model. Afterwards the loaded objects are
+    moved out of the garbage collector's reach (`gc.freeze`), so collections in
+    forked children don't write to, and thereby copy, the shared pages.
+    """
+    from .nlp import get_nlp
+
+    names = list(BACKENDS) + ['nlp'] if names is None else names
+    for name in names:
+        if name == 'nlp':
+            get_nlp()
+        else:
+            get_backend(name)
+    gc.freeze()
+
+
+def preload_from_settings():
+    """Preloads the backends listed in `PRELOAD_BACKENDS`, if any."""
+    names = getattr(settings, 'PRELOAD_BACKENDS', [])
+    if names:
+        preload(names)
@@ -0,0 +1,83 @@
+"""Benchmarks for the file pipeline, run with `python manage.py benchmark <name>`.
+
+Benchmarks that write to the database do so in a throw-away test database
+(created and destroyed the same way the test runner does), never in the
+configured one.
+"""
+import contextlib
+import statistics
+import sys
+import time
+
+# Benchmark name -> module exposing `add_arguments(parser)` and `run(stdout, **options)`.
+BENCHMARKS = {
+    'search': 'fileapp.benchmarks.search',
+    'tags': 'fileapp.benchmarks.tags',
+    'pdf': 'fileapp.benchmarks.pdf',
+    'nlp': 'fileapp.benchmarks.nlp',
+    'startup': 'fileapp.benchmarks.startup',
+    'ocr': 'fileapp.benchmarks.ocr',
+    'download': 'fileapp.benchmarks.download',
+    'upload': 'fileapp.benchmarks.upload',
+    'query': 'fileapp.benchmarks.query',
+    'pipeline': 'fileapp.benchmarks.pipeline',
+    'load': 'fileapp.benchmarks.load',
+    'similarity': 'fileapp.benchmarks.similarity',
+}
+
+
+@contextlib.contextmanager
+def benchmark_database(verbosity=0):
+    """Runs the enclosed block against a fresh test database."""
+    from django.test.utils import setup_databases, teardown_databases
+    from fileapp import tag_cache
+
+    old_config = setup_databases(verbosity=verbosity, interactive=False)
+    tag_cache.clear()  # Ids read from the configured database mean nothing here
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=verbosity)
+        tag_cache.clear()
+
+
+def timed(func, *args, **kwargs):
+    """Calls `func` and returns `(seconds, result)`."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of samples."""
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    """p50/p95/mean of a list of durations in seconds, formatted in milliseconds."""
+    if not samples:
+        return "n/a"
+    return (
+        f"p50 {percentile(samples, 50) * 1000:8.2f} ms  "
+        f"p95 {percentile(samples, 95) * 1000:8.2f} ms  "
+        f"mean {statistics.fmean(samples) * 1000:8.2f} ms"
+    )
+
+
+def peak_rss_bytes(children=False):
+    """Peak resident set size of this process (or of its waited-for children) so far."""
+    import resource
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+
+def format_bytes(size):
+    """Human readable byte count."""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
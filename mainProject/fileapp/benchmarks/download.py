@@ -0,0 +1,140 @@
+"""Large-file download throughput and worker CPU: the old FileResponse vs the download engine.
+
+Each response is written to a local socket the way a WSGI server writes it:
+with `os.sendfile` when the response exposes a file descriptor (what
+gunicorn's `wsgi.file_wrapper` does) or else by iterating the body, while a
+reader thread drains the other end. Worker CPU is the user + system time of
+the sending thread. The old view had no Range or conditional support, so a
+resumed download or a revalidation cost it the whole file again.
+"""
+import io
+import os
+import resource
+import socket
+import statistics
+import tempfile
+import threading
+import time
+
+from . import benchmark_database, format_bytes
+
+
+def add_arguments(parser):
+    parser.add_argument('--size-mb', type=int, default=256, help='Size of the downloaded file.')
+    parser.add_argument('--repeat', type=int, default=3, help='Downloads per variant (the median is reported).')
+
+
+def legacy_download(file_path, file_name):
+    """The response `download_file` built before the download engine."""
+    from django.http import FileResponse
+
+    response = FileResponse(open(file_path, 'rb'))
+    response['Content-Disposition'] = f'attachment; filename="{file_name}"'
+    return response
+
+
+def _file_descriptor(response):
+    file_to_stream = getattr(response, 'file_to_stream', None)
+    if file_to_stream is None:
+        return None
+    try:
+        return file_to_stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+def _send(response, sock, use_sendfile, result):
+    """Writes a response to `sock` like a WSGI server; records the thread's CPU time."""
+    before = resource.getrusage(resource.RUSAGE_THREAD)
+    head = f"HTTP/1.1 {response.status_code}\r\n" + "".join(
+        f"{name}: {value}\r\n" for name, value in response.items()
+    ) + "\r\n"
+    sock.sendall(head.encode('latin-1'))
+    fd = _file_descriptor(response) if use_sendfile else None
+    sent = 0
+    if fd is not None:
+        offset = os.lseek(fd, 0, os.SEEK_CUR)
+        length = int(response['Content-Length'])
+        while sent < length:
+            sent += os.sendfile(sock.fileno(), fd, offset + sent, length - sent)
+    else:
+        for chunk in response:
+            sock.sendall(chunk)
+            sent += len(chunk)
+    response.close()
+    sock.close()
+    after = resource.getrusage(resource.RUSAGE_THREAD)
+    result['cpu'] = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    result['body'] = sent
+
+
+def _download(make_response, use_sendfile):
+    """Serves one response over a socket pair; returns (seconds, cpu seconds, body bytes)."""
+    server, client = socket.socketpair()
+    result = {}
+    start = time.perf_counter()
+    sender = threading.Thread(target=_send, args=(make_response(), server, use_sendfile, result))
+    sender.start()
+    buffer = bytearray(1024 * 1024)
+    while client.recv_into(buffer):
+        pass
+    sender.join()
+    client.close()
+    return time.perf_counter() - start, result['cpu'], result['body']
+
+
+def run(stdout, size_mb, repeat, **options):
+    from django.core.files import File as DjangoFile
+    from django.test import RequestFactory
+    from django.test.utils import override_settings
+    from fileapp.views import download_file, save_file
+
+    with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root), benchmark_database():
+        source = os.path.join(media_root, 'source.bin')
+        with open(source, 'wb') as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(1024 * 1024))
+        with open(source, 'rb') as f:
+            file_instance = save_file('large_download.bin', DjangoFile(f, name='large_download.bin'))
+        os.remove(source)
+        blob = file_instance.blob
+        file_path = blob.file_content.path
+        size = blob.size
+        etag = f'"{blob.content_hash}"'
+        factory = RequestFactory()
+        url = f'/api/download/{file_instance.id}/'
+
+        def engine(**headers):
+            return lambda: download_file(factory.get(url, **headers), file_instance.id)
+
+        def legacy():
+            return legacy_download(file_path, file_instance.file_name)
+
+        variants = [
+            ('old view, iterated', legacy, False),
+            ('old view, sendfile', legacy, True),
+            ('engine, iterated', engine(), False),
+            ('engine, sendfile', engine(), True),
+            ('old view, resume at 50%', legacy, True),
+            ('engine, resume at 50%', engine(HTTP_RANGE=f'bytes={size // 2}-'), True),
+            ('engine, 1 MB range', engine(HTTP_RANGE='bytes=0-1048575'), True),
+            ('old view, revalidate', legacy, True),
+            ('engine, revalidate (304)', engine(HTTP_IF_NONE_MATCH=etag), True),
+        ]
+        stdout.write(f"File: {format_bytes(size)}")
+        for name, make_response, use_sendfile in variants:
+            runs = [_download(make_response, use_sendfile) for _ in range(repeat)]
+            seconds = statistics.median(run[0] for run in runs)
+            cpu = statistics.median(run[1] for run in runs)
+            body = runs[0][2]
+            stdout.write(
+                f"  {name:<26} {format_bytes(body):>10}  {seconds * 1000:8.1f} ms  "
+                f"{body / seconds / 1e6 if body else 0:8.0f} MB/s  worker CPU {cpu * 1000:8.1f} ms"
+            )
+
+        with override_settings(DOWNLOAD_OFFLOAD='x-accel-redirect'):
+            runs = [_download(engine(), True) for _ in range(repeat)]
+        stdout.write(
+            f"  {'engine, X-Accel-Redirect':<26} {format_bytes(runs[0][2]):>10}  "
+            f"{statistics.median(run[0] for run in runs) * 1000:8.1f} ms  (body sent by the front server)"
+        )
@@ -0,0 +1,183 @@
+"""Synthetic input files for the benchmarks, written without extra dependencies."""
+import os
+import random
+import zipfile
+from itertools import accumulate, product
+from xml.sax.saxutils import escape
+
+# Common English words, so extracted text looks like prose to the tagger.
+WORDS = (
+    "account address agreement analysis annual application approval archive audit balance budget "
+    "business calendar campaign capital certificate client committee company contract customer "
+    "database deadline delivery department deposit design document employee engineering estimate "
+    "finance forecast government guarantee hardware insurance inventory invoice journal language "
+    "license logistics machine management manufacturing marketing meeting memorandum network "
+    "operation order organisation payment payroll performance planning policy portfolio procedure "
+    "product project proposal purchase quality receipt record register report request research "
+    "revenue review salary schedule security service shipment software statement strategy supplier "
+    "survey system technology training transaction transport vendor warehouse"
+).split()
+
+
+CONSONANTS = 'bdfgklmnprtvz'
+VOWELS = 'aeiou'
+
+
+def random_text(rng, words, vocabulary=WORDS, cum_weights=None):
+    """`words` words of pseudo-prose drawn from `vocabulary`, uniformly or by `cum_weights`."""
+    if cum_weights is not None:
+        return " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=words))
+    return " ".join(rng.choice(vocabulary) for _ in range(words))
+
+
+def pseudo_words(count, rng):
+    """Pronounceable lower-case words of three syllables, which the tagger keeps as they are."""
+    syllables = [consonant + vowel for consonant, vowel in product(CONSONANTS, VOWELS)]
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choices(syllables, k=3)))
+    return sorted(words)
+
+
+def vocabulary(size, rng):
+    """`(words, cum_weights)`: the common words topped up with pseudo-words, drawn with Zipf frequencies."""
+    words = WORDS[:size] + pseudo_words(max(0, size - len(WORDS)), rng)
+    rng.shuffle(words)
+    return words, list(accumulate(1 / rank for rank in range(1, len(words) + 1)))
+
+
+def _pdf_string(text):
+    return "(" + text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+
+def write_pdf(path, pages):
+    """Writes a minimal text PDF; `pages` is a list of pages, each a list of lines."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # Page tree, filled in once the page object numbers are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_refs = []
+    for lines in pages:
+        stream = "BT /F1 10 Tf 12 TL 40 800 Td " + " ".join(f"{_pdf_string(line)} Tj T*" for line in lines) + " ET"
+        stream = stream.encode('latin-1', 'replace')
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects)
+        )
+        page_refs.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(page_refs), len(page_refs))
+
+    with open(path, 'wb') as out:
+        out.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(out.tell())
+            out.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+        xref_offset = out.tell()
+        out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            out.write(b"%010d 00000 n \n" % offset)
+        out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset))
+
+
+def write_text_pdf(path, page_count, lines_per_page=60, words_per_line=12, seed=0):
+    """Writes a `page_count`-page PDF full of pseudo-prose."""
+    rng = random.Random(seed)
+    write_pdf(path, [
+        [random_text(rng, words_per_line) for _ in range(lines_per_page)]
+        for _ in range(page_count)
+    ])
+
+
+DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+DOCX_RELATIONSHIPS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="word/document.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+    '</Relationships>'
+)
+
+
+def write_docx(path, paragraphs):
+    """Writes a minimal Word document with one run of text per paragraph."""
+    body = "".join(f'<w:p><w:r><w:t xml:space="preserve">{escape(text)}</w:t></w:r></w:p>' for text in paragraphs)
+    document = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+        f'<w:body>{body}</w:body></w:document>'
+    )
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('[Content_Types].xml', DOCX_CONTENT_TYPES)
+        archive.writestr('_rels/.rels', DOCX_RELATIONSHIPS)
+        archive.writestr('word/document.xml', document)
+
+
+def write_text_image(path, size, dpi=None, font_size=40, seed=0, shaded=False, quality=90, vocabulary=WORDS):
+    """Writes an image of dark pseudo-prose lines; returns the set of words drawn.
+
+    `shaded` puts the text on an uneven gray gradient, like a phone photo of a page.
+    """
+    from PIL import Image, ImageDraw, ImageFont
+
+    rng = random.Random(seed)
+    width, height = size
+    if shaded:
+        image = Image.linear_gradient('L').resize(size).point(lambda level: 150 + level * 80 // 255)
+    else:
+        image = Image.new('L', size, 255)
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default(size=font_size)
+    margin = font_size * 2
+    words_per_line = max(1, (width - 2 * margin) // (font_size * 6))
+    drawn = set()
+    for top in range(margin, height - margin - font_size, int(font_size * 1.6)):
+        line = random_text(rng, words_per_line, vocabulary)
+        drawn.update(line.split())
+        draw.text((margin, top), line, fill=30, font=font)
+    save_options = {'dpi': (dpi, dpi)} if dpi else {}
+    if path.endswith('.jpg'):
+        save_options['quality'] = quality
+    image.save(path, **save_options)
+    return drawn
+
+
+def write_corpus(directory, files, kinds=('pdf', 'docx', 'image'), words=2000, image_size=(1240, 1754),
+                 vocabulary_size=2000, seed=0):
+    """Writes `files` documents cycling through `kinds`; returns `(paths, words, cum_weights)`, the last two
+    being the vocabulary the text was drawn from.
+
+    PDFs and Word documents hold about `words` words each (PDFs 600 to a
+    page); images are pages of `image_size` pixels filled with text lines.
+    """
+    rng = random.Random(seed)
+    words_list, cum_weights = vocabulary(vocabulary_size, rng)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for number in range(files):
+        kind = kinds[number % len(kinds)]
+        if kind == 'pdf':
+            path = os.path.join(directory, f"document_{number}.pdf")
+            lines = [random_text(rng, 12, words_list, cum_weights) for _ in range(max(1, words // 12))]
+            write_pdf(path, [lines[start:start + 50] for start in range(0, len(lines), 50)])
+        elif kind == 'docx':
+            path = os.path.join(directory, f"document_{number}.docx")
+            write_docx(path, [random_text(rng, 50, words_list, cum_weights) for _ in range(max(1, words // 50))])
+        elif kind == 'image':
+            path = os.path.join(directory, f"scan_{number}.png")
+            # Drawn from the common words, which Tesseract reads back reliably
+            write_text_image(path, image_size, dpi=150, font_size=28, seed=rng.randrange(2 ** 32))
+        else:
+            raise ValueError(f"Unknown document kind: {kind}")
+        paths.append(path)
+    return paths, words_list, cum_weights
@@ -0,0 +1,179 @@
+"""Concurrent connections sustained by a running server, WSGI or ASGI.
+
+Opens `--connections` keep-alive HTTP/1.1 connections to `--url` at once,
+each sending requests for the `--paths` in turn until `--duration` seconds
+have passed (or `--requests` requests were sent in total), and reports
+requests per second, latency percentiles, errors and how many connections
+were kept open without an error to the end. `--read-rate` makes every
+client read response bodies at that many bytes per second, like a slow
+mobile download, which is what ties up a thread per connection under WSGI.
+
+The server is started separately, with the same database, e.g.
+
+    gunicorn myproject.wsgi --workers 2 --threads 8
+    uvicorn myproject.asgi:application --workers 2
+
+(with `ASYNC_VIEWS = True` in the settings for the second one), so both are
+measured with this same client. The client only needs the standard library.
+"""
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import CommandError
+
+from . import format_bytes, percentile
+
+READ_BLOCK = 16 * 1024
+
+
+def add_arguments(parser):
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='Base URL of the running server.')
+    parser.add_argument('--paths', nargs='+', default=['/api/search/results/?q=report'],
+                        help='Request paths, sent in turn on every connection.')
+    parser.add_argument('--connections', type=int, default=100, help='Connections opened at once.')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds to keep sending requests.')
+    parser.add_argument('--requests', type=int, help='Stop after this many requests in total instead.')
+    parser.add_argument('--read-rate', type=int, default=0, help='Bytes per second each client reads (0: no limit).')
+    parser.add_argument('--timeout', type=float, default=30.0, help='Seconds before a request counts as failed.')
+
+
+class _Stats:
+    def __init__(self, budget):
+        self.latencies = []
+        self.errors = {}
+        self.received = 0
+        self.budget = budget  # Requests left to send, or None
+        self.open = 0
+        self.peak_open = 0
+        self.sustained = 0
+
+    def claim(self):
+        """Whether another request may be sent."""
+        if self.budget is None:
+            return True
+        if self.budget <= 0:
+            return False
+        self.budget -= 1
+        return True
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+async def _read_body(reader, headers, read_rate):
+    """Reads a response body (Content-Length, chunked or until close); returns its size."""
+    async def read(size):
+        data = await reader.read(size) if size < 0 else await reader.readexactly(size)
+        if read_rate:
+            await asyncio.sleep(len(data) / read_rate)
+        return data
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        size = 0
+        while True:
+            chunk_size = int((await reader.readline()).split(b';', 1)[0], 16)
+            if chunk_size == 0:
+                while (await reader.readline()).strip():  # Trailers
+                    pass
+                return size
+            remaining = chunk_size
+            while remaining:
+                remaining -= len(await read(min(remaining, READ_BLOCK)))
+            await reader.readexactly(2)  # CRLF after the chunk
+            size += chunk_size
+    if 'content-length' in headers:
+        remaining = size = int(headers['content-length'])
+        while remaining:
+            remaining -= len(await read(min(remaining, READ_BLOCK)))
+        return size
+    size = 0
+    while data := await read(-1 if not read_rate else READ_BLOCK):
+        size += len(data)
+    return size
+
+
+async def _request(reader, writer, host, path, read_rate):
+    """Sends one GET and reads the response; returns `(status, body size, keep-alive)`."""
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nAccept: */*\r\n\r\n".encode('latin-1'))
+    await writer.drain()
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError("Connection closed by the server")
+    version, status = status_line.split(None, 2)[:2]
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    size = await _read_body(reader, headers, read_rate)
+    keep_alive = version == b'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+    return int(status), size, keep_alive
+
+
+async def _client(number, target, paths, deadline, read_rate, timeout, stats):
+    host, port, ssl = target
+    reader = writer = None
+    failed = False
+    sent = 0
+    try:
+        while time.monotonic() < deadline and stats.claim():
+            if writer is None:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port, ssl=ssl), timeout)
+                stats.open += 1
+                stats.peak_open = max(stats.peak_open, stats.open)
+            path = paths[(number + sent) % len(paths)]
+            sent += 1
+            start = time.perf_counter()
+            status, size, keep_alive = await asyncio.wait_for(_request(reader, writer, host, path, read_rate), timeout)
+            stats.latencies.append(time.perf_counter() - start)
+            stats.received += size
+            if status >= 400:
+                stats.error(f"HTTP {status}")
+            if not keep_alive:
+                writer.close()
+                stats.open -= 1
+                writer = None
+    except asyncio.TimeoutError:
+        failed = True
+        stats.error('timeout')
+    except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+        failed = True
+        stats.error(type(e).__name__)
+    finally:
+        if writer is not None:
+            writer.close()
+            stats.open -= 1
+    if not failed:
+        stats.sustained += 1
+
+
+async def _load(url, paths, connections, duration, requests, read_rate, timeout):
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        raise CommandError(f"Unsupported URL: {url}")
+    target = (parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80), parts.scheme == 'https')
+    prefix = parts.path.rstrip('/')
+    stats = _Stats(requests)
+    deadline = time.monotonic() + (duration if requests is None else float('inf'))
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        _client(number, target, [prefix + path for path in paths], deadline, read_rate, timeout, stats)
+        for number in range(connections)
+    ])
+    return stats, time.perf_counter() - start
+
+
+def run(stdout, url, paths, connections, duration, requests, read_rate, timeout, **options):
+    stats, seconds = asyncio.run(_load(url, paths, connections, duration, requests, read_rate, timeout))
+    latencies = stats.latencies
+    stdout.write(f"{url}: {connections} connections for {seconds:.1f}s, {len(latencies)} requests"
+                 + (f", clients reading {format_bytes(read_rate)}/s" if read_rate else ""))
+    if latencies:
+        stdout.write(
+            f"  {len(latencies) / seconds:.1f} req/s, {format_bytes(stats.received / seconds)}/s received; latency "
+            f"p50 {percentile(latencies, 50) * 1000:.1f} ms  p95 {percentile(latencies, 95) * 1000:.1f} ms  "
+            f"p99 {percentile(latencies, 99) * 1000:.1f} ms"
+        )
+    stdout.write(f"  connections sustained {stats.sustained}/{connections} (at most {stats.peak_open} open at once)")
+    if stats.errors:
+        stdout.write("  errors: " + ", ".join(f"{kind} {number}" for kind, number in sorted(stats.errors.items())))
@@ -0,0 +1,69 @@
+"""Tagging throughput: the full spaCy pipeline vs the trimmed, batched tagger.
+
+The old path loaded every pipeline component and ran `nlp(content)` on the
+whole document; the new one excludes unused components and streams chunks
+through `nlp.pipe`. Reports model load time, documents/s and tokens/s.
+"""
+import random
+import time
+from collections import Counter
+
+from .fixtures import random_text
+
+
+def add_arguments(parser):
+    parser.add_argument('--docs', type=int, default=20)
+    parser.add_argument('--words', type=int, default=20_000, help='Words per document.')
+    parser.add_argument('--batch-size', type=int, help='NLP_BATCH_SIZE for the new path.')
+    parser.add_argument('--n-process', type=int, help='NLP_N_PROCESS for the new path.')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def legacy_tag_counts(nlp, content):
+    doc = nlp(content)
+    return Counter(token.lemma_.lower() for token in doc if token.is_alpha and not token.is_stop)
+
+
+def run(stdout, docs, words, batch_size, n_process, seed, **options):
+    import spacy
+    from django.conf import settings
+    from django.test.utils import override_settings
+    from fileapp import nlp as tagger
+
+    rng = random.Random(seed)
+    texts = [random_text(rng, words) for _ in range(docs)]
+
+    start = time.perf_counter()
+    full_nlp = spacy.load(getattr(settings, 'NLP_MODEL', 'en_core_web_sm'))
+    legacy_load = time.perf_counter() - start
+    tokens = sum(len(full_nlp.tokenizer(text)) for text in texts)
+
+    start = time.perf_counter()
+    for text in texts:
+        legacy_tag_counts(full_nlp, text)
+    legacy_seconds = time.perf_counter() - start
+
+    overrides = {}
+    if batch_size:
+        overrides['NLP_BATCH_SIZE'] = batch_size
+    if n_process:
+        overrides['NLP_N_PROCESS'] = n_process
+    with override_settings(**overrides):
+        tagger._nlp = None
+        start = time.perf_counter()
+        tagger.get_nlp()
+        new_load = time.perf_counter() - start
+        start = time.perf_counter()
+        for text in texts:
+            tagger.generate_tag_counts(text)
+        new_seconds = time.perf_counter() - start
+
+    stdout.write(f"{docs} documents x {words} words, {tokens} tokens")
+    for label, load, seconds, pipeline in (
+        ('legacy', legacy_load, legacy_seconds, full_nlp.pipe_names),
+        ('trimmed', new_load, new_seconds, tagger.get_nlp().pipe_names),
+    ):
+        stdout.write(
+            f"  {label:<8} load {load:6.2f} s  {docs / seconds:8.2f} docs/s  {tokens / seconds:10.0f} tokens/s  "
+            f"pipeline: {', '.join(pipeline) or '(tokenizer only)'}"
+        )
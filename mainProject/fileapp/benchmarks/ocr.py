@@ -0,0 +1,103 @@
+"""OCR pages/s and word recall at different preprocessing settings.
+
+Generates three fixture images: a clean A4 scan at 300 DPI, a 48 MP "phone
+photo" of a page (shaded background, JPEG) and a long receipt-like strip.
+Each is run through the old path (the raw image straight into tesseract) and
+through the OCR pipeline with preprocessing steps switched on one by one.
+Without a tesseract binary only the preprocessing cost is measured.
+"""
+import os
+import re
+import tempfile
+import time
+
+from .fixtures import write_text_image
+
+FIXTURES = [
+    # name, file, size, dpi, font size, shaded
+    ('scan', 'scan.png', (2480, 3508), 300, 40, False),
+    ('photo', 'photo.jpg', (8000, 6000), 72, 90, True),
+    ('receipt', 'receipt.png', (1200, 14000), 300, 36, False),
+]
+
+# Variant -> OCR settings; None is the old path
+VARIANTS = [
+    ('raw', None),
+    ('grayscale', {'OCR_TARGET_DPI': None, 'OCR_MAX_PIXELS': None, 'OCR_BINARIZE': False, 'OCR_TILE_HEIGHT': None}),
+    ('downscaled', {'OCR_BINARIZE': False, 'OCR_TILE_HEIGHT': None}),
+    ('binarized', {'OCR_TILE_HEIGHT': None}),
+    ('tiled', {}),
+]
+
+
+def add_arguments(parser):
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per fixture and variant.')
+    parser.add_argument('--workers', type=int, help='OCR_WORKERS for the tiled variant.')
+    parser.add_argument('--fixtures', nargs='+', choices=[f[0] for f in FIXTURES], help='Only these fixtures.')
+
+
+def _recall(drawn, text):
+    found = set(re.findall(r'[a-z]+', text.lower()))
+    return len(drawn & found) / len(drawn) if drawn else 0.0
+
+
+def _run_variant(file_path, overrides):
+    from django.test.utils import override_settings
+    from fileapp import ocr
+    from fileapp.backends import get_backend
+
+    Image = get_backend('pil')
+    if overrides is None:
+        with Image.open(file_path) as image:
+            start = time.perf_counter()
+            image.load()
+            return time.perf_counter() - start, image.width * image.height, lambda: get_backend('pytesseract').image_to_string(image)
+    with override_settings(**overrides):
+        with Image.open(file_path) as image:
+            start = time.perf_counter()
+            processed, dpi = ocr.preprocess(image)
+            bands = ocr.tiles(processed)
+            seconds = time.perf_counter() - start
+
+        def recognize():
+            with override_settings(**overrides):
+                if len(bands) == 1:
+                    return ocr.recognize(processed, dpi)
+                return "\n".join(ocr._executor().map(lambda band: ocr.recognize(band, dpi), bands))
+
+        return seconds, processed.width * processed.height, recognize
+
+
+def run(stdout, repeat, workers, fixtures, **options):
+    from django.test.utils import override_settings
+    from fileapp import ocr
+
+    tesseract = ocr.find_tesseract()
+    if tesseract is None:
+        stdout.write("Tesseract not found (set TESSERACT_CMD or add it to PATH); measuring preprocessing only")
+    overrides = {'OCR_WORKERS': workers} if workers else {}
+
+    with tempfile.TemporaryDirectory() as directory, override_settings(**overrides):
+        ocr.limit_tesseract_threads()  # As in the ingestion worker's processes
+        for name, file_name, size, dpi, font_size, shaded in FIXTURES:
+            if fixtures and name not in fixtures:
+                continue
+            file_path = os.path.join(directory, file_name)
+            drawn = write_text_image(file_path, size, dpi=dpi, font_size=font_size, shaded=shaded)
+            stdout.write(f"{name}: {size[0]}x{size[1]}, {os.path.getsize(file_path) / 1e6:.1f} MB")
+            for variant, variant_settings in VARIANTS:
+                prep_seconds = ocr_seconds = 0.0
+                recall = None
+                for _ in range(repeat):
+                    seconds, pixels, recognize = _run_variant(file_path, variant_settings)
+                    prep_seconds += seconds
+                    if tesseract is not None:
+                        start = time.perf_counter()
+                        text = recognize()
+                        ocr_seconds += time.perf_counter() - start
+                        recall = _recall(drawn, text)
+                line = f"  {variant:<11} {pixels / 1e6:6.1f} MP  preprocess {prep_seconds / repeat * 1000:8.1f} ms"
+                if recall is not None:
+                    total = (prep_seconds + ocr_seconds) / repeat
+                    line += f"  {1 / total:6.2f} pages/s  word recall {recall:6.1%}"
+                stdout.write(line)
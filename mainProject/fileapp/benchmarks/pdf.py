@@ -0,0 +1,83 @@
+"""Memory and throughput of PDF text extraction on multi-hundred-page documents.
+
+Compares the old whole-document reader (string concatenation, page objects
+kept alive) with the streaming page-by-page extractor, serially and fanned
+out to a process pool. Each run happens in a freshly spawned process so peak
+RSS figures don't leak between variants.
+"""
+import multiprocessing
+import os
+import tempfile
+import time
+
+from . import format_bytes, peak_rss_bytes
+from .fixtures import write_text_pdf
+
+
+def add_arguments(parser):
+    parser.add_argument('--pages', type=int, nargs='+', default=[100, 300, 600], help='Page counts of the generated PDFs.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Processes for the parallel variant.')
+    parser.add_argument('--tag', action='store_true', help='Also run the extracted text through the tagger.')
+
+
+def legacy_pdf_reader(file_path):
+    """The whole-document reader used before streaming extraction."""
+    import pdfplumber
+
+    with pdfplumber.open(file_path) as pdf:
+        all_text = ""
+        for page in pdf.pages:
+            text = page.extract_text()
+            all_text += text + "\n" if text else ""
+        return all_text
+
+
+def _measure(variant, file_path, workers, tag, results):
+    import django
+
+    django.setup()
+    from django.test.utils import override_settings
+    from fileapp import extraction
+
+    baseline = peak_rss_bytes()
+    start = time.perf_counter()
+    if variant == 'legacy':
+        texts = [legacy_pdf_reader(file_path)]
+    elif variant == 'streaming':
+        texts = extraction.iter_pdf_pages(file_path)
+    else:
+        texts = None
+    with override_settings(PDF_WORKERS=workers, PDF_PARALLEL_MIN_PAGES=0, PDF_MAX_PAGES=None, PDF_EXTRACT_TIMEOUT=None):
+        if texts is None:
+            texts = extraction.iter_pdf_text(file_path)
+        if tag:
+            extraction.generate_tag_counts(texts)
+        else:
+            for _ in texts:
+                pass
+    seconds = time.perf_counter() - start
+    results.put({
+        'seconds': seconds,
+        'rss_growth': peak_rss_bytes() - baseline,
+        'children_rss': peak_rss_bytes(children=True),
+    })
+
+
+def run(stdout, pages, workers, tag, **options):
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        for page_count in pages:
+            file_path = os.path.join(directory, f"fixture_{page_count}.pdf")
+            write_text_pdf(file_path, page_count)
+            stdout.write(f"{page_count} pages, {format_bytes(os.path.getsize(file_path))}")
+            for variant in ('legacy', 'streaming', 'parallel'):
+                results = context.Queue()
+                process = context.Process(target=_measure, args=(variant, file_path, workers, tag, results))
+                process.start()
+                result = results.get()
+                process.join()
+                stdout.write(
+                    f"  {variant:<10} {result['seconds']:7.2f} s  {page_count / result['seconds']:7.1f} pages/s  "
+                    f"peak RSS +{format_bytes(result['rss_growth'])}"
+                    + (f" (pool processes {format_bytes(result['children_rss'])} each at most)" if variant == 'parallel' else "")
+                )
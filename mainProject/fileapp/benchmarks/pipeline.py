@@ -0,0 +1,268 @@
+"""End-to-end latency, throughput and peak memory of the file pipeline, with a JSON baseline.
+
+Generates a corpus of PDFs, Word documents and scanned-page images, then
+drives the views through the Django test client against a throw-away
+database (SQLite with `benchmark --settings myproject.benchmark_settings pipeline`):
+uploads (`save_file`), ingestion of the queued files (in this
+process, one file at a time), searches (`perform_search`, each query once
+uncached and once from the result cache), downloads, thumbnails, renames and
+deletes.
+
+Every operation reports p50/p95/p99 latency and operations per second, and
+peak RSS is taken after each phase. `--baseline FILE` compares the run with
+the results saved in FILE (or saves them there if it doesn't exist yet, or
+with `--save-baseline`); operations whose p95 grew by more than
+`--tolerance` are reported as regressions.
+"""
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import CommandError
+
+from . import benchmark_database, format_bytes, peak_rss_bytes, percentile
+from .fixtures import random_text, write_corpus
+
+
+def add_arguments(parser):
+    parser.add_argument('--files', type=int, default=60)
+    parser.add_argument('--kinds', nargs='+', choices=['pdf', 'docx', 'image'], default=['pdf', 'docx', 'image'])
+    parser.add_argument('--words', type=int, default=2000, help='Words per PDF and Word document.')
+    parser.add_argument('--image-size', default='1240x1754', help='Pixels of the scanned pages (WIDTHxHEIGHT).')
+    parser.add_argument('--vocabulary', type=int, default=2000, help='Distinct words in the corpus.')
+    parser.add_argument('--searches', type=int, default=100, help='Distinct search queries.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', help='JSON file to compare the results with (written if missing).')
+    parser.add_argument('--save-baseline', action='store_true', help='Overwrite the baseline with this run.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative p95 increase reported as a regression.')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Exit with an error if anything regressed.')
+
+
+def _stats(samples, size=0):
+    """Summary of one operation's latencies (seconds) and the bytes it moved."""
+    total = sum(samples)
+    stats = {
+        'count': len(samples),
+        'p50': percentile(samples, 50),
+        'p95': percentile(samples, 95),
+        'p99': percentile(samples, 99),
+        'mean': statistics.fmean(samples),
+        'per_second': len(samples) / total if total else 0.0,
+    }
+    if size:
+        stats['mb_per_second'] = size / (1024 * 1024) / total if total else 0.0
+    return stats
+
+
+def _check(response, operation):
+    """Fails the run on an error response, which would otherwise be timed as a success."""
+    if response.status_code != 200:
+        raise CommandError(f"{operation} failed with status {response.status_code}.")
+    return response
+
+
+def _consume(response):
+    """Reads the whole body, as a client would, and returns its size."""
+    if response.streaming:
+        size = sum(len(chunk) for chunk in response.streaming_content)
+    else:
+        size = len(response.content)
+    response.close()
+    return size
+
+
+def _ingest_queue(samples_by_kind):
+    """Runs the queued ingestion jobs here, one file at a time, timing each one; returns the failures."""
+    from fileapp import metrics
+    from fileapp.extraction import extract_and_tag
+    from fileapp.ingest import claim_jobs, complete_job, fail_job
+
+    failures = 0
+    while True:
+        jobs = claim_jobs('benchmark', 50)
+        if not jobs:
+            return failures
+        for job in jobs:
+            kind = os.path.splitext(job.file.file_name)[1].lstrip('.')
+            start = time.perf_counter()
+            try:
+                tag_positions, report, text = extract_and_tag(job.file.blob.file_content.path, job.file.file_name)
+            except Exception as e:
+                fail_job(job, e)  # Retried after a backoff, so not again in this run
+                failures += 1
+                continue
+            metrics.merge(report.pop('metrics', None))  # Recorded in this process; keep it
+            complete_job(job, tag_positions, report, text)
+            samples_by_kind.setdefault(kind, []).append((time.perf_counter() - start, job.file.blob.size))
+
+
+def _run(stdout, client, corpus_dir, files, kinds, words, image_size, vocabulary, searches, seed):
+    from fileapp.backends import preload
+    from fileapp.models import File
+
+    preload(['nlp'])  # Loading the model is the startup benchmark's business, not the first request's
+
+    results = {'operations': {}, 'peak_rss': {}}
+
+    def record(name, samples, size=0):
+        results['operations'][name] = _stats(samples, size)
+
+    def phase_done(name):
+        results['peak_rss'][name] = peak_rss_bytes()
+
+    start = time.perf_counter()
+    paths, words_list, cum_weights = write_corpus(corpus_dir, files, kinds, words, image_size, vocabulary, seed)
+    corpus_bytes = sum(os.path.getsize(path) for path in paths)
+    stdout.write(f"Corpus: {len(paths)} files ({', '.join(kinds)}), {format_bytes(corpus_bytes)}, "
+                 f"written in {time.perf_counter() - start:.1f}s")
+
+    samples = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            start = time.perf_counter()
+            response = client.post('/api/upload/', {'action': 'upload', 'query': '', 'file': f})
+            samples.append(time.perf_counter() - start)
+        _check(response, f"Upload of {path}")
+    record('upload', samples, corpus_bytes)
+    phase_done('upload')
+
+    ingested = {}
+    failures = _ingest_queue(ingested)
+    for kind, kind_samples in sorted(ingested.items()):
+        record(f'ingest {kind}', [seconds for seconds, _ in kind_samples], sum(size for _, size in kind_samples))
+    if failures:
+        stdout.write(f"  {failures} files failed extraction (is Tesseract installed?)")
+    phase_done('ingest')
+
+    rng = random.Random(seed)
+    queries = [random_text(rng, rng.randint(1, 3), words_list, cum_weights) for _ in range(searches)]
+    cold, cached = [], []
+    for query in queries:
+        for samples in (cold, cached):
+            start = time.perf_counter()
+            response = client.post('/api/search/', {'action': 'search', 'query': query})
+            samples.append(time.perf_counter() - start)
+            _check(response, f"Search for {query!r}")
+    record('search', cold)
+    record('search, cached', cached)
+    phase_done('search')
+
+    file_ids = list(File.objects.order_by('id').values_list('id', flat=True))
+    samples, downloaded = [], 0
+    for file_id in file_ids:
+        start = time.perf_counter()
+        downloaded += _consume(_check(client.get(f'/api/download/{file_id}/'), f"Download of file {file_id}"))
+        samples.append(time.perf_counter() - start)
+    record('download', samples, downloaded)
+    phase_done('download')
+
+    samples, fetched = [], 0
+    for file_id in File.objects.filter(blob__preview__has_thumbnail=True).order_by('id').values_list('id', flat=True):
+        start = time.perf_counter()
+        fetched += _consume(_check(client.get(f'/api/preview/{file_id}/thumbnail/'), f"Thumbnail of file {file_id}"))
+        samples.append(time.perf_counter() - start)
+    if samples:
+        record('thumbnail', samples, fetched)
+
+    samples = []
+    for number, file_id in enumerate(file_ids):
+        start = time.perf_counter()
+        response = client.post(f'/api/rename/{file_id}/', json.dumps({'new_name_base': f'renamed_{number}'}), content_type='application/json')
+        samples.append(time.perf_counter() - start)
+        _check(response, f"Rename of file {file_id}")
+    record('rename', samples)
+
+    samples = []
+    for file_id in file_ids:
+        start = time.perf_counter()
+        response = client.post(f'/api/delete/{file_id}/')
+        samples.append(time.perf_counter() - start)
+        _check(response, f"Delete of file {file_id}")
+    record('delete', samples)
+    phase_done('delete')
+    return results
+
+
+def _report(stdout, results):
+    stdout.write(f"  {'operation':<16} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>9} {'MB/s':>8}")
+    for name, stats in results['operations'].items():
+        mb_per_second = f"{stats['mb_per_second']:8.2f}" if 'mb_per_second' in stats else f"{'':>8}"
+        stdout.write(
+            f"  {name:<16} {stats['count']:>6} {stats['p50'] * 1000:9.2f} {stats['p95'] * 1000:9.2f} "
+            f"{stats['p99'] * 1000:9.2f} {stats['per_second']:9.1f} {mb_per_second}"
+        )
+    stdout.write("  peak RSS after " + ", ".join(
+        f"{phase} {format_bytes(size)}" for phase, size in results['peak_rss'].items()
+    ))
+
+
+def _compare(stdout, results, baseline, tolerance):
+    """Prints the change against the baseline; returns the names of regressed operations."""
+    if baseline.get('config') != results['config']:
+        stdout.write("  Baseline was recorded with other options; differences may not mean much:")
+        stdout.write(f"    baseline {baseline.get('config')}")
+    regressions = []
+    stdout.write(f"  {'operation':<16} {'p50':>8} {'p95':>8} {'ops/s':>8}  (change against the baseline)")
+    for name, stats in results['operations'].items():
+        old = baseline.get('operations', {}).get(name)
+        if not old:
+            stdout.write(f"  {name:<16} (not in the baseline)")
+            continue
+
+        def change(key):
+            return (stats[key] - old[key]) / old[key] if old[key] else 0.0
+
+        regressed = change('p95') > tolerance
+        if regressed:
+            regressions.append(name)
+        stdout.write(
+            f"  {name:<16} {change('p50'):+8.1%} {change('p95'):+8.1%} {change('per_second'):+8.1%}"
+            + ("  REGRESSION" if regressed else "")
+        )
+    old_rss = max(baseline.get('peak_rss', {}).values(), default=0)
+    new_rss = max(results['peak_rss'].values(), default=0)
+    if old_rss:
+        regressed = (new_rss - old_rss) / old_rss > tolerance
+        if regressed:
+            regressions.append('peak RSS')
+        stdout.write(f"  {'peak RSS':<16} {format_bytes(old_rss)} -> {format_bytes(new_rss)}" + ("  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def run(stdout, files, kinds, words, image_size, vocabulary, searches, seed, baseline, save_baseline,
+        tolerance, fail_on_regression, **options):
+    from django.conf import settings
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import override_settings
+
+    width, _, height = image_size.lower().partition('x')
+    config = {
+        'files': files, 'kinds': kinds, 'words': words, 'image_size': image_size,
+        'vocabulary': vocabulary, 'searches': searches, 'seed': seed, 'database': connection.vendor,
+    }
+    stdout.write(f"Database: {connection.vendor} (test database, created for the run)")
+    # The test client's requests come from host 'testserver'
+    hosts = [*settings.ALLOWED_HOSTS, 'testserver']
+    with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root, ALLOWED_HOSTS=hosts), benchmark_database():
+        results = _run(
+            stdout, Client(), os.path.join(media_root, 'corpus'), files, kinds, words,
+            (int(width), int(height)), vocabulary, searches, seed,
+        )
+    results['config'] = config
+    _report(stdout, results)
+
+    if not baseline:
+        return
+    if save_baseline or not os.path.exists(baseline):
+        with open(baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        stdout.write(f"Baseline saved to {baseline}.")
+        return
+    with open(baseline) as f:
+        regressions = _compare(stdout, results, json.load(f), tolerance)
+    if regressions and fail_on_regression:
+        raise CommandError(f"Slower than the baseline: {', '.join(regressions)}.")
@@ -0,0 +1,105 @@
+"""Latency of boolean, phrase and prefix queries over positional postings.
+
+Builds a synthetic corpus whose documents are sequences of pseudo-words drawn
+from a Zipf distribution, with each posting's token positions stored the way
+ingestion stores them, and times `query.rank` (first page, no result cache)
+for each kind of query. The plain bag-of-lemmas ranking of the same words is
+timed alongside for reference: it can only answer "any of these words", so
+its hit counts show how much an operator narrows the result set.
+"""
+import random
+
+from . import benchmark_database, summarize, timed
+from .fixtures import pseudo_words
+
+
+def add_arguments(parser):
+    parser.add_argument('--files', type=int, default=5_000)
+    parser.add_argument('--tokens', type=int, default=200, help='Tokens per document.')
+    parser.add_argument('--vocabulary', type=int, default=5_000)
+    parser.add_argument('--queries', type=int, default=20, help='Queries timed per kind.')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def _populate(rng, words, weights, files, tokens):
+    """Creates the corpus; returns the token sequence of every document (to draw phrases from)."""
+    from fileapp.models import Blob, File, FileTag, Tag
+    from fileapp.positions import encode_positions
+    from fileapp.tags import recount_doc_freqs
+
+    Tag.objects.bulk_create([Tag(tag_name=word) for word in words], batch_size=5000)
+    tag_ids = dict(Tag.objects.values_list('tag_name', 'id'))
+    blob = Blob.objects.create(content_hash='0' * 64, file_content='uploaded_files/synthetic.txt')
+    documents = []
+    for start in range(0, files, 500):
+        batch = [rng.choices(words, weights=weights, k=tokens) for _ in range(min(500, files - start))]
+        file_instances = File.objects.bulk_create(
+            [File(file_name=f"synthetic_{start + i}.txt", blob=blob, token_count=tokens) for i in range(len(batch))]
+        )
+        if file_instances[0].pk is None:  # Backends that don't return ids from bulk inserts
+            file_instances = list(File.objects.order_by('-id')[:len(batch)])[::-1]
+        rows = []
+        for file_instance, document in zip(file_instances, batch):
+            positions = {}
+            for position, word in enumerate(document):
+                positions.setdefault(word, []).append(position)
+            rows.extend(
+                FileTag(file=file_instance, tag_id=tag_ids[word], frequency=len(occurrences), positions=encode_positions(occurrences))
+                for word, occurrences in positions.items()
+            )
+        FileTag.objects.bulk_create(rows, batch_size=5000)
+        documents.extend(batch)
+    recount_doc_freqs()  # The postings were written directly
+    return documents
+
+
+def run(stdout, files, tokens, vocabulary, queries, seed, **options):
+    from fileapp import query, search
+    from fileapp.models import FileTag
+
+    rng = random.Random(seed)
+    words = pseudo_words(vocabulary, rng)
+    rng.shuffle(words)
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    common, medium, rare = words[:20], words[50:500], words[1000:]
+
+    with benchmark_database():
+        documents = _populate(rng, words, weights, files, tokens)
+        stdout.write(f"{files} files, {FileTag.objects.count()} postings, {vocabulary} words")
+
+        def pair(left, right, operator):
+            words = [rng.choice(left), rng.choice(right)]
+            return f"{words[0]} {operator} {words[1]}", words
+
+        def phrase():
+            document = rng.choice(documents)
+            start = rng.randrange(len(document) - 1)
+            words = document[start:start + 2]
+            return '"' + " ".join(words) + '"', words
+
+        def prefix():
+            word = rng.choice(medium)
+            return word[:3] + '*', [word]
+
+        kinds = [
+            ('rare AND common', lambda: pair(rare, common, 'AND')),
+            ('common AND common', lambda: pair(common, common, 'AND')),
+            ('medium AND medium', lambda: pair(medium, medium, 'AND')),
+            ('common NOT medium', lambda: pair(common, medium, 'NOT')),
+            ('two-word phrase', phrase),
+            ('prefix (3 letters)', prefix),
+        ]
+        query.rank(words[0], None, 20)  # Loads the spaCy model outside the timings
+        for label, make in kinds:
+            query_samples, plain_samples, hits, plain_hits = [], [], [], []
+            for _ in range(queries):
+                text, words = make()
+                seconds, (_, total) = timed(query.rank, text, None, 20)
+                query_samples.append(seconds)
+                hits.append(total['value'])
+                # The plain path ranks files containing any of the words (for a prefix, the word it was cut from)
+                seconds, (_, plain_total) = timed(search._rank, words, None, 20)
+                plain_samples.append(seconds)
+                plain_hits.append(plain_total['value'])
+            stdout.write(f"  {label:<20} query  {summarize(query_samples)}  avg hits {sum(hits) / len(hits):9.1f}")
+            stdout.write(f"  {'':<20} plain  {summarize(plain_samples)}  avg hits {sum(plain_hits) / len(plain_hits):9.1f}")
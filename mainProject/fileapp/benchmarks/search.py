@@ -0,0 +1,152 @@
+"""Search latency at growing FileTag table sizes (BM25 vs the old per-tag loop).
+
+Builds a synthetic corpus with a Zipf-distributed vocabulary, so query terms
+range from very rare to present in most files, and times `rank_files` against
+the previous implementation at each requested number of `FileTag` rows. Deep
+pages are also fetched both through the keyset cursor and the way the
+OFFSET-paginated search did it (exact count, full model instances).
+"""
+import random
+from collections import defaultdict
+
+from . import benchmark_database, summarize, timed
+
+
+def add_arguments(parser):
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000], help='FileTag row counts to measure at.')
+    parser.add_argument('--tags-per-file', type=int, default=100)
+    parser.add_argument('--vocabulary', type=int, default=20_000, help='Number of distinct tags.')
+    parser.add_argument('--queries', type=int, default=20, help='Queries timed per table size.')
+    parser.add_argument('--legacy-max-rows', type=int, default=100_000, help='Skip the old implementation above this many rows.')
+    parser.add_argument('--page-depth', type=int, default=50, help='Page number fetched by the deep-page comparison.')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def legacy_search(tag_names):
+    """The per-tag query loop `perform_search` used before BM25 ranking."""
+    from fileapp.models import File, FileTag
+
+    file_hit_count = defaultdict(int)
+    for tag in tag_names:
+        tag_file_hits = FileTag.objects.filter(tag__tag_name=tag).values_list('file', flat=True).distinct()
+        for file_hit in tag_file_hits:
+            file_hit_count[file_hit] += 1
+    sorted_file_hits = sorted(file_hit_count.items(), key=lambda x: x[1], reverse=True)
+    return [File.objects.get(id=file_id) for file_id, _ in sorted_file_hits]
+
+
+def offset_page(tag_names, page, page_size=20):
+    """One result page the way search paginated before cursors: OFFSET, exact count and full instances."""
+    from django.conf import settings
+    from django.db.models import Avg, Case, Count, FloatField, Sum, Value, When
+    from django.db.models.functions import Cast
+    from fileapp.models import File, FileTag, Tag
+    from fileapp.search import bm25_idf
+
+    k1 = getattr(settings, 'SEARCH_BM25_K1', 1.2)
+    b = getattr(settings, 'SEARCH_BM25_B', 0.75)
+    doc_freqs = dict(Tag.objects.filter(tag_name__in=tag_names, doc_freq__gt=0).values_list('id', 'doc_freq'))
+    if not doc_freqs:
+        return [], 0
+    corpus = File.objects.filter(ingest_status=File.IngestStatus.DONE).aggregate(doc_count=Count('id'), avg_length=Avg('token_count'))
+    idf = Case(
+        *[When(tag_id=tag_id, then=Value(bm25_idf(corpus['doc_count'], df))) for tag_id, df in doc_freqs.items()],
+        output_field=FloatField(),
+    )
+    tf = Cast('frequency', FloatField())
+    length_norm = Value(k1) * (Value(1 - b) + Value(b) * Cast('file__token_count', FloatField()) / Value(corpus['avg_length'] or 1.0))
+    postings = FileTag.objects.filter(tag_id__in=doc_freqs)
+    offset = (page - 1) * page_size
+    ranked = list(
+        postings.values('file_id')
+        .annotate(score=Sum(idf * tf * Value(k1 + 1) / (tf + length_norm)))
+        .order_by('-score', '-file_id')
+        .values_list('file_id', 'score')[offset:offset + page_size]
+    )
+    total = postings.values('file_id').distinct().count()
+    files_by_id = File.objects.in_bulk([file_id for file_id, _ in ranked])
+    return [files_by_id[file_id] for file_id, _ in ranked if file_id in files_by_id], total
+
+
+def _cursor_at(rank_files, tag_names, page):
+    """Cursor of the given page, found by walking the pages before it."""
+    cursor = None
+    for _ in range(page - 1):
+        cursor = rank_files(tag_names, cursor).next_cursor
+        if cursor is None:
+            break
+    return cursor
+
+
+def _populate(rng, blob, vocabulary, weights, tags_per_file, current_rows, target_rows):
+    """Adds synthetic files until the FileTag table holds `target_rows` rows."""
+    from fileapp.models import File, FileTag
+    from fileapp.tags import recount_doc_freqs
+
+    batch_files = 500
+    while current_rows < target_rows:
+        files = []
+        postings = []
+        batch_rows = 0
+        for _ in range(batch_files):
+            if current_rows + batch_rows >= target_rows:
+                break
+            tag_ids = set(rng.choices(vocabulary, weights=weights, k=tags_per_file))
+            frequencies = {tag_id: rng.randint(1, 12) for tag_id in tag_ids}
+            files.append(File(
+                file_name=f"synthetic_{rng.getrandbits(32):08x}.pdf",
+                blob=blob,
+                token_count=sum(frequencies.values()),
+            ))
+            postings.append(frequencies)
+            batch_rows += len(frequencies)
+        File.objects.bulk_create(files, batch_size=1000)
+        if files[0].pk is None:  # Backends that don't return ids from bulk inserts
+            files = list(File.objects.order_by('-id')[:len(files)])[::-1]
+        rows = [
+            FileTag(file=file_instance, tag_id=tag_id, frequency=frequency)
+            for file_instance, frequencies in zip(files, postings)
+            for tag_id, frequency in frequencies.items()
+        ]
+        FileTag.objects.bulk_create(rows, batch_size=5000)
+        current_rows += len(rows)
+    recount_doc_freqs()  # The postings were written directly
+    return current_rows
+
+
+def run(stdout, rows, tags_per_file, vocabulary, queries, legacy_max_rows, page_depth, seed, **options):
+    from fileapp.models import Blob, Tag
+    from fileapp.search import rank_files
+
+    rng = random.Random(seed)
+    with benchmark_database():
+        blob = Blob.objects.create(content_hash='0' * 64, file_content='uploaded_files/synthetic.pdf')
+        Tag.objects.bulk_create([Tag(tag_name=f"term{i:06d}") for i in range(vocabulary)], batch_size=5000)
+        tags = list(Tag.objects.order_by('id').values_list('id', 'tag_name'))
+        tag_ids = [tag_id for tag_id, _ in tags]
+        weights = [1 / (rank + 1) for rank in range(len(tags))]
+
+        current_rows = 0
+        for target in sorted(rows):
+            current_rows = _populate(rng, blob, tag_ids, weights, tags_per_file, current_rows, target)
+            query_set = [
+                [name for _, name in rng.choices(tags, weights=weights, k=rng.randint(1, 3))]
+                for _ in range(queries)
+            ]
+            bm25_samples = [timed(rank_files, names)[0] for names in query_set]
+            stdout.write(f"{current_rows:>9} rows  bm25    {summarize(bm25_samples)}")
+            if current_rows <= legacy_max_rows:
+                legacy_samples = [timed(legacy_search, names)[0] for names in query_set]
+                stdout.write(f"{current_rows:>9} rows  legacy  {summarize(legacy_samples)}")
+
+            # Common terms, whose hits run deepest
+            for deep_query in ([tags[0][1]], [tags[0][1], tags[1][1]]):
+                for page in (1, page_depth):
+                    cursor = _cursor_at(rank_files, deep_query, page)
+                    if page > 1 and cursor is None:
+                        continue
+                    cursor_samples = [timed(rank_files, deep_query, cursor)[0] for _ in range(queries)]
+                    offset_samples = [timed(offset_page, deep_query, page)[0] for _ in range(queries)]
+                    label = f"{len(deep_query)} term{'s' if len(deep_query) > 1 else ''}, page {page}"
+                    stdout.write(f"{current_rows:>9} rows  {label:<17} cursor  {summarize(cursor_samples)}")
+                    stdout.write(f"{current_rows:>9} rows  {label:<17} offset  {summarize(offset_samples)}")
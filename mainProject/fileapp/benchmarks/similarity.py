@@ -0,0 +1,141 @@
+"""Latency, recall and footprint of the similar-files lookup.
+
+Builds a synthetic corpus of tag sets, drawn from a Zipf distribution over
+`--vocabulary` tag ids, in which `--duplicate-share` of the files are edited
+copies of an earlier file (5-50% of their tags replaced), as revisions and
+re-scans of the same document would be. Signatures and LSH keys are written
+with `similarity.store_signatures`, as ingestion does; then
+`similarity.similar_files` is timed for random files, and its hits are
+compared with the exact top `--limit` by Jaccard similarity of the tag sets
+(computed by brute force over the whole corpus) on a sample of them.
+"""
+import random
+import tracemalloc
+
+from . import benchmark_database, format_bytes, peak_rss_bytes, summarize, timed
+
+
+def add_arguments(parser):
+    parser.add_argument('--files', type=int, default=100_000)
+    parser.add_argument('--tags', type=int, default=200, help='Tags drawn per file (fewer distinct ones remain).')
+    parser.add_argument('--vocabulary', type=int, default=50_000)
+    parser.add_argument('--duplicate-share', type=float, default=0.3, help='Share of files that are edited copies of another.')
+    parser.add_argument('--queries', type=int, default=200, help='Lookups timed.')
+    parser.add_argument('--recall-queries', type=int, default=20, help='Lookups checked against brute-force Jaccard.')
+    parser.add_argument('--limit', type=int, default=10, help='Similar files asked for per lookup.')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def _tag_sets(np_rng, files, tags, vocabulary, duplicate_share):
+    """One set of tag ids per file, edited copies included."""
+    import numpy as np
+
+    p = 1 / np.arange(1, vocabulary + 1)
+    p /= p.sum()
+    tag_sets = []
+    for start in range(0, files, 10_000):
+        draws = np_rng.choice(vocabulary, size=(min(10_000, files - start), tags), p=p) + 1
+        for row in draws:
+            if tag_sets and np_rng.random() < duplicate_share:
+                source = sorted(tag_sets[np_rng.integers(len(tag_sets))])
+                replaced = int(len(source) * np_rng.uniform(0.05, 0.5))
+                kept = np_rng.permutation(source)[replaced:]
+                tag_sets.append(set(kept.tolist()) | set(row[:replaced].tolist()))
+            else:
+                tag_sets.append(set(row.tolist()))
+    return tag_sets
+
+
+def _populate(tag_sets):
+    """Creates a blob and a file per tag set and stores their signatures; returns their `(blob_id, file_id)`s."""
+    from fileapp.models import Blob, File
+    from fileapp.similarity import store_signatures
+
+    created = []
+    for start in range(0, len(tag_sets), 5_000):
+        batch = range(start, min(start + 5_000, len(tag_sets)))
+        Blob.objects.bulk_create(
+            [Blob(content_hash=f"{i:064x}", file_content=f"uploaded_files/synthetic_{i}.txt", ref_count=1) for i in batch]
+        )
+        blob_ids = dict(Blob.objects.filter(content_hash__in=[f"{i:064x}" for i in batch]).values_list('content_hash', 'id'))
+        blobs = [blob_ids[f"{i:064x}"] for i in batch]
+        File.objects.bulk_create([File(file_name=f"synthetic_{i}.txt", blob_id=blob_id) for i, blob_id in zip(batch, blobs)])
+        file_ids = dict(File.objects.filter(blob_id__in=blobs).values_list('blob_id', 'id'))
+        created.extend((blob_id, file_ids[blob_id]) for blob_id in blobs)
+        store_signatures({blob_id: tag_sets[i] for i, blob_id in zip(batch, blobs)})
+    return created
+
+
+def _exact_top(tag_sets, index, limit, min_score):
+    """Indexes of the `limit` files most similar to file `index` by exact Jaccard similarity."""
+    query = tag_sets[index]
+    scores = []
+    for other, tag_set in enumerate(tag_sets):
+        if other != index:
+            shared = len(query & tag_set)
+            if shared:
+                score = shared / (len(query) + len(tag_set) - shared)
+                if score >= min_score:
+                    scores.append((score, other))
+    scores.sort(reverse=True)
+    return scores[:limit]
+
+
+def run(stdout, files, tags, vocabulary, duplicate_share, queries, recall_queries, limit, seed, **options):
+    import numpy as np
+    from django.conf import settings
+
+    from fileapp import similarity
+    from fileapp.models import SimilarityKey, TagSignature
+
+    rng = random.Random(seed)
+    tag_sets = _tag_sets(np.random.default_rng(seed), files, tags, vocabulary, duplicate_share)
+    min_score = getattr(settings, 'SIMILARITY_MIN_SCORE', 0.2)
+
+    with benchmark_database():
+        seconds, created = timed(_populate, tag_sets)
+        signatures, keys = TagSignature.objects.count(), SimilarityKey.objects.count()
+        stdout.write(
+            f"{files} files, {sum(map(len, tag_sets)) / files:.0f} distinct tags each on average, "
+            f"signed and indexed in {seconds:.1f} s ({files / seconds:.0f} files/s)"
+        )
+        stdout.write(
+            f"  storage: {signatures} signatures ({format_bytes(signatures * similarity.PERMUTATIONS * 4)}), "
+            f"{keys} band keys ({format_bytes(keys * 16)} of key and blob id, before the index)"
+        )
+
+        similarity.similar_files(created[0][1], limit)  # Loads NumPy and the hash coefficients outside the timings
+        samples, candidate_counts, hits = [], [], []
+        for _ in range(queries):
+            blob_id, file_id = rng.choice(created)
+            seconds, results = timed(similarity.similar_files, file_id, limit)
+            samples.append(seconds)
+            hits.append(len(results))
+            candidate_counts.append(len(similarity.candidates(similarity.load_signature(blob_id), blob_id)))
+        stdout.write(f"  lookup (limit {limit})  {summarize(samples)}")
+        stdout.write(
+            f"  candidates scored: avg {sum(candidate_counts) / len(candidate_counts):.1f}, max {max(candidate_counts)}; "
+            f"hits returned: avg {sum(hits) / len(hits):.1f}"
+        )
+
+        tracemalloc.start()
+        similarity.similar_files(rng.choice(created)[1], limit)
+        _, lookup_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stdout.write(f"  memory: {format_bytes(lookup_peak)} allocated at peak by one lookup, process peak RSS {format_bytes(peak_rss_bytes())}")
+
+        found = expected = 0
+        index_of_file = {file_id: index for index, (_, file_id) in enumerate(created)}
+        for _ in range(recall_queries):
+            index = rng.randrange(files)
+            exact = {other for _, other in _exact_top(tag_sets, index, limit, min_score)}
+            returned = {index_of_file[hit['id']] for hit in similarity.similar_files(created[index][1], limit)}
+            found += len(exact & returned)
+            expected += len(exact)
+        if expected:
+            stdout.write(
+                f"  recall@{limit} vs exact Jaccard >= {min_score}: {found / expected:.1%} "
+                f"({found}/{expected} over {recall_queries} lookups)"
+            )
+        else:
+            stdout.write(f"  recall: no file sampled has another with Jaccard >= {min_score}")
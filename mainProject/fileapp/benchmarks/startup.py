@@ -0,0 +1,57 @@
+"""Process start-up cost: import time and peak RSS of cold processes.
+
+Each scenario runs in a fresh interpreter: `manage.py check`, a cold web
+worker (settings, app registry, WSGI application and URLconf loaded), the
+same worker with the eager imports `views.py` used to do, and an ingestion
+worker after `preload()`. Unix only (peak RSS comes from `os.wait4`).
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from . import format_bytes
+
+WEB_WORKER = (
+    "import django; django.setup(); "
+    "from myproject.wsgi import application; "
+    "from django.urls import resolve; resolve('/api/search/')"
+)
+
+SCENARIOS = [
+    ('manage.py check', ['manage.py', 'check']),
+    ('cold web worker', ['-c', WEB_WORKER]),
+    ('web worker, eager imports (before)', ['-c', WEB_WORKER + (
+        "; import pdfplumber, textract, docx2txt, spacy, PIL.Image, pytesseract; "
+        "from django.conf import settings; spacy.load(settings.NLP_MODEL)"
+    )]),
+    ('ingestion worker, preloaded', ['-c', "import django; django.setup(); from fileapp.backends import preload; preload()"]),
+]
+
+
+def add_arguments(parser):
+    parser.add_argument('--repeat', type=int, default=5)
+
+
+def _run_once(args, cwd):
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, *args], cwd=cwd, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise RuntimeError(f"{' '.join(args)} exited with status {process.returncode}")
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return seconds, rss
+
+
+def run(stdout, repeat, **options):
+    from django.conf import settings
+
+    for label, args in SCENARIOS:
+        samples = [_run_once(args, settings.BASE_DIR) for _ in range(repeat)]
+        seconds = statistics.median(sample[0] for sample in samples)
+        rss = max(sample[1] for sample in samples)
+        stdout.write(f"{label:<38} {seconds * 1000:8.0f} ms  peak RSS {format_bytes(rss)}")
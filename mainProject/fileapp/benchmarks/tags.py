@@ -0,0 +1,60 @@
+"""Upload-to-indexed time for a many-tag document (batched vs per-tag writes).
+
+Times the work the ingestion worker does once extraction has finished: storing
+the file's tags and marking it searchable. The document's tags are measured
+both against an empty vocabulary ("cold", every tag is new) and against one
+that already contains them ("warm", the common case for an established corpus).
+"""
+import random
+import string
+
+from . import benchmark_database, summarize, timed
+
+
+def add_arguments(parser):
+    parser.add_argument('--tags', type=int, default=3000, help='Distinct tags in the document.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def legacy_save_tags(file_instance, tag_counts):
+    """The per-tag writer `save_file` used before batching, outside any transaction."""
+    from fileapp.models import FileTag, Tag
+
+    for tag_name, frequency in tag_counts.items():
+        tag, created = Tag.objects.get_or_create(tag_name=tag_name)
+        FileTag.objects.create(file=file_instance, tag=tag, frequency=frequency)
+
+
+def _document(rng, tags):
+    return {
+        ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 12))): rng.randint(1, 20)
+        for _ in range(tags)
+    }
+
+
+def run(stdout, tags, repeat, seed, **options):
+    from fileapp import tag_cache
+    from fileapp.models import Blob, File, FileTag, Tag
+    from fileapp.tags import save_tags
+
+    rng = random.Random(seed)
+    writers = [('legacy', legacy_save_tags), ('batched', save_tags)]
+    with benchmark_database():
+        blob = Blob.objects.create(content_hash='0' * 64, file_content='uploaded_files/synthetic.pdf')
+        for vocabulary in ('cold', 'warm'):
+            for label, writer in writers:
+                samples = []
+                for _ in range(repeat):
+                    tag_counts = _document(rng, tags)
+                    if vocabulary == 'cold':
+                        Tag.objects.all().delete()
+                        tag_cache.clear()
+                    else:
+                        Tag.objects.bulk_create([Tag(tag_name=name) for name in tag_counts], ignore_conflicts=True)
+                    file_instance = File.objects.create(file_name='synthetic.pdf', blob=blob)
+                    seconds, _ = timed(writer, file_instance, tag_counts)
+                    samples.append(seconds)
+                    FileTag.objects.filter(file=file_instance).delete()
+                    file_instance.delete()
+                stdout.write(f"{len(tag_counts)} tags  {vocabulary}  {label:<8} {summarize(samples)}")
@@ -0,0 +1,146 @@
+"""Peak memory and I/O bytes per GB uploaded: the multipart form vs resumable chunked uploads.
+
+Both paths are driven through real `WSGIRequest`s whose body is read from a
+file, standing in for the socket. I/O is what the process moved through
+read/write system calls (`rchar`/`wchar` in /proc/self/io, Linux only),
+body included. Each variant runs in a freshly spawned process so peak RSS
+figures don't leak between them.
+"""
+import multiprocessing
+import os
+import tempfile
+import time
+
+from . import format_bytes, peak_rss_bytes
+
+BOUNDARY = 'benchmarkboundary'
+
+
+def add_arguments(parser):
+    parser.add_argument('--size-mb', type=int, default=512, help='Size of the uploaded file.')
+    parser.add_argument('--chunk-mb', type=int, default=8, help='Chunk size of the chunked variant.')
+
+
+def _io_counters():
+    counters = {}
+    with open('/proc/self/io') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            counters[name] = int(value)
+    return counters
+
+
+def _request(method, path, body_file, length, content_type='', **meta):
+    from django.core.handlers.wsgi import WSGIRequest
+
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'SERVER_NAME': 'testserver',
+        'SERVER_PORT': '80',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': body_file,
+        'CONTENT_LENGTH': str(length),
+        'CONTENT_TYPE': content_type,
+    }
+    environ.update(meta)
+    return WSGIRequest(environ)
+
+
+def _upload_form(multipart_path):
+    from fileapp import views
+
+    with open(multipart_path, 'rb') as body:
+        request = _request(
+            'POST', '/api/upload/', body, os.path.getsize(multipart_path),
+            content_type=f'multipart/form-data; boundary={BOUNDARY}',
+        )
+        views.upload_and_search(request)
+        request.close()  # Closes the temporary upload file, as the request handler would
+
+
+def _upload_chunked(source_path, chunk_size):
+    import io
+    import json
+
+    from fileapp import views
+
+    size = os.path.getsize(source_path)
+    payload = json.dumps({'file_name': 'upload.bin', 'size': size}).encode()
+    response = views.start_upload(_request('POST', '/api/upload/sessions/', io.BytesIO(payload), len(payload), 'application/json'))
+    upload_id = json.loads(response.content)['upload_id']
+    with open(source_path, 'rb') as body:
+        for offset in range(0, size, chunk_size):
+            length = min(chunk_size, size - offset)
+            body.seek(offset)
+            request = _request(
+                'PUT', f'/api/upload/sessions/{upload_id}/', body, length,
+                'application/octet-stream', HTTP_UPLOAD_OFFSET=str(offset),
+            )
+            views.upload_chunk(request, upload_id)
+    views.finish_upload(_request('POST', f'/api/upload/sessions/{upload_id}/finish/', io.BytesIO(), 0), upload_id)
+
+
+def _measure(variant, source_path, multipart_path, chunk_size, media_root, results):
+    import django
+
+    django.setup()
+    from django.test.utils import override_settings
+
+    from . import benchmark_database
+
+    with override_settings(MEDIA_ROOT=media_root), benchmark_database():
+        baseline = peak_rss_bytes()
+        before = _io_counters()
+        start = time.perf_counter()
+        if variant == 'form':
+            _upload_form(multipart_path)
+        else:
+            _upload_chunked(source_path, chunk_size)
+        seconds = time.perf_counter() - start
+        after = _io_counters()
+        results.put({
+            'seconds': seconds,
+            'rss_growth': peak_rss_bytes() - baseline,
+            'read': after['rchar'] - before['rchar'],
+            'written': after['wchar'] - before['wchar'],
+        })
+
+
+def run(stdout, size_mb, chunk_mb, **options):
+    if not os.path.exists('/proc/self/io'):
+        stdout.write("This benchmark needs /proc/self/io (Linux).")
+        return
+    size = size_mb * 1024 * 1024
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, 'source.bin')
+        multipart_path = os.path.join(directory, 'multipart.body')
+        with open(source_path, 'wb') as source, open(multipart_path, 'wb') as multipart:
+            multipart.write((
+                f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="action"\r\n\r\nupload\r\n'
+                f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="upload.bin"\r\n'
+                f'Content-Type: application/octet-stream\r\n\r\n'
+            ).encode())
+            for _ in range(size_mb):
+                block = os.urandom(1024 * 1024)
+                source.write(block)
+                multipart.write(block)
+            multipart.write(f'\r\n--{BOUNDARY}--\r\n'.encode())
+
+        stdout.write(f"Upload of {format_bytes(size)}; I/O scaled to 1 GB")
+        per_gb = (1024 ** 3) / size
+        for variant, label in (('form', 'multipart form'), ('chunked', f'chunked ({chunk_mb} MB chunks)')):
+            media_root = os.path.join(directory, f'media_{variant}')
+            results = context.Queue()
+            process = context.Process(
+                target=_measure,
+                args=(variant, source_path, multipart_path, chunk_mb * 1024 * 1024, media_root, results),
+            )
+            process.start()
+            result = results.get()
+            process.join()
+            stdout.write(
+                f"  {label:<24} {result['seconds']:6.2f} s  peak RSS +{format_bytes(result['rss_growth']):>9}  "
+                f"read {format_bytes(result['read'] * per_gb):>9}  written {format_bytes(result['written'] * per_gb):>9} per GB"
+            )
@@ -0,0 +1,272 @@
+"""Serving stored files: conditional requests, byte ranges and zero-copy hand-off.
+
+Blob contents never change, so the content hash is a strong ETag and the
+blob's creation time is its Last-Modified date; revalidations are answered
+with 304 without touching the file. `Range` requests (single or multiple
+ranges, optionally guarded by `If-Range`) get 206 responses, so interrupted
+downloads resume where they stopped.
+
+The bytes themselves go out one of three ways:
+- `DOWNLOAD_OFFLOAD = 'x-accel-redirect'` (nginx) or `'x-sendfile'` (Apache,
+  lighttpd): the response only names the file and the front server sends it,
+  ranges included, without a Python worker being involved.
+- Otherwise whole files and ranges that run to the end of the file are
+  returned with their file descriptor, so WSGI servers with a sendfile-capable
+  `wsgi.file_wrapper` (e.g. gunicorn) copy them with `os.sendfile`.
+- Everything else (bounded and multiple ranges) is streamed in blocks.
+
+Under ASGI there is no sendfile, and Django would read a synchronous body
+into memory before sending it, so `serve_blob(..., asynchronous=True)` (used
+by the async download view) streams every body as an async iterator whose
+blocks are read in a worker thread: slow clients then hold an idle
+coroutine, not a thread, and memory stays at one block per download.
+"""
+import asyncio
+import io
+import mimetypes
+import os
+import uuid
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+
+BLOCK_SIZE = 64 * 1024  # Bytes per read when streaming ranges
+
+
+def parse_range_header(header, size):
+    """Parses a `Range: bytes=...` header against a file of `size` bytes.
+
+    Returns a sorted list of non-overlapping `(start, end)` byte ranges (end
+    inclusive), an empty list if no range is satisfiable, or None if the
+    header is absent, malformed or asks for more than `DOWNLOAD_MAX_RANGES`
+    ranges, in which case the whole file should be served.
+    """
+    if not header:
+        return None
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    specs = [spec.strip() for spec in specs.split(',') if spec.strip()]
+    if not specs or len(specs) > getattr(settings, 'DOWNLOAD_MAX_RANGES', 16):
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.partition('-')
+        if not dash:
+            return None
+        first, last = first.strip(), last.strip()
+        if not first:  # Suffix range: the last `last` bytes
+            if not last.isdigit():
+                return None
+            length = int(last)
+            if length > 0 and size > 0:
+                ranges.append((max(0, size - length), size - 1))
+            continue
+        if not first.isdigit() or (last and not last.isdigit()):
+            return None
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start < size:
+            ranges.append((start, min(int(last), size - 1) if last else size - 1))
+
+    # Merge overlapping and adjacent ranges
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _if_range_matches(request, etag, last_modified):
+    """Whether an `If-Range` precondition (an ETag or a date) still holds; True if there is none."""
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag  # Weak tags never match: If-Range needs a strong comparison
+    return parse_http_date_safe(if_range) == last_modified
+
+
+class RangeFile:
+    """Read-only view of `length` bytes of an open file, starting at `start`.
+
+    When the range runs to the end of the file, `fileno()` exposes the
+    descriptor (positioned at `start`) so the server can `sendfile()` it;
+    for bounded ranges it raises, since servers send from the descriptor up
+    to the end of the file.
+    """
+
+    def __init__(self, file, start, length, to_end):
+        self.file = file
+        self.remaining = length
+        self.to_end = to_end
+        file.seek(start)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        if not self.to_end:
+            raise io.UnsupportedOperation("fileno() of a bounded range")
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+async def _aread_blocks(file_path, start, length):
+    """Async iterator over `length` bytes of a file from `start`, each block read in a worker thread."""
+    f = await asyncio.to_thread(open, file_path, 'rb')
+    try:
+        f.seek(start)
+        while length:
+            data = await asyncio.to_thread(f.read, min(BLOCK_SIZE, length))
+            if not data:
+                return  # File shrank under us; the client sees a short body
+            length -= len(data)
+            yield data
+    finally:
+        f.close()  # After a disconnect, waits for the read still running in its thread
+
+
+def _multipart_ranges(file_path, ranges, size, content_type, boundary):
+    """Yields a multipart/byteranges body, reading each range in blocks."""
+    with open(file_path, 'rb') as f:
+        for start, end in ranges:
+            yield _part_header(boundary, content_type, start, end, size)
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                data = f.read(min(BLOCK_SIZE, remaining))
+                if not data:
+                    return  # File shrank under us; the client sees a short body
+                remaining -= len(data)
+                yield data
+        yield f"\r\n--{boundary}--\r\n".encode('ascii')
+
+
+async def _amultipart_ranges(file_path, ranges, size, content_type, boundary):
+    """`_multipart_ranges` as an async iterator."""
+    for start, end in ranges:
+        yield _part_header(boundary, content_type, start, end, size)
+        async for data in _aread_blocks(file_path, start, end - start + 1):
+            yield data
+    yield f"\r\n--{boundary}--\r\n".encode('ascii')
+
+
+def _part_header(boundary, content_type, start, end, size):
+    return (
+        f"\r\n--{boundary}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+    ).encode('ascii')
+
+
+def _offload_response(blob, content_type):
+    """Empty response that tells the front server which file to send; it also handles Range."""
+    response = HttpResponse(content_type=content_type)
+    mode = getattr(settings, 'DOWNLOAD_OFFLOAD', None)
+    if mode == 'x-accel-redirect':
+        prefix = getattr(settings, 'DOWNLOAD_ACCEL_REDIRECT_PREFIX', '/protected-media/')
+        response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(blob.file_content.name)
+    else:
+        response['X-Sendfile'] = blob.file_content.path
+    return response
+
+
+def _streamed(file_path, start, length, content_type, status=200):
+    """Response streaming part of a file through an async iterator, for ASGI."""
+    response = StreamingHttpResponse(_aread_blocks(file_path, start, length), status=status, content_type=content_type)
+    response['Content-Length'] = length
+    return response
+
+
+def serve_blob(request, blob, file_name, asynchronous=False):
+    """Response for a download of `blob` under the name `file_name`.
+
+    Handles `If-None-Match`/`If-Modified-Since` (304), `If-Match`/
+    `If-Unmodified-Since` (412), `Range` (206/416) and `If-Range`. With
+    `asynchronous`, bodies are async iterators, for responses served by ASGI.
+    """
+    file_path = blob.file_content.path
+    size = os.path.getsize(file_path)
+    etag = f'"{blob.content_hash}"'
+    last_modified = int(blob.created_at.timestamp())
+    content_type = blob.content_type
+    if not content_type or content_type == 'application/octet-stream':
+        content_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': getattr(settings, 'DOWNLOAD_CACHE_CONTROL', 'private, no-cache'),
+        'Content-Disposition': content_disposition_header(True, file_name),
+    }
+
+    def with_headers(response):
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+    conditional = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if conditional is not None:
+        return with_headers(conditional)
+
+    if getattr(settings, 'DOWNLOAD_OFFLOAD', None):
+        return with_headers(_offload_response(blob, content_type))
+
+    ranges = None
+    if request.method in ('GET', 'HEAD') and _if_range_matches(request, etag, last_modified):
+        ranges = parse_range_header(request.headers.get('Range'), size)
+
+    if ranges is None and asynchronous:
+        return with_headers(_streamed(file_path, 0, size, content_type))
+    if ranges is None:
+        response = FileResponse(open(file_path, 'rb'), content_type=content_type)
+        response.block_size = BLOCK_SIZE
+        return with_headers(response)
+
+    if not ranges:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f"bytes */{size}"
+        return with_headers(response)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        length = end - start + 1
+        if asynchronous:
+            response = _streamed(file_path, start, length, content_type, status=206)
+            response['Content-Range'] = f"bytes {start}-{end}/{size}"
+            return with_headers(response)
+        range_file = RangeFile(open(file_path, 'rb'), start, length, to_end=end == size - 1)
+        response = FileResponse(range_file, status=206, content_type=content_type)
+        response.block_size = BLOCK_SIZE
+        response['Content-Length'] = length
+        response['Content-Range'] = f"bytes {start}-{end}/{size}"
+        return with_headers(response)
+
+    boundary = uuid.uuid4().hex
+    length = sum(
+        len(_part_header(boundary, content_type, start, end, size)) + end - start + 1
+        for start, end in ranges
+    ) + len(f"\r\n--{boundary}--\r\n")
+    multipart = _amultipart_ranges if asynchronous else _multipart_ranges
+    response = StreamingHttpResponse(
+        multipart(file_path, ranges, size, content_type, boundary),
+        status=206,
+        content_type=f"multipart/byteranges; boundary={boundary}",
+    )
+    response['Content-Length'] = length
+    return with_headers(response)
@@ -0,0 +1,496 @@
+import csv
+import logging
+import os
+import signal
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+
+from django.conf import settings
+
+from . import metrics, ocr
+from .backends import get_backend
+from .nlp import generate_tag_positions
+from .text_store import TextRecorder
+from .thumbnails import render_thumbnail
+
+logger = logging.getLogger(__name__)
+
+# This module must not import models: it is loaded by the ingestion worker's
+# child processes, which only do CPU work and never touch the database.
+# Extraction libraries are imported on first use through `backends`.
+
+# Bump when a change to the extractors alters the text of files already
+# ingested; files extracted with an older version can then be re-extracted
+# (`reindex_tags --reextract`).
+EXTRACTOR_VERSION = 1
+
+
+def init_worker(ignore_interrupts=False):
+    """Initializer of the process pools that run extraction.
+
+    With `ignore_interrupts`, Ctrl-C (sent to the whole process group) is left
+    to the parent, which finishes the files in progress.
+    """
+    if ignore_interrupts:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ocr.limit_tesseract_threads()
+
+
+def extract_text_from_image(image_path):
+    """Extracts text from an image file using OCR."""
+    return "\n".join(ocr.iter_image_text(image_path))
+
+
+def _pdf_page_count(file_path):
+    with get_backend('pdfplumber').open(file_path) as pdf:
+        return len(pdf.pages)
+
+
+def iter_pdf_pages(file_path, start=0, stop=None, deadline=None):
+    """Yields the text of PDF pages `start` to `stop` one page at a time.
+
+    Each page's layout objects are released as soon as its text is taken, so
+    memory stays flat however long the document is. Stops early, keeping what
+    was read so far, once `deadline` (a `time.time()` value) has passed.
+    Pages with images but (almost) no text layer, i.e. scans, are OCRed unless
+    `OCR_PDF_FALLBACK` is off.
+    """
+    ocr_fallback = getattr(settings, 'OCR_PDF_FALLBACK', True)
+    min_chars = getattr(settings, 'OCR_PDF_MIN_CHARS', 20)
+    with get_backend('pdfplumber').open(file_path) as pdf:
+        for page_number, page in enumerate(pdf.pages[start:stop], start=start):
+            if deadline is not None and time.time() > deadline:
+                logger.warning("PDF extraction timed out at page %d of %s", page_number, file_path)
+                metrics.count('pdf_timeouts')
+                return
+            text = page.extract_text()
+            if ocr_fallback and len((text or '').strip()) < min_chars and page.images:
+                text = ocr.ocr_pdf_page(page) or text
+            page.close()  # Drop the page's cached layout objects
+            metrics.count('pages', source='pdf')
+            if text:
+                yield text
+
+
+def _extract_page_range(file_path, start, stop, deadline):
+    return list(iter_pdf_pages(file_path, start, stop, deadline)), metrics.take()
+
+
+def iter_pdf_text(file_path):
+    """Yields the text of a PDF page by page.
+
+    With `PDF_WORKERS` above 1, big documents are fanned out to a process
+    pool of that size; by default they are read here, since this already
+    runs in the ingestion, import or re-tagging pool, one process per CPU.
+    Honours `PDF_MAX_PAGES` (pages past the cap are ignored) and
+    `PDF_EXTRACT_TIMEOUT` (extraction stops and keeps the pages read so far).
+    """
+    page_count = _pdf_page_count(file_path)
+    max_pages = getattr(settings, 'PDF_MAX_PAGES', None)
+    if max_pages:
+        page_count = min(page_count, max_pages)
+    timeout = getattr(settings, 'PDF_EXTRACT_TIMEOUT', None)
+    deadline = None if timeout is None else time.time() + timeout
+    workers = getattr(settings, 'PDF_WORKERS', 1) or 1
+
+    if workers <= 1 or page_count < getattr(settings, 'PDF_PARALLEL_MIN_PAGES', 50):
+        yield from iter_pdf_pages(file_path, 0, page_count, deadline)
+        return
+
+    pages_per_task = getattr(settings, 'PDF_PAGES_PER_TASK', 25)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_extract_page_range, file_path, start, min(start + pages_per_task, page_count), deadline)
+            for start in range(0, page_count, pages_per_task)
+        ]
+        # Ranges are yielded in page order as soon as each one is done
+        for future in futures:
+            try:
+                texts, recorded = future.result(timeout=None if deadline is None else max(0, deadline - time.time()))
+            except FutureTimeoutError:
+                logger.warning("PDF extraction timed out after %ss for %s", timeout, file_path)
+                metrics.count('pdf_timeouts')
+                for pending in futures:
+                    pending.cancel()
+                return
+            metrics.merge(recorded)
+            yield from texts
+
+
+def pdf_reader(file_path):
+    """Extracts text from a PDF file."""
+    return "".join(text + "\n" for text in iter_pdf_text(file_path))
+
+
+def doc_reader(file_path, extension=None):
+    """Extracts text from DOC and DOCX files."""
+    extension = extension or os.path.splitext(str(file_path))[1].lstrip('.').lower()
+    if extension == 'doc':
+        return get_backend('textract').process(file_path, extension='doc').decode('utf-8')
+    return get_backend('docx2txt').process(file_path)
+
+
+# Leading bytes -> content type, checked in order
+MAGIC_NUMBERS = [
+    (b'%PDF-', 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+    (b'BM', 'image/bmp'),
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'application/x-ole-storage'),
+    (b'PK\x03\x04', 'application/zip'),
+]
+
+# Member that identifies an Office Open XML package
+ZIP_MARKERS = [
+    ('word/document.xml', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+    ('xl/workbook.xml', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    ('ppt/presentation.xml', 'application/vnd.openxmlformats-officedocument.presentationml.presentation'),
+]
+
+# Legacy Office files share one container format; only the extension tells them apart
+OLE_TYPES_BY_EXTENSION = {
+    '.doc': 'application/msword',
+    '.xls': 'application/vnd.ms-excel',
+    '.ppt': 'application/vnd.ms-powerpoint',
+}
+
+TEXT_TYPES_BY_EXTENSION = {
+    '.md': 'text/markdown',
+    '.markdown': 'text/markdown',
+    '.csv': 'text/csv',
+    '.html': 'text/html',
+    '.htm': 'text/html',
+}
+
+
+def _looks_like_text(head):
+    if b'\x00' in head:
+        return False
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut off by the end of the sample is fine
+        return e.start >= len(head) - 3
+    return True
+
+
+def sniff_content_type(file_path, file_name=''):
+    """Determines a file's content type from its leading bytes, using the name only as a tie-breaker."""
+    with open(file_path, 'rb') as f:
+        head = f.read(8192)
+    extension = os.path.splitext(file_name or str(file_path))[1].lower()
+
+    content_type = next((ctype for magic, ctype in MAGIC_NUMBERS if head.startswith(magic)), None)
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        content_type = 'image/webp'
+    if content_type == 'application/zip':
+        with zipfile.ZipFile(file_path) as archive:
+            members = set(archive.namelist())
+        return next((ctype for marker, ctype in ZIP_MARKERS if marker in members), content_type)
+    if content_type == 'application/x-ole-storage':
+        return OLE_TYPES_BY_EXTENSION.get(extension, content_type)
+    if content_type is not None:
+        return content_type
+
+    if _looks_like_text(head):
+        if head.lstrip()[:15].lower().startswith((b'<!doctype html', b'<html')):
+            return 'text/html'
+        return TEXT_TYPES_BY_EXTENSION.get(extension, 'text/plain')
+    return 'application/octet-stream'
+
+
+class Extractor:
+    """A text extractor for one or more content types.
+
+    `func(file_path, content_type)` yields the file's text in chunks. `cost` is a
+    rough relative cost per megabyte of input; when several extractors handle a
+    type they are tried cheapest first, falling back to the next one if an
+    extractor fails or finds no text.
+    """
+
+    def __init__(self, name, content_types, cost, func):
+        self.name = name
+        self.content_types = tuple(content_types)
+        self.cost = cost
+        self.func = func
+
+    def __repr__(self):
+        return f"<Extractor {self.name} cost={self.cost}>"
+
+
+_extractors = []
+
+
+def register_extractor(name, content_types, cost):
+    """Decorator adding a chunk-yielding function to the extractor registry."""
+    def decorator(func):
+        _extractors.append(Extractor(name, content_types, cost, func))
+        _extractors.sort(key=lambda extractor: extractor.cost)
+        return func
+    return decorator
+
+
+def extractors_for(content_type):
+    """Extractors that handle a content type, cheapest first.
+
+    Extractors registered for the exact type come before catch-alls registered
+    for its family (e.g. 'text/*').
+    """
+    family = content_type.split('/')[0] + '/*'
+    exact = [extractor for extractor in _extractors if content_type in extractor.content_types]
+    generic = [extractor for extractor in _extractors if family in extractor.content_types and extractor not in exact]
+    return exact + generic
+
+
+class ExtractionReport:
+    """What extracting one file cost: content type, extractor used, extractors that failed before it, time and volume."""
+
+    def __init__(self):
+        self.content_type = ''
+        self.extractor = ''
+        self.failed_extractors = []
+        self.seconds = 0.0
+        self.bytes_processed = 0
+        self.characters = 0
+
+    def as_dict(self):
+        return {
+            'content_type': self.content_type,
+            'extractor': self.extractor,
+            'failed_extractors': self.failed_extractors,
+            'seconds': self.seconds,
+            'bytes_processed': self.bytes_processed,
+            'characters': self.characters,
+        }
+
+    def __str__(self):
+        return format_report(self.as_dict())
+
+
+def format_report(report):
+    """One-line summary of an extraction report, given as a dict (`ExtractionReport.as_dict`)."""
+    failed = f" (after {', '.join(report['failed_extractors'])} failed)" if report['failed_extractors'] else ""
+    return (
+        f"{report['content_type']} via {report['extractor'] or 'no extractor'}{failed}: "
+        f"{report['bytes_processed']} bytes -> {report['characters']} characters in {report['seconds']:.2f}s"
+    )
+
+
+TEXT_BLOCK_SIZE = 1024 * 1024  # Characters per chunk yielded by the native text extractors
+
+
+def _blocks(pieces, size=TEXT_BLOCK_SIZE):
+    """Groups small text pieces into chunks of roughly `size` characters."""
+    block, length = [], 0
+    for piece in pieces:
+        block.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield "\n".join(block)
+            block, length = [], 0
+    if block:
+        yield "\n".join(block)
+
+
+@register_extractor('text', ['text/plain', 'text/markdown', 'text/*'], cost=1)
+def _extract_plain_text(file_path, content_type):
+    with open(file_path, encoding='utf-8', errors='replace') as f:
+        yield from _blocks(line.rstrip('\n') for line in f)
+
+
+@register_extractor('csv', ['text/csv'], cost=2)
+def _extract_csv(file_path, content_type):
+    with open(file_path, encoding='utf-8', errors='replace', newline='') as f:
+        yield from _blocks(" ".join(row) for row in csv.reader(f))
+
+
+class _HTMLTextParser(HTMLParser):
+    SKIPPED_TAGS = {'script', 'style', 'noscript', 'template'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.pieces = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self._skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS and self._skipping:
+            self._skipping -= 1
+
+    def handle_data(self, data):
+        if not self._skipping and not data.isspace():
+            self.pieces.append(data)
+
+
+@register_extractor('html', ['text/html'], cost=2)
+def _extract_html(file_path, content_type):
+    parser = _HTMLTextParser()
+    with open(file_path, encoding='utf-8', errors='replace') as f:
+        while True:
+            data = f.read(TEXT_BLOCK_SIZE)
+            if not data:
+                break
+            parser.feed(data)
+            if parser.pieces:
+                yield " ".join(parser.pieces)
+                parser.pieces = []
+    parser.close()
+    if parser.pieces:
+        yield " ".join(parser.pieces)
+
+
+def _xml_text(archive, member, text_tag):
+    """Text of every `text_tag` element of an XML member of a zip archive, streamed."""
+    with archive.open(member) as f:
+        for _, element in ElementTree.iterparse(f):
+            if element.tag == text_tag and element.text:
+                yield element.text
+            element.clear()
+
+
+SPREADSHEETML = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+DRAWINGML = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+
+
+@register_extractor('xlsx', ['application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'], cost=3)
+def _extract_xlsx(file_path, content_type):
+    with zipfile.ZipFile(file_path) as archive:
+        members = archive.namelist()
+        # Cell text lives in the shared string table, or inline in the sheets
+        if 'xl/sharedStrings.xml' in members:
+            yield from _blocks(_xml_text(archive, 'xl/sharedStrings.xml', SPREADSHEETML + 't'))
+        for member in sorted(m for m in members if m.startswith('xl/worksheets/') and m.endswith('.xml')):
+            yield from _blocks(_xml_text(archive, member, SPREADSHEETML + 't'))
+
+
+def _slide_number(member):
+    digits = ''.join(ch for ch in os.path.basename(member) if ch.isdigit())
+    return int(digits or 0)
+
+
+@register_extractor('pptx', ['application/vnd.openxmlformats-officedocument.presentationml.presentation'], cost=3)
+def _extract_pptx(file_path, content_type):
+    with zipfile.ZipFile(file_path) as archive:
+        slides = [m for m in archive.namelist() if m.startswith('ppt/slides/slide') and m.endswith('.xml')]
+        for member in sorted(slides, key=_slide_number):
+            text = " ".join(_xml_text(archive, member, DRAWINGML + 't'))
+            if text:
+                yield text
+
+
+@register_extractor('docx2txt', ['application/vnd.openxmlformats-officedocument.wordprocessingml.document'], cost=3)
+def _extract_docx(file_path, content_type):
+    yield doc_reader(file_path, 'docx')
+
+
+@register_extractor('pdfplumber', ['application/pdf'], cost=10)
+def _extract_pdf(file_path, content_type):
+    yield from iter_pdf_text(file_path)
+
+
+@register_extractor('textract', [
+    'application/msword',
+    'application/vnd.ms-excel',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+], cost=20)
+def _extract_with_textract(file_path, content_type):
+    extension = {
+        'application/msword': 'doc',
+        'application/vnd.ms-excel': 'xls',
+    }.get(content_type, 'docx')
+    yield get_backend('textract').process(file_path, extension=extension).decode('utf-8')
+
+
+@register_extractor('tesseract', ['image/*'], cost=100)
+def _extract_image(file_path, content_type):
+    yield from ocr.iter_image_text(file_path)
+
+
+def _timed(chunks, report):
+    """Passes chunks through, adding the time spent producing them to the report."""
+    iterator = iter(chunks)
+    while True:
+        start = time.perf_counter()
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            report.seconds += time.perf_counter() - start
+            return
+        report.seconds += time.perf_counter() - start
+        report.characters += len(chunk)
+        yield chunk
+
+
+def _run_chain(file_path, content_type, report):
+    last_error = None
+    for extractor in extractors_for(content_type):
+        produced = False
+        try:
+            for chunk in extractor.func(file_path, content_type):
+                if chunk:
+                    if not produced:
+                        report.extractor = extractor.name
+                    produced = True
+                    yield chunk
+        except Exception as e:
+            if produced:
+                raise  # Part of the text was already handed on; retry the whole job
+            logger.warning("%s failed on %s; trying the next extractor", extractor.name, file_path, exc_info=True)
+            metrics.count('extractor_failures', extractor=extractor.name, content_type=content_type)
+            report.failed_extractors.append(extractor.name)
+            last_error = e
+            continue
+        if produced:
+            return
+    if last_error is not None:
+        raise last_error
+
+
+def iter_text(file_path, file_name='', report=None):
+    """Yields the text of a stored file in chunks.
+
+    The content type is sniffed from the file's bytes and the matching
+    extractors are tried cheapest first. Fills in `report` if one is given.
+    """
+    report = report if report is not None else ExtractionReport()
+    report.content_type = sniff_content_type(file_path, file_name)
+    report.bytes_processed = os.path.getsize(file_path)
+    yield from _timed(_run_chain(file_path, report.content_type, report), report)
+
+
+def extract_text(file_path, file_name=''):
+    """Extracts the full text of a stored file."""
+    return "\n".join(iter_text(file_path, file_name))
+
+
+def extract_and_tag(file_path, file_name):
+    """Ingestion job stages: extract the text of a stored file, then tag it.
+
+    Runs inside the worker's process pool. Extractor errors are raised so the
+    job can be retried; the tags with their positions, the extraction report
+    and the compressed text (for `ExtractedText`) are returned to the parent
+    process, which writes them. The report's `metrics` are the stage timings
+    recorded here, for the parent to `metrics.merge()`; its `preview` is the
+    start of the text and the first-page thumbnail, for `previews.store_preview`.
+    """
+    report = ExtractionReport()
+    recorder = TextRecorder(iter_text(file_path, file_name, report), getattr(settings, 'PREVIEW_TEXT_LENGTH', 1000))
+    start = time.perf_counter()
+    tag_positions = generate_tag_positions(recorder)
+    # Extraction runs lazily inside tagging; the report timed its part
+    metrics.observe('extract', report.seconds, content_type=report.content_type, extractor=report.extractor, size=report.bytes_processed)
+    metrics.observe('nlp', time.perf_counter() - start - report.seconds, characters=report.characters)
+    metrics.count('bytes', report.bytes_processed, stage='extract')
+    metrics.count('characters', report.characters)
+    preview = {'text': recorder.lead, 'thumbnail': render_thumbnail(file_path, report.content_type)}
+    return tag_positions, dict(report.as_dict(), preview=preview, metrics=metrics.take()), recorder.data
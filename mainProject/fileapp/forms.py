@@ -1,7 +1,18 @@
 from django import forms
 
+from . import query as query_language
+
 class UploadFileForm(forms.Form):
     file = forms.FileField()
 
 class SearchForm(forms.Form):
-    query = forms.CharField(max_length=255)
\ No newline at end of file
+    query = forms.CharField(max_length=255)
+
+    def clean_query(self):
+        query = self.cleaned_data['query']
+        if query_language.is_advanced(query):
+            try:
+                query_language.parse(query)
+            except query_language.QuerySyntaxError as e:
+                raise forms.ValidationError(str(e))
+        return query
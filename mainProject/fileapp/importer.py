@@ -0,0 +1,238 @@
+"""Bulk import of existing directory trees, used by the `import_directory` command.
+
+Files go through two process-pool stages: every file is hashed, and only
+content that is neither stored yet nor already seen in this run is copied into
+blob storage and extracted and tagged with the same code as uploads
+(`extraction.extract_and_tag`). Results are written in batches, each batch
+(blobs, files and the tags of all its files) in one transaction, and the paths
+of every committed batch are appended to a checkpoint file so an interrupted
+import picks up where it stopped.
+"""
+import logging
+import os
+from collections import Counter
+from hashlib import sha256
+
+from django.core.files import File as DjangoFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+
+from . import metrics, search_cache
+from .extraction import EXTRACTOR_VERSION, extract_and_tag
+from .ingest import enqueue_ingest
+from .models import Blob, ExtractedText, File
+from .nlp import tagger_version
+from .previews import store_preview
+from .tags import copy_tags, save_tags_for_files, token_count
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024
+
+
+def walk_files(root, extensions=None, follow_symlinks=False, skipped=None):
+    """Yields the regular files under `root` in a stable (sorted) order.
+
+    Directories that can't be listed are logged and left out, and appended
+    to the list `skipped` if one is given.
+    """
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        try:
+            entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+        except OSError as e:
+            logger.warning("Skipping directory %s: %s", directory, e)
+            if skipped is not None:
+                skipped.append(directory)
+            continue
+        subdirectories = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=follow_symlinks):
+                subdirectories.append(entry.path)
+            elif entry.is_file(follow_symlinks=follow_symlinks):
+                if extensions and os.path.splitext(entry.name)[1].lower() not in extensions:
+                    continue
+                yield entry.path
+        directories.extend(reversed(subdirectories))
+
+
+def hash_path(path):
+    """Pool task: `(sha256, size, metrics)` of a file on disk, `metrics` being for `metrics.merge()`."""
+    hasher = sha256()
+    size = 0
+    with metrics.span('hash', path=path), open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+            size += len(data)
+    metrics.count('bytes', size, stage='hash')
+    return hasher.hexdigest(), size, metrics.take()
+
+
+def store_and_extract(path, file_name, content_hash):
+    """Pool task: copies a file into blob storage under its hash, then extracts and tags the stored copy.
+
+    Returns `(stored_name, tag_positions, report, text, error)`, `text` being the
+    compressed extracted text (and the report carrying this process's
+    `metrics`, as from `extract_and_tag`); extraction errors are returned rather than
+    raised so the file is still imported (and queued for the ingestion worker
+    to retry).
+    """
+    field = Blob._meta.get_field('file_content')
+    with metrics.span('store', file_name=file_name), open(path, 'rb') as f:
+        stored_name = field.storage.save(
+            field.generate_filename(Blob(content_hash=content_hash), file_name), DjangoFile(f, name=file_name)
+        )
+    try:
+        tag_positions, report, text = extract_and_tag(field.storage.path(stored_name), file_name)
+    except Exception as e:
+        return stored_name, None, None, None, str(e) or e.__class__.__name__
+    return stored_name, tag_positions, report, text, ''
+
+
+class ImportEntry:
+    """One file of the import as it moves through the stages."""
+
+    def __init__(self, path, file_name):
+        self.path = path
+        self.file_name = file_name
+        self.content_hash = ''
+        self.size = 0
+        self.stored_name = None  # Set for the first copy of new content
+        self.tag_positions = None
+        self.report = None
+        self.text = None  # Compressed extracted text
+        self.error = ''
+        self.source_file_id = None  # Indexed file with the same content, whose tags are copied
+        self.source_token_count = 0
+        self.source_versions = (0, 0)  # Extractor and tagger versions of the source file's tags
+
+
+def known_blobs(content_hashes):
+    """For each already stored hash: `(file_id, token_count, versions)` of an indexed file to copy tags from, or None.
+
+    Unreferenced blobs don't count: `gc_blobs` may delete them before the
+    import references them, so their content is stored again.
+    """
+    blobs = dict(Blob.objects.filter(content_hash__in=content_hashes, ref_count__gt=0).values_list('id', 'content_hash'))
+    sources = {}
+    for blob_id, file_id, token_count, extractor_version, tagger_version in (
+        File.objects
+        .filter(blob_id__in=blobs, ingest_status=File.IngestStatus.DONE)
+        .order_by('-id')
+        .values_list('blob_id', 'id', 'token_count', 'extractor_version', 'tagger_version')
+    ):
+        sources[blob_id] = (file_id, token_count, (extractor_version, tagger_version))
+    return {content_hash: sources.get(blob_id) for blob_id, content_hash in blobs.items()}
+
+
+def write_batch(entries):
+    """Creates the blobs, files and tags of a batch of imported files in one transaction."""
+    with transaction.atomic(), metrics.span('db_write', files=len(entries)):
+        new = [entry for entry in entries if entry.stored_name]
+        Blob.objects.bulk_create(
+            [
+                Blob(
+                    content_hash=entry.content_hash,
+                    file_content=entry.stored_name,
+                    size=entry.size,
+                    content_type=(entry.report or {}).get('content_type', ''),
+                )
+                for entry in new
+            ],
+            ignore_conflicts=True,  # An upload stored the same content meanwhile; keep theirs
+        )
+        # Locked, so gc_blobs can't delete an unreferenced one before the counts below are raised
+        blobs = {
+            blob.content_hash: blob
+            for blob in Blob.objects.select_for_update().filter(content_hash__in={entry.content_hash for entry in entries})
+        }
+        texts = []
+        for entry in new:
+            blob = blobs[entry.content_hash]
+            if blob.file_content.name != entry.stored_name:
+                stored_name = entry.stored_name
+                transaction.on_commit(lambda name=stored_name: default_storage.delete(name))
+            elif entry.text is not None:
+                texts.append(ExtractedText(
+                    blob=blob,
+                    data=entry.text,
+                    characters=entry.report.get('characters', 0),
+                    extractor_version=EXTRACTOR_VERSION,
+                ))
+                preview = entry.report['preview']
+                store_preview(blob, preview['text'], preview['thumbnail'])
+        ExtractedText.objects.bulk_create(texts, ignore_conflicts=True)
+
+        tagged, copies, failed = [], [], []
+        references = Counter()
+        current_versions = (EXTRACTOR_VERSION, tagger_version())
+        for entry in entries:
+            blob = blobs[entry.content_hash]
+            references[blob.id] += 1
+            if entry.tag_positions is not None:
+                status, tokens, versions = File.IngestStatus.DONE, token_count(entry.tag_positions), current_versions
+            elif entry.source_file_id is not None:
+                status, tokens, versions = File.IngestStatus.DONE, entry.source_token_count, entry.source_versions
+            else:
+                status, tokens, versions = File.IngestStatus.PENDING, 0, (0, 0)
+            file_instance = File.objects.create(
+                file_name=entry.file_name,
+                blob=blob,
+                ingest_status=status,
+                token_count=tokens,
+                extractor_version=versions[0],
+                tagger_version=versions[1],
+            )
+            if entry.tag_positions is not None:
+                tagged.append((file_instance, entry.tag_positions))
+            elif entry.source_file_id is not None:
+                copies.append((entry.source_file_id, file_instance))
+            else:
+                failed.append(file_instance)
+
+        save_tags_for_files(tagged)
+        for source_file_id, file_instance in copies:
+            copy_tags(source_file_id, file_instance)
+        for file_instance in failed:
+            enqueue_ingest(file_instance)  # The ingestion worker retries extraction
+
+        blob_ids_by_count = {}
+        for blob_id, count in references.items():
+            blob_ids_by_count.setdefault(count, []).append(blob_id)
+        for count, blob_ids in blob_ids_by_count.items():
+            Blob.objects.filter(id__in=blob_ids).update(ref_count=F('ref_count') + count)
+        search_cache.invalidate()
+    metrics.count('tags', sum(len(tag_positions) for _, tag_positions in tagged))
+
+
+class Checkpoint:
+    """Append-only log of the paths whose import has been committed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8', errors='surrogateescape') as f:
+                self.done = {line.rstrip('\n') for line in f if line.endswith('\n')}  # A torn last line is redone
+        return self.done
+
+    def mark(self, paths):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8', errors='surrogateescape') as f:
+            for path in paths:
+                f.write(path + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.update(paths)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.done = set()
@@ -0,0 +1,211 @@
+"""Database-backed ingestion queue.
+
+Uploads only persist the file and enqueue an `IngestJob`; the `ingest_worker`
+management command claims jobs, runs `extraction.extract_and_tag` in a process
+pool and stores the resulting tags through the helpers below.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import metrics, search_cache
+from .extraction import EXTRACTOR_VERSION
+from .models import Blob, ExtractedText, File, IngestJob
+from .nlp import tagger_version
+from .previews import store_preview
+from .tags import copy_tags, delete_tags, save_tags, token_count
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def enqueue_ingest(file_instance):
+    """Marks the file as pending and queues an ingestion job for it."""
+    with transaction.atomic():
+        File.objects.filter(id=file_instance.id).update(ingest_status=File.IngestStatus.PENDING, ingest_error='')
+        file_instance.ingest_status = File.IngestStatus.PENDING
+        return IngestJob.objects.create(
+            file=file_instance,
+            max_attempts=_setting('INGEST_MAX_ATTEMPTS', 3),
+        )
+
+
+def heartbeat(worker_id):
+    """Refreshes `locked_at` of the jobs a worker is running, so `requeue_stale_jobs` leaves them alone."""
+    return (
+        IngestJob.objects
+        .filter(status=IngestJob.Status.RUNNING, locked_by=worker_id)
+        .update(locked_at=timezone.now())
+    )
+
+
+def requeue_stale_jobs():
+    """Returns jobs whose worker stopped sending heartbeats (see `heartbeat`) to the queue.
+
+    The lost run counts as an attempt (claiming counted it), so `fail_job`
+    schedules a retry with backoff, or marks the file failed once
+    `max_attempts` runs have died: a file that crashes its worker doesn't
+    come back forever.
+    """
+    timeout = _setting('INGEST_JOB_TIMEOUT', 5 * 60)
+    cutoff = timezone.now() - timedelta(seconds=timeout)
+    stale = IngestJob.objects.filter(status=IngestJob.Status.RUNNING, locked_at__lt=cutoff)
+    requeued = 0
+    for job in stale:
+        with transaction.atomic():
+            # Its worker may have sent a heartbeat or finished it since the read
+            if not stale.select_for_update().filter(id=job.id).exists():
+                continue
+            fail_job(job, f"Worker {job.locked_by} sent no heartbeat for {timeout}s.")
+        requeued += 1
+    return requeued
+
+
+def claim_jobs(worker_id, limit):
+    """Claims up to `limit` due jobs for this worker.
+
+    Each job is taken with a conditional UPDATE, so several workers can poll
+    the same table without double-processing a job.
+    """
+    now = timezone.now()
+    candidate_ids = list(
+        IngestJob.objects
+        .filter(status=IngestJob.Status.QUEUED, run_after__lte=now)
+        .order_by('run_after', 'id')
+        .values_list('id', flat=True)[:limit]
+    )
+    claimed = []
+    for job_id in candidate_ids:
+        updated = (
+            IngestJob.objects
+            .filter(id=job_id, status=IngestJob.Status.QUEUED)
+            .update(status=IngestJob.Status.RUNNING, locked_by=worker_id, locked_at=now, attempts=F('attempts') + 1)
+        )
+        if updated:
+            claimed.append(job_id)
+    if not claimed:
+        return []
+    jobs = list(IngestJob.objects.filter(id__in=claimed).select_related('file__blob'))
+    File.objects.filter(id__in=[job.file_id for job in jobs]).update(ingest_status=File.IngestStatus.PROCESSING)
+    return jobs
+
+
+def file_deleted(job):
+    """Whether a claimed job's file has been deleted since (its job row went with it)."""
+    return not File.objects.filter(id=job.file_id).exists()
+
+
+def release_jobs(worker_id):
+    """Puts the jobs a stopping worker still holds back on the queue."""
+    jobs = IngestJob.objects.filter(status=IngestJob.Status.RUNNING, locked_by=worker_id)
+    File.objects.filter(id__in=jobs.values('file_id')).update(ingest_status=File.IngestStatus.PENDING)
+    jobs.update(status=IngestJob.Status.QUEUED, locked_by='', locked_at=None, run_after=timezone.now())
+
+
+def _mark_done(job, token_count, extractor_version, tagger_version):
+    search_cache.invalidate()  # The file's tags are now searchable
+    IngestJob.objects.filter(id=job.id).update(status=IngestJob.Status.DONE, last_error='', locked_by='', locked_at=None)
+    File.objects.filter(id=job.file_id).update(
+        ingest_status=File.IngestStatus.DONE,
+        ingest_error='',
+        token_count=token_count,
+        extractor_version=extractor_version,
+        tagger_version=tagger_version,
+    )
+
+
+def store_extracted_text(blob_id, data, characters):
+    """Keeps the compressed text extracted from a blob, replacing any earlier extraction."""
+    ExtractedText.objects.update_or_create(
+        blob_id=blob_id,
+        defaults={'data': data, 'characters': characters, 'extractor_version': EXTRACTOR_VERSION},
+    )
+
+
+def complete_job(job, tag_positions, report=None, text=None):
+    """Stores the tags produced by a job and marks the file searchable.
+
+    `report` is the extraction report (see `extraction.ExtractionReport`); the
+    sniffed content type is kept on the file's blob, and its preview stored.
+    `text` is the compressed extracted text, kept so the file can later be
+    re-tagged without extracting it again.
+    """
+    with transaction.atomic(), metrics.span('db_write', file_id=job.file_id, tags=len(tag_positions)):
+        # A retried job may have written part of its tags before failing.
+        delete_tags([job.file_id])
+        save_tags(job.file, tag_positions)
+        if report and report.get('content_type'):
+            Blob.objects.filter(id=job.file.blob_id).update(content_type=report['content_type'])
+        if text is not None:
+            store_extracted_text(job.file.blob_id, text, report.get('characters', 0) if report else 0)
+        if report and report.get('preview') is not None:
+            store_preview(job.file.blob, report['preview']['text'], report['preview']['thumbnail'])
+        _mark_done(job, token_count(tag_positions), EXTRACTOR_VERSION, tagger_version())
+    metrics.count('tags', len(tag_positions))
+    metrics.count('ingest_jobs', outcome='done')
+
+
+def reuse_duplicate_tags(job):
+    """Completes a job without extraction when another file with the same blob is already indexed.
+
+    Returns True if the tags were copied, False if the file needs extracting.
+    """
+    source = (
+        File.objects
+        .filter(blob_id=job.file.blob_id, ingest_status=File.IngestStatus.DONE)
+        .exclude(id=job.file_id)
+        .first()
+    )
+    if source is None:
+        return False
+    with transaction.atomic(), metrics.span('db_write', file_id=job.file_id, copied_from=source.id):
+        delete_tags([job.file_id])
+        copy_tags(source.id, job.file)
+        _mark_done(job, source.token_count, source.extractor_version, source.tagger_version)
+    metrics.count('ingest_jobs', outcome='duplicate')
+    return True
+
+
+def fail_job(job, error):
+    """Records a failed attempt and schedules a retry with exponential backoff."""
+    error = str(error) or error.__class__.__name__
+    with transaction.atomic():
+        if job.attempts < job.max_attempts:
+            delay = _setting('INGEST_RETRY_BACKOFF', 30) * 2 ** (job.attempts - 1)
+            IngestJob.objects.filter(id=job.id).update(
+                status=IngestJob.Status.QUEUED,
+                last_error=error,
+                locked_by='',
+                locked_at=None,
+                run_after=timezone.now() + timedelta(seconds=delay),
+            )
+            File.objects.filter(id=job.file_id).update(ingest_status=File.IngestStatus.PENDING, ingest_error=error)
+        else:
+            IngestJob.objects.filter(id=job.id).update(status=IngestJob.Status.FAILED, last_error=error, locked_by='', locked_at=None)
+            File.objects.filter(id=job.file_id).update(ingest_status=File.IngestStatus.FAILED, ingest_error=error)
+    metrics.count('ingest_jobs', outcome='retried' if job.attempts < job.max_attempts else 'failed')
+
+
+def ingest_state(file_instance):
+    """Serializable ingestion state of a file, as returned by the status endpoint."""
+    return _state(file_instance, file_instance.ingest_jobs.order_by('-id').first())
+
+
+async def aingest_state(file_instance):
+    """`ingest_state` through the async ORM."""
+    return _state(file_instance, await file_instance.ingest_jobs.order_by('-id').afirst())
+
+
+def _state(file_instance, job):
+    return {
+        'id': file_instance.id,
+        'file_name': file_instance.file_name,
+        'status': file_instance.ingest_status,
+        'attempts': job.attempts if job else 0,
+        'max_attempts': job.max_attempts if job else 0,
+        'error': file_instance.ingest_error,
+    }
@@ -0,0 +1,20 @@
+from importlib import import_module
+
+from django.core.management.base import BaseCommand
+
+from fileapp.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = "Runs one of the file pipeline benchmarks."
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='benchmark', required=True)
+        for name, module_path in BENCHMARKS.items():
+            module = import_module(module_path)
+            subparser = subparsers.add_parser(name, help=module.__doc__.strip().splitlines()[0])
+            module.add_arguments(subparser)
+
+    def handle(self, *args, **options):
+        module = import_module(BENCHMARKS[options.pop('benchmark')])
+        module.run(self.stdout, **options)
@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from fileapp.models import Blob, File, Preview
+from fileapp.previews import PREVIEW_VERSION, build_preview, evict
+
+
+class Command(BaseCommand):
+    help = "Makes the search result previews of indexed files that have none (e.g. ingested before previews existed)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Also remake previews of an older PREVIEW_VERSION.')
+        parser.add_argument('--batch-size', type=int, default=200, help='Blobs read per query.')
+
+    def handle(self, *args, **options):
+        missing = ~Exists(Preview.objects.filter(blob_id=OuterRef('pk')))
+        if options['rebuild']:
+            missing = missing | Exists(Preview.objects.filter(blob_id=OuterRef('pk')).exclude(version=PREVIEW_VERSION))
+        pending = (
+            Blob.objects
+            .filter(ref_count__gt=0)
+            .filter(Exists(File.objects.filter(blob_id=OuterRef('pk'), ingest_status=File.IngestStatus.DONE)))
+            .filter(missing)
+            .order_by('id')
+        )
+        built = failed = 0
+        last_id = 0
+        start = time.monotonic()
+        while True:
+            blobs = list(pending.filter(id__gt=last_id)[:options['batch_size']])
+            if not blobs:
+                break
+            last_id = blobs[-1].id
+            for blob in blobs:
+                try:
+                    with transaction.atomic():
+                        build_preview(blob)
+                    built += 1
+                except OSError as e:
+                    failed += 1
+                    self.stderr.write(f"Blob {blob.id}: {e}")
+            self.stdout.write(f"{built} previews built ({built / max(time.monotonic() - start, 1e-9):.1f}/s)")
+        if not built and not failed:
+            self.stdout.write("Every indexed file has an up-to-date preview.")
+        if failed:
+            self.stdout.write(f"{failed} blobs could not be read.")
+        evicted, size = evict()
+        if evicted:
+            self.stdout.write(f"Evicted {evicted} thumbnails ({size / (1024 * 1024):.1f} MB) to stay within PREVIEW_CACHE_MAX_BYTES.")
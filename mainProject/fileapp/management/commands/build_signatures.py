@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
+
+from fileapp.models import Blob, File, TagSignature
+from fileapp.similarity import SIGNATURE_VERSION, build_signatures
+
+
+class Command(BaseCommand):
+    help = "Computes the tag signatures used by the similar-files lookup for indexed files that have none."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Also remake signatures of an older SIGNATURE_VERSION.')
+        parser.add_argument('--batch-size', type=int, default=500, help='Blobs signed per transaction.')
+
+    def handle(self, *args, **options):
+        missing = ~Exists(TagSignature.objects.filter(blob_id=OuterRef('pk')))
+        if options['rebuild']:
+            missing = missing | Exists(TagSignature.objects.filter(blob_id=OuterRef('pk')).exclude(version=SIGNATURE_VERSION))
+        pending = (
+            Blob.objects
+            .filter(ref_count__gt=0)
+            .filter(Exists(File.objects.filter(blob_id=OuterRef('pk'), ingest_status=File.IngestStatus.DONE)))
+            .filter(missing)
+            .order_by('id')
+        )
+        built = untagged = 0
+        last_id = 0
+        start = time.monotonic()
+        while True:
+            blob_ids = list(pending.filter(id__gt=last_id).values_list('id', flat=True)[:options['batch_size']])
+            if not blob_ids:
+                break
+            last_id = blob_ids[-1]
+            stored = build_signatures(blob_ids)
+            built += stored
+            untagged += len(blob_ids) - stored
+            self.stdout.write(f"{built} signatures built ({built / max(time.monotonic() - start, 1e-9):.1f}/s)")
+        if not built and not untagged:
+            self.stdout.write("Every indexed file has an up-to-date signature.")
+        if untagged:
+            self.stdout.write(f"{untagged} blobs have no tags to sign.")
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from fileapp.storage import collect_garbage, sweep_orphans, unsharded_blobs
+
+
+class Command(BaseCommand):
+    help = "Deletes stored content no file has referenced for BLOB_GC_GRACE seconds, and files no blob or preview points to."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace', type=int,
+            help='Seconds content stays after its last file is deleted, and the minimum age of an unreferenced '
+                 'file before it is removed (default: BLOB_GC_GRACE). Keep it above the length of any import.',
+        )
+        parser.add_argument('--batch-size', type=int, default=500, help='Blobs deleted per transaction.')
+        parser.add_argument('--no-orphans', action='store_true', help="Don't look for files without a blob or preview.")
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted.')
+
+    def handle(self, *args, **options):
+        grace = options['grace'] if options['grace'] is not None else getattr(settings, 'BLOB_GC_GRACE', 24 * 60 * 60)
+        dry_run = options['dry_run']
+        verb = "Would delete" if dry_run else "Deleted"
+        blobs, size = collect_garbage(grace, options['batch_size'], dry_run)
+        self.stdout.write(f"{verb} {blobs} unreferenced blobs ({size / (1024 * 1024):.1f} MB).")
+        if not options['no_orphans']:
+            files, size = sweep_orphans(grace, dry_run=dry_run)
+            self.stdout.write(f"{verb} {files} files without a blob or preview ({size / (1024 * 1024):.1f} MB).")
+            unsharded = unsharded_blobs()
+            if unsharded:
+                self.stdout.write(f"uploaded_files/ was not swept: {unsharded} blobs are still stored there. Run shard_blobs first.")
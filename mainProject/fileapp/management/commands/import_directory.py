@@ -0,0 +1,202 @@
+import hashlib
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from fileapp import metrics
+from fileapp.backends import preload
+from fileapp.extraction import init_worker
+from fileapp.importer import Checkpoint, ImportEntry, hash_path, known_blobs, store_and_extract, walk_files, write_batch
+from fileapp.views import rename_file_if_too_long
+
+LOOKUP_BATCH = 200  # Hashed files checked against stored blobs per query
+
+
+class Command(BaseCommand):
+    help = "Imports every file under a directory: dedupes by content, extracts and tags in parallel, and resumes after interruptions."
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Directory tree to import.')
+        parser.add_argument('--workers', type=int, help='Hashing/extraction processes (default: one per CPU).')
+        parser.add_argument('--batch-size', type=int, help='Files written per transaction (default: IMPORT_BATCH_SIZE).')
+        parser.add_argument('--checkpoint', help='Checkpoint file (default: under MEDIA_ROOT/imports/, one per directory).')
+        parser.add_argument('--restart', action='store_true', help='Ignore an existing checkpoint and import everything again.')
+        parser.add_argument('--extensions', nargs='+', help='Only import files with these extensions (e.g. .pdf .docx).')
+        parser.add_argument('--follow-symlinks', action='store_true')
+        parser.add_argument('--no-preload', action='store_true', help='Let each process import backends on first use.')
+        parser.add_argument('--progress-interval', type=float, default=5, help='Seconds between progress lines.')
+
+    def handle(self, *args, **options):
+        root = os.path.abspath(options['directory'])
+        if not os.path.isdir(root):
+            raise CommandError(f"{root} is not a directory.")
+        workers = options['workers'] or os.cpu_count() or 1
+        self.batch_size = options['batch_size'] or getattr(settings, 'IMPORT_BATCH_SIZE', 500)
+        self.progress_interval = options['progress_interval']
+        extensions = {ext.lower() if ext.startswith('.') else '.' + ext.lower() for ext in options['extensions'] or []}
+
+        checkpoint_path = options['checkpoint'] or os.path.join(
+            settings.MEDIA_ROOT, 'imports', hashlib.sha1(root.encode('utf-8', 'surrogateescape')).hexdigest()[:16] + '.log'
+        )
+        self.checkpoint = Checkpoint(checkpoint_path)
+        if options['restart']:
+            self.checkpoint.clear()
+        done = self.checkpoint.load()
+        if done:
+            self.stdout.write(f"Resuming: {len(done)} files already imported according to {checkpoint_path}.")
+        self.skipped = []  # Directories that couldn't be listed
+        paths = (path for path in walk_files(root, extensions, options['follow_symlinks'], self.skipped) if path not in done)
+
+        metrics.publish()  # Children hand their timings back with each result
+        if not options['no_preload']:
+            preload()  # Forked children share the loaded backends and model
+        connections.close_all()  # Children never use the database
+
+        self.hashing = {}  # Future -> entry being hashed
+        self.extracting = {}  # Future -> entry being stored and extracted
+        self.first_by_hash = {}  # Hash -> first entry with new content, until its batch is written
+        self.waiting = {}  # Hash -> duplicates waiting for the first entry's extraction
+        self.hashed = []  # Hashed entries not yet checked against stored content
+        self.ready = []  # Entries ready to be written
+        self.stats = {'files': 0, 'bytes': 0, 'duplicates': 0, 'failed': 0, 'queued': 0}
+        self.start = self.last_progress = time.monotonic()
+
+        # Ctrl-C reaches the whole process group; only this process reacts to it
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(True,))
+        self.stdout.write(f"Importing {root} with {workers} processes (checkpoint: {checkpoint_path}).")
+        try:
+            self._run(pool, paths, workers * 4)
+        except KeyboardInterrupt:
+            self.stdout.write("Interrupted; finishing the files in progress. Run the command again to resume.")
+            self._drain()
+        pool.shutdown(cancel_futures=True)
+        self._progress(final=True)
+
+    def _run(self, pool, paths, max_in_flight):
+        exhausted = False
+        while True:
+            while not exhausted and len(self.hashing) + len(self.extracting) < max_in_flight:
+                path = next(paths, None)
+                if path is None:
+                    exhausted = True
+                    break
+                entry = ImportEntry(path, rename_file_if_too_long(os.path.basename(path)))
+                self.hashing[pool.submit(hash_path, path)] = entry
+
+            if self.hashed and (len(self.hashed) >= LOOKUP_BATCH or not self.hashing):
+                self._dedupe(pool)
+            if len(self.ready) >= self.batch_size or (self.ready and not self.hashing and not self.extracting):
+                self._flush()
+            if not self.hashing and not self.extracting:
+                if exhausted and not self.hashed:
+                    break
+                continue
+
+            done, _ = wait([*self.hashing, *self.extracting], timeout=self.progress_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in self.hashing:
+                    self._hashed(self.hashing.pop(future), future)
+                else:
+                    self._extracted(self.extracting.pop(future), future)
+            if time.monotonic() - self.last_progress >= self.progress_interval:
+                self._progress()
+
+    def _hashed(self, entry, future):
+        try:
+            entry.content_hash, entry.size, recorded = future.result()
+        except Exception as e:
+            self.stats['failed'] += 1
+            self.stderr.write(f"Could not read {entry.path}: {e}")
+            return
+        metrics.merge(recorded)
+        self.hashed.append(entry)
+
+    def _dedupe(self, pool):
+        """Sends new content to extraction; duplicates reuse the stored blob and its tags."""
+        buffered, self.hashed = self.hashed, []
+        known = known_blobs({entry.content_hash for entry in buffered} - self.first_by_hash.keys())
+        for entry in buffered:
+            content_hash = entry.content_hash
+            original = self.first_by_hash.get(content_hash)
+            if original is not None:
+                self.stats['duplicates'] += 1
+                if original in self.extracting.values():
+                    self.waiting.setdefault(content_hash, []).append(entry)
+                else:
+                    self._copy_result(original, entry)
+            elif content_hash in known:
+                self.stats['duplicates'] += 1
+                if known[content_hash] is not None:
+                    entry.source_file_id, entry.source_token_count, entry.source_versions = known[content_hash]
+                self.ready.append(entry)
+            else:
+                self.first_by_hash[content_hash] = entry
+                self.extracting[pool.submit(store_and_extract, entry.path, entry.file_name, content_hash)] = entry
+
+    def _copy_result(self, original, entry):
+        entry.tag_positions = original.tag_positions
+        entry.error = original.error
+        self.ready.append(entry)
+
+    def _extracted(self, entry, future):
+        duplicates = self.waiting.pop(entry.content_hash, [])
+        try:
+            entry.stored_name, entry.tag_positions, entry.report, entry.text, entry.error = future.result()
+        except Exception as e:
+            # Not stored; neither it nor its duplicates are checkpointed, so the next run retries them
+            self.first_by_hash.pop(entry.content_hash, None)
+            self.stats['failed'] += 1 + len(duplicates)
+            self.stderr.write(f"Could not import {entry.path}: {e}")
+            return
+        if entry.report:
+            metrics.merge(entry.report.pop('metrics', None))
+        if entry.error:
+            self.stderr.write(f"Extraction failed for {entry.path}: {entry.error}; queued for the ingestion worker.")
+        self.ready.append(entry)
+        for duplicate in duplicates:
+            self._copy_result(entry, duplicate)
+
+    def _drain(self):
+        """Lets files already being stored finish, so an interruption leaves no unreferenced copies, and writes them."""
+        for future in self.hashing:
+            future.cancel()
+        self.hashing.clear()
+        for future, entry in list(self.extracting.items()):
+            del self.extracting[future]
+            if not future.cancel():
+                self._extracted(entry, future)
+        self._flush()
+
+    def _flush(self):
+        if not self.ready:
+            return
+        # The batch is only dropped from `ready` once committed, so an interrupted write is redone
+        write_batch(self.ready)
+        batch, self.ready = self.ready, []
+        self.checkpoint.mark([entry.path for entry in batch])
+        for entry in batch:
+            if self.first_by_hash.get(entry.content_hash) is entry:
+                del self.first_by_hash[entry.content_hash]  # Now found in the database instead
+            self.stats['files'] += 1
+            self.stats['bytes'] += entry.size
+            if entry.tag_positions is None and entry.source_file_id is None:
+                self.stats['queued'] += 1
+
+    def _progress(self, final=False):
+        self.last_progress = time.monotonic()
+        elapsed = max(self.last_progress - self.start, 1e-9)
+        stats = self.stats
+        self.stdout.write(
+            f"{'Done: ' if final else ''}{stats['files']} files imported "
+            f"({stats['duplicates']} duplicates, {stats['queued']} queued for retry, {stats['failed']} failed, "
+            f"{len(self.skipped)} directories skipped) "
+            f"in {elapsed:.1f}s: {stats['files'] / elapsed:.1f} files/s, {stats['bytes'] / elapsed / 1e6:.1f} MB/s"
+        )
+        if final and self.skipped:
+            self.stderr.write("Directories that could not be read (fix their permissions and run the command again):")
+            for directory in self.skipped:
+                self.stderr.write(f"  {directory}")
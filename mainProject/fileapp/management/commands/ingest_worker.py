@@ -0,0 +1,119 @@
+import os
+import socket
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from fileapp import metrics
+from fileapp.backends import preload
+from fileapp.extraction import extract_and_tag, format_report, init_worker
+from fileapp.ingest import (
+    claim_jobs, complete_job, fail_job, file_deleted, heartbeat, release_jobs, requeue_stale_jobs, reuse_duplicate_tags,
+)
+
+
+class Command(BaseCommand):
+    help = "Processes queued uploads: extracts text and generates tags in a local process pool."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, help='Number of extraction processes (default: INGEST_WORKERS).')
+        parser.add_argument('--poll-interval', type=float, help='Seconds between queue polls (default: INGEST_POLL_INTERVAL).')
+        parser.add_argument('--once', action='store_true', help='Exit once no due jobs are left instead of polling forever.')
+        parser.add_argument('--no-preload', action='store_true', help='Let each process import backends on first use (default: INGEST_PRELOAD).')
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or getattr(settings, 'INGEST_WORKERS', None) or os.cpu_count() or 1
+        poll_interval = options['poll_interval'] or getattr(settings, 'INGEST_POLL_INTERVAL', 2)
+        heartbeat_interval = getattr(settings, 'INGEST_HEARTBEAT_INTERVAL', 30)
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+        if getattr(settings, 'INGEST_PRELOAD', True) and not options['no_preload']:
+            # Forked children inherit the loaded backends and model instead of each loading their own
+            preload()
+
+        metrics.publish()  # Children hand their timings back with each result
+
+        # Children never use the database; don't let them inherit open connections.
+        connections.close_all()
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+        running = {}
+        last_heartbeat = time.monotonic()
+        self.stdout.write(f"Ingestion worker {worker_id} started with {workers} processes.")
+        try:
+            while True:
+                if running and time.monotonic() - last_heartbeat >= heartbeat_interval:
+                    heartbeat(worker_id)  # Jobs that take long (large scans) aren't taken for abandoned
+                    last_heartbeat = time.monotonic()
+                requeue_stale_jobs()
+                free_slots = workers - len(running)
+                claimed = claim_jobs(worker_id, free_slots) if free_slots > 0 else []
+                for job in claimed:
+                    if file_deleted(job):
+                        self._skip_deleted(job)
+                        continue
+                    try:
+                        reused = reuse_duplicate_tags(job)
+                        path = job.file.blob.file_content.path
+                    except Exception as e:
+                        self._fail(job, e)
+                        continue
+                    if reused:
+                        self.stdout.write(f"Job {job.id} ({job.file.file_name}) reused the tags of an identical file.")
+                        continue
+                    running[pool.submit(extract_and_tag, path, job.file.file_name)] = job
+
+                if not running:
+                    if claimed:
+                        continue  # Everything claimed was a duplicate; look for more work right away
+                    if options['once']:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+
+                done, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                pool_broken = False
+                for future in done:
+                    job = running.pop(future)
+                    try:
+                        tag_positions, report, text = future.result()
+                    except BrokenProcessPool as e:
+                        # A child died (e.g. killed for memory); every in-flight job is lost with it.
+                        pool_broken = True
+                        fail_job(job, e)
+                        self.stderr.write(f"Job {job.id} ({job.file.file_name}) lost with a crashed worker process.")
+                    except Exception as e:
+                        self._fail(job, e)
+                    else:
+                        metrics.merge(report.pop('metrics', None))
+                        if file_deleted(job):
+                            self._skip_deleted(job)
+                            continue
+                        try:
+                            complete_job(job, tag_positions, report, text)
+                        except Exception as e:
+                            # E.g. the file was deleted while its tags were written; other jobs go on
+                            self._fail(job, e)
+                            continue
+                        self.stdout.write(f"Job {job.id} ({job.file.file_name}) indexed {len(tag_positions)} tags; extracted {format_report(report)}.")
+                if pool_broken:
+                    for future, job in running.items():
+                        fail_job(job, 'Worker process pool crashed.')
+                    running.clear()
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping; returning in-flight jobs to the queue.")
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+            release_jobs(worker_id)
+
+    def _fail(self, job, error):
+        fail_job(job, error)
+        self.stderr.write(f"Job {job.id} ({job.file.file_name}) failed: {error}")
+
+    def _skip_deleted(self, job):
+        self.stdout.write(f"Job {job.id} ({job.file.file_name}) skipped: the file was deleted.")
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from fileapp.previews import cache_size, evict
+
+
+class Command(BaseCommand):
+    help = "Deletes the least recently served preview thumbnails while they take more than PREVIEW_CACHE_MAX_BYTES."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-bytes', type=int, help='Size to stay within (default: PREVIEW_CACHE_MAX_BYTES).')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be evicted.')
+
+    def handle(self, *args, **options):
+        count, size = cache_size()
+        self.stdout.write(f"{count} thumbnails stored ({size / (1024 * 1024):.1f} MB).")
+        evicted, freed = evict(options['max_bytes'], dry_run=options['dry_run'])
+        verb = "Would evict" if options['dry_run'] else "Evicted"
+        self.stdout.write(f"{verb} {evicted} thumbnails ({freed / (1024 * 1024):.1f} MB); they are rendered again when next shown.")
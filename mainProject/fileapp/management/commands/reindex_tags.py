@@ -0,0 +1,66 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from fileapp.backends import preload
+from fileapp.extraction import EXTRACTOR_VERSION
+from fileapp.nlp import tagger_version
+from fileapp.reindex import queue_reextraction, retag_text, stale_files, stored_texts, write_retagged
+
+
+class Command(BaseCommand):
+    help = "Re-tags files tagged with an older NLP_TAGGER_VERSION from their stored text, without extracting them again."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Files re-tagged per transaction (default: REINDEX_BATCH_SIZE).')
+        parser.add_argument('--workers', type=int, help='Tagging processes (default: INGEST_WORKERS).')
+        parser.add_argument(
+            '--reextract', action='store_true',
+            help='Queue files without stored text, or extracted with an older extractor version, for the ingestion '
+                 'worker. They are left out of search results until it has processed them.',
+        )
+        parser.add_argument('--no-preload', action='store_true', help='Let each process load the spaCy model on first use.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size'] or getattr(settings, 'REINDEX_BATCH_SIZE', 200)
+        workers = options['workers'] or getattr(settings, 'INGEST_WORKERS', None) or os.cpu_count() or 1
+        reextract = options['reextract']
+        if not options['no_preload']:
+            preload(['nlp'])  # Forked children share the loaded model
+        stats = {'retagged': 0, 'queued': 0, 'skipped': 0}
+        start = time.monotonic()
+        self.stdout.write(f"Re-tagging files to tagger version {tagger_version()} with {workers} processes.")
+
+        connections.close_all()  # Children never use the database
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for batch in stale_files(batch_size, reextract):
+                texts = stored_texts({blob_id for _, blob_id in batch})
+                retag, requeue = [], []
+                for file_id, blob_id in batch:
+                    stored = texts.get(blob_id)
+                    if reextract and (stored is None or stored[1] != EXTRACTOR_VERSION):
+                        requeue.append(file_id)
+                    elif stored is not None:
+                        retag.append((file_id, blob_id))
+                    else:
+                        stats['skipped'] += 1  # Ingested before text was stored
+
+                # Files sharing content are tagged once
+                blob_ids = list({blob_id for _, blob_id in retag})
+                counts = dict(zip(blob_ids, pool.map(retag_text, [texts[blob_id][0] for blob_id in blob_ids])))
+                if retag:
+                    write_retagged([(file_id, counts[blob_id], texts[blob_id][1]) for file_id, blob_id in retag])
+                queue_reextraction(requeue)
+                stats['retagged'] += len(retag)
+                stats['queued'] += len(requeue)
+                elapsed = max(time.monotonic() - start, 1e-9)
+                self.stdout.write(
+                    f"{stats['retagged']} files re-tagged, {stats['queued']} queued for extraction, "
+                    f"{stats['skipped']} without stored text ({stats['retagged'] / elapsed:.1f} files/s)"
+                )
+        if stats['skipped']:
+            self.stdout.write(f"{stats['skipped']} files have no stored text; run with --reextract to extract them again.")
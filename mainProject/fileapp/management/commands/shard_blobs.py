@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from fileapp.models import Blob
+from fileapp.storage import shard, sharded_name
+
+
+class Command(BaseCommand):
+    help = "Moves stored content from the flat `uploaded_files/` layout to directories sharded by content hash."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Blobs read per query.')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the blobs that would move.')
+
+    def handle(self, *args, **options):
+        moved = checked = 0
+        last_id = 0
+        start = time.monotonic()
+        while True:
+            # Keyset pagination: moved blobs change their name, not their id
+            blobs = list(Blob.objects.filter(id__gt=last_id).exclude(file_content='').order_by('id')[:options['batch_size']])
+            if not blobs:
+                break
+            last_id = blobs[-1].id
+            for blob in blobs:
+                checked += 1
+                if options['dry_run']:
+                    moved += sharded_name(blob) is not None
+                    continue
+                try:
+                    moved += shard(blob)
+                except FileNotFoundError:
+                    self.stderr.write(f"Blob {blob.id}: {blob.file_content.name} is missing from storage; left as it is.")
+            self.stdout.write(f"{checked} blobs checked, {moved} {'to move' if options['dry_run'] else 'moved'} "
+                              f"({checked / max(time.monotonic() - start, 1e-9):.0f} blobs/s)")
+        self.stdout.write("Done. Run gc_blobs to remove copies an interrupted run left behind.")
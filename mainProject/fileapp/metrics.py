@@ -0,0 +1,362 @@
+"""Per-stage timings and counters for the ingestion and search paths.
+
+    with metrics.span('hash', file_name=name):
+        ...
+    metrics.count('pages', 12, source='pdf')
+
+Each span is added to a `fileapp_stage_seconds{stage=...}` histogram and each
+counter to `fileapp_<name>_total{...}`; `GET metrics/` renders them in the
+Prometheus text format. Database queries are counted (by statement type)
+through a connection execute wrapper. With `METRICS_SPAN_LOG` set, a
+`METRICS_SPAN_SAMPLE_RATE` share of the spans is also appended to that file as
+JSON lines, with their attributes, for offline profiling.
+
+Metrics are kept per process:
+
+- Pool children, which never serve the endpoint, hand what they recorded back
+  to their parent with `take()`, next to the task's result, and the parent
+  `merge()`s it.
+- Other processes (the ingestion worker, `import_directory`, other web
+  workers) write a snapshot to `METRICS_DIR` every `METRICS_FLUSH_INTERVAL`
+  seconds and on exit; the endpoint adds those to its own. Snapshots of
+  processes that have exited are folded into one `retired.json` there, so
+  the totals stay cumulative (as Prometheus counters must) without a file
+  per process ever started.
+
+With `METRICS_ENABLED` off (the default), `span()` returns a shared
+do-nothing context manager, `count()` and `observe()` return at once and
+queries are not wrapped.
+"""
+import atexit
+import json
+import os
+import random
+import socket
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+ENABLED = getattr(settings, 'METRICS_ENABLED', False)
+SPAN_LOG = getattr(settings, 'METRICS_SPAN_LOG', None)
+SAMPLE_RATE = getattr(settings, 'METRICS_SPAN_SAMPLE_RATE', 0.01) if SPAN_LOG else 0
+FLUSH_INTERVAL = getattr(settings, 'METRICS_FLUSH_INTERVAL', 10)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)  # Seconds; +Inf is implicit
+
+_lock = threading.Lock()
+_histograms = {}  # Stage -> [count per bucket (the last one +Inf)..., sum of seconds]
+_counters = defaultdict(float)  # Rendered series name -> value
+_series_names = {}  # (name, *label items) -> rendered series name
+_publishing = False  # Whether this process writes snapshots to METRICS_DIR
+_last_flush = 0.0
+_span_log = None
+_span_log_pid = None
+
+
+def _reset_after_fork():
+    """Forked children start from zero; their parent still holds (and reports) what came before."""
+    global _lock, _histograms, _counters, _span_log
+    _lock = threading.Lock()
+    _histograms = {}
+    _counters = defaultdict(float)
+    _span_log = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class _Span:
+    __slots__ = ('stage', 'attributes', 'start')
+
+    def __init__(self, stage, attributes):
+        self.stage = stage
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.stage, time.perf_counter() - self.start, **self.attributes)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(stage, **attributes):
+    """Context manager timing the enclosed block as one `stage` span; `attributes` only go to the span log."""
+    if not ENABLED:
+        return _NO_SPAN
+    return _Span(stage, attributes)
+
+
+def observe(stage, seconds, **attributes):
+    """Records a `stage` span measured elsewhere."""
+    if not ENABLED:
+        return
+    index = bisect_left(BUCKETS, seconds)  # First bucket with seconds <= bound; len(BUCKETS) is +Inf
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = [0] * (len(BUCKETS) + 1) + [0.0]
+        histogram[index] += 1
+        histogram[-1] += seconds
+    if SAMPLE_RATE and random.random() < SAMPLE_RATE:
+        _log_span(stage, seconds, attributes)
+    _maybe_flush()
+
+
+def count(name, amount=1, **labels):
+    """Adds `amount` to the `fileapp_<name>_total` counter with the given labels."""
+    if not ENABLED:
+        return
+    series = (name, *labels.items())
+    key = _series_names.get(series)
+    if key is None:
+        key = _series_names[series] = _series(f"fileapp_{name}_total", labels)
+    with _lock:
+        _counters[key] += amount
+    _maybe_flush()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items())) + '}'
+
+
+# --- Span log ----------------------------------------------------------------
+
+def _log_span(stage, seconds, attributes):
+    global _span_log, _span_log_pid
+    record = {'time': time.time(), 'pid': os.getpid(), 'stage': stage, 'seconds': seconds, **attributes}
+    line = json.dumps(record, default=str) + '\n'
+    with _lock:
+        if _span_log is None or _span_log_pid != os.getpid():
+            # Appending, so lines from several processes don't overwrite each other
+            _span_log = open(SPAN_LOG, 'a', buffering=1, encoding='utf-8')
+            _span_log_pid = os.getpid()
+        _span_log.write(line)
+
+
+# --- Collecting across processes ---------------------------------------------
+
+def _snapshot():
+    with _lock:
+        return {
+            'histograms': {stage: list(histogram) for stage, histogram in _histograms.items()},
+            'counters': dict(_counters),
+        }
+
+
+def _add(histograms, counters, snapshot):
+    for stage, values in snapshot.get('histograms', {}).items():
+        histogram = histograms.setdefault(stage, [0] * (len(BUCKETS) + 1) + [0.0])
+        for index, value in enumerate(values):
+            histogram[index] += value
+    for key, value in snapshot.get('counters', {}).items():
+        counters[key] += value
+
+
+def take():
+    """Returns and clears what this process recorded, for a pool task to return to its parent (None when disabled)."""
+    global _publishing
+    if not ENABLED:
+        return None
+    snapshot = _snapshot()
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+    if _publishing:
+        # Whatever this process published is in the snapshot now; its parent reports it from here on
+        _publishing = False
+        try:
+            os.remove(_snapshot_path())
+        except FileNotFoundError:
+            pass
+    return snapshot
+
+
+def merge(snapshot):
+    """Adds a snapshot returned by a pool task's `take()` to this process's metrics."""
+    if not snapshot:
+        return
+    with _lock:
+        _add(_histograms, _counters, snapshot)
+    _maybe_flush()
+
+
+RETIRED = 'retired.json'  # Snapshots of exited processes, added up
+HOST = socket.gethostname()
+
+
+def _snapshot_path():
+    directory = getattr(settings, 'METRICS_DIR', None)
+    return os.path.join(directory, f"{HOST}.{os.getpid()}.json") if directory else None
+
+
+def _exited(name):
+    """Whether a snapshot file was written by a process of this host that is gone."""
+    host, _, pid = name[:-len('.json')].rpartition('.')
+    if host not in (HOST, '') or not pid.isdigit():  # '': named by PID alone, as before hosts were added
+        return False  # Another host's processes can't be checked from here
+    try:
+        os.kill(int(pid), 0)  # Signal 0 only checks that the process exists
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass  # Exists, under another user
+    return False
+
+
+def _read(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write(path, snapshot):
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f)
+    os.replace(temporary, path)  # Readers never see a half-written snapshot
+
+
+def _retire(directory, names):
+    """Folds the snapshots of exited processes into RETIRED and deletes them.
+
+    Runs under an exclusive lock, so two processes collecting at once don't
+    both fold the same snapshot.
+    """
+    import fcntl
+
+    with open(os.path.join(directory, 'retired.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        histograms, counters = {}, defaultdict(float)
+        paths = [os.path.join(directory, name) for name in [RETIRED, *names]]
+        for path in paths:
+            try:
+                _add(histograms, counters, _read(path))
+            except FileNotFoundError:
+                continue  # No retired snapshots yet, or already folded by another process
+            except ValueError:
+                continue  # Cut short when its process died; nothing to recover
+        _write(paths[0], {'histograms': histograms, 'counters': dict(counters)})
+        for path in paths[1:]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def publish():
+    """Makes this process write its metrics to `METRICS_DIR`, for the endpoint of whichever process serves it.
+
+    Called by the WSGI/ASGI application and the long-running management
+    commands; forked web workers inherit it.
+    """
+    global _publishing
+    if ENABLED and getattr(settings, 'METRICS_DIR', None):
+        _publishing = True
+        atexit.register(flush)
+
+
+def flush():
+    """Writes this process's snapshot to `METRICS_DIR` now."""
+    global _last_flush
+    path = _snapshot_path()
+    if not (ENABLED and _publishing and path):
+        return
+    _last_flush = time.monotonic()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _write(path, _snapshot())
+
+
+def _maybe_flush():
+    if _publishing and time.monotonic() - _last_flush >= FLUSH_INTERVAL:
+        flush()
+
+
+def collect():
+    """This process's metrics plus the snapshots other processes wrote to `METRICS_DIR`."""
+    histograms, counters = {}, defaultdict(float)
+    _add(histograms, counters, _snapshot())
+    directory = getattr(settings, 'METRICS_DIR', None)
+    if directory and os.path.isdir(directory):
+        own = os.path.basename(_snapshot_path())
+        names = [name for name in os.listdir(directory) if name.endswith('.json') and name not in (own, RETIRED)]
+        exited = [name for name in names if _exited(name)] if os.name == 'posix' else []
+        if exited:
+            _retire(directory, exited)
+        for name in [RETIRED, *(name for name in names if name not in exited)]:
+            try:
+                _add(histograms, counters, _read(os.path.join(directory, name)))
+            except (OSError, ValueError):  # Replaced or removed while listing
+                continue
+    return histograms, counters
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    histograms, counters = collect()
+    lines = [
+        '# HELP fileapp_stage_seconds Time spent per pipeline stage.',
+        '# TYPE fileapp_stage_seconds histogram',
+    ]
+    for stage in sorted(histograms):
+        values = histograms[stage]
+        cumulative = 0
+        for bound, value in zip(BUCKETS + ('+Inf',), values):
+            cumulative += value
+            lines.append(f'{_series("fileapp_stage_seconds_bucket", {"stage": stage, "le": bound})} {cumulative}')
+        lines.append(f'{_series("fileapp_stage_seconds_sum", {"stage": stage})} {values[-1]}')
+        lines.append(f'{_series("fileapp_stage_seconds_count", {"stage": stage})} {cumulative}')
+    typed = set()
+    for key in sorted(counters):
+        name = key.split('{', 1)[0]
+        if name not in typed:
+            lines.append(f'# TYPE {name} counter')
+            typed.add(name)
+        value = counters[key]
+        lines.append(f'{key} {int(value) if float(value).is_integer() else value}')
+    return '\n'.join(lines) + '\n'
+
+
+# --- Database queries --------------------------------------------------------
+
+def _count_query(execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        statement = sql.split(None, 1)[0].upper() if sql else ''
+        count('db_queries', statement=statement)
+        count('db_query_seconds', time.perf_counter() - start, statement=statement)
+
+
+def _wrap_connection(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+def install():
+    """Counts the queries of every database connection opened from now on (when enabled)."""
+    if ENABLED:
+        connection_created.connect(_wrap_connection, dispatch_uid='fileapp.metrics')
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileapp', '0002_ingestion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='token_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='filetag',
+            name='frequency',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddIndex(
+            model_name='filetag',
+            index=models.Index(fields=['tag', 'file'], name='fileapp_fil_tag_id_8a6e0f_idx'),
+        ),
+    ]
@@ -0,0 +1,68 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def files_to_blobs(apps, schema_editor):
+    """Moves each file's stored content into a blob, merging files with equal hashes."""
+    Blob = apps.get_model('fileapp', 'Blob')
+    File = apps.get_model('fileapp', 'File')
+    blobs = {}
+    for file_instance in File.objects.order_by('id').iterator():
+        blob = blobs.get(file_instance.content_hash)
+        if blob is None:
+            try:
+                size = file_instance.file_content.size
+            except OSError:
+                size = 0
+            blob = Blob.objects.create(
+                content_hash=file_instance.content_hash,
+                file_content=file_instance.file_content.name,
+                size=size,
+            )
+            blobs[file_instance.content_hash] = blob
+        # Duplicates keep their own copy on disk; it is simply no longer referenced.
+        blob.ref_count += 1
+        file_instance.blob = blob
+        file_instance.save(update_fields=['blob'])
+    for blob in blobs.values():
+        blob.save(update_fields=['ref_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileapp', '0003_search_term_frequencies'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64, unique=True)),
+                ('file_content', models.FileField(upload_to='uploaded_files/')),
+                ('size', models.BigIntegerField(default=0)),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='blob',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='files', to='fileapp.blob'),
+        ),
+        migrations.RunPython(files_to_blobs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='file',
+            name='blob',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='files', to='fileapp.blob'),
+        ),
+        migrations.RemoveField(
+            model_name='file',
+            name='content_hash',
+        ),
+        migrations.RemoveField(
+            model_name='file',
+            name='file_content',
+        ),
+    ]
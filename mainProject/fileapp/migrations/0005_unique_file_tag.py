@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:54
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_file_tags(apps, schema_editor):
+    """Collapses repeated (file, tag) rows into one so the constraint can be added."""
+    FileTag = apps.get_model('fileapp', 'FileTag')
+    duplicates = (
+        FileTag.objects
+        .values('file_id', 'tag_id')
+        .annotate(rows=Count('id'), keep_id=Min('id'), total=Sum('frequency'))
+        .filter(rows__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        FileTag.objects.filter(id=duplicate['keep_id']).update(frequency=duplicate['total'])
+        (
+            FileTag.objects
+            .filter(file_id=duplicate['file_id'], tag_id=duplicate['tag_id'])
+            .exclude(id=duplicate['keep_id'])
+            .delete()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileapp', '0004_blob'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_file_tags, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='filetag',
+            constraint=models.UniqueConstraint(fields=('file', 'tag'), name='unique_file_tag'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileapp', '0005_unique_file_tag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='content_type',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:12
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileapp', '0006_blob_content_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('file_name', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField(blank=True, null=True)),
+                ('received', models.BigIntegerField(default=0)),
+                ('staging_name', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['updated_at'], name='fileapp_upl_updated_677871_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileapp', '0007_upload_session'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExtractedText',
+            fields=[
+                ('blob', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='extracted_text', serialize=False, to='fileapp.blob')),
+                ('data', models.BinaryField()),
+                ('characters', models.PositiveBigIntegerField(default=0)),
+                ('extractor_version', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='extractor_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='tagger_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
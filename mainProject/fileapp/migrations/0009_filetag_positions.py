@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileapp', '0008_extracted_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filetag',
+            name='positions',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+    ]
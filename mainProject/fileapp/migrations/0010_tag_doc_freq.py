@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:05
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_doc_freqs(apps, schema_editor):
+    """Sets every tag's document frequency from its postings."""
+    FileTag = apps.get_model('fileapp', 'FileTag')
+    Tag = apps.get_model('fileapp', 'Tag')
+    postings = FileTag.objects.filter(tag_id=OuterRef('pk')).values('tag_id').annotate(files=Count('id')).values('files')
+    Tag.objects.update(doc_freq=Coalesce(Subquery(postings), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileapp', '0009_filetag_positions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='doc_freq',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_doc_freqs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:01
+
+import fileapp.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileapp', '0010_tag_doc_freq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='released_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='blob',
+            name='file_content',
+            field=models.FileField(upload_to=fileapp.models.blob_upload_to),
+        ),
+    ]
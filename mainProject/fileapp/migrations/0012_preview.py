@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:08
+
+import django.db.models.deletion
+import django.utils.timezone
+import fileapp.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileapp', '0011_blob_sharding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Preview',
+            fields=[
+                ('blob', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='preview', serialize=False, to='fileapp.blob')),
+                ('text', models.TextField(blank=True)),
+                ('has_thumbnail', models.BooleanField(default=False)),
+                ('thumbnail', models.FileField(blank=True, upload_to=fileapp.models.preview_upload_to)),
+                ('thumbnail_size', models.PositiveIntegerField(default=0)),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('last_accessed', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
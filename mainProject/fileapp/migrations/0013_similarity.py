@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileapp', '0012_preview'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TagSignature',
+            fields=[
+                ('blob', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='tag_signature', serialize=False, to='fileapp.blob')),
+                ('data', models.BinaryField()),
+                ('version', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SimilarityKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.BigIntegerField()),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similarity_keys', to='fileapp.blob')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['key', 'blob'], name='fileapp_sim_key_6be43a_idx')],
+            },
+        ),
+    ]
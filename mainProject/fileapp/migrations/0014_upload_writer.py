@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fileapp', '0013_similarity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='writer',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+    ]
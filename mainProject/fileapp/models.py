@@ -1,22 +1,168 @@
+import os
+import re
+import uuid
+
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
+
+from .text_store import iter_text_chunks
 
 class Tag(models.Model):
     tag_name = models.CharField(max_length=255, unique=True)
+    doc_freq = models.PositiveIntegerField(default=0)  # Files tagged with it; kept up to date by `tags`, read by the ranking
 
     def __str__(self):
         return self.tag_name
 
+def blob_upload_to(blob, file_name):
+    """Storage key of a blob, sharded by its hash: `blobs/3a/7f/3a7f...e1.pdf` (see BLOB_STORAGE_DIR)."""
+    levels = getattr(settings, 'BLOB_SHARD_LEVELS', 2)
+    shards = [blob.content_hash[2 * level:2 * level + 2] for level in range(levels)]
+    extension = os.path.splitext(file_name)[1].lower()
+    if not re.fullmatch(r'\.[a-z0-9]{1,15}', extension):
+        extension = ''  # Only a short, plain extension fits the key length
+    return '/'.join([getattr(settings, 'BLOB_STORAGE_DIR', 'blobs'), *shards, blob.content_hash + extension])
+
+
+class Blob(models.Model):
+    """Stored file content, shared by every `File` with the same sha256."""
+    content_hash = models.CharField(max_length=64, unique=True)
+    file_content = models.FileField(upload_to=blob_upload_to)
+    size = models.BigIntegerField(default=0)
+    content_type = models.CharField(max_length=255, blank=True)  # Sniffed from the bytes during ingestion
+    ref_count = models.PositiveIntegerField(default=0)  # Number of File rows referencing this blob
+    created_at = models.DateTimeField(auto_now_add=True)
+    released_at = models.DateTimeField(null=True, blank=True)  # Last time a reference was dropped; `gc_blobs` waits BLOB_GC_GRACE after it
+
+    def __str__(self):
+        return self.content_hash
+
 class File(models.Model):
+    class IngestStatus(models.TextChoices):
+        PENDING = 'pending', 'Pending'
+        PROCESSING = 'processing', 'Processing'
+        DONE = 'done', 'Done'
+        FAILED = 'failed', 'Failed'
+
     file_name = models.CharField(max_length=255)
-    file_content = models.FileField(upload_to='uploaded_files/')
-    content_hash = models.CharField(max_length=64)
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, related_name='files')
+    ingest_status = models.CharField(max_length=16, choices=IngestStatus.choices, default=IngestStatus.DONE)
+    ingest_error = models.TextField(blank=True)
+    token_count = models.PositiveIntegerField(default=0)  # Tagged tokens in the document, used for BM25 length normalisation
+    extractor_version = models.PositiveIntegerField(default=0)  # extraction.EXTRACTOR_VERSION the tags were built from; 0 = unknown
+    tagger_version = models.PositiveIntegerField(default=0)  # NLP_TAGGER_VERSION the tags were generated with; 0 = unknown
 
     def __str__(self):
         return self.file_name
 
+class ExtractedText(models.Model):
+    """The text extracted from a blob, zlib-compressed (see `text_store`), so files can be re-tagged without re-extracting."""
+    blob = models.OneToOneField(Blob, on_delete=models.CASCADE, primary_key=True, related_name='extracted_text')
+    data = models.BinaryField()
+    characters = models.PositiveBigIntegerField(default=0)  # Length of the uncompressed text
+    extractor_version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def chunks(self):
+        return iter_text_chunks(bytes(self.data))
+
+    def __str__(self):
+        return f"{self.blob} ({self.characters} characters)"
+
+def preview_upload_to(preview, file_name):
+    """Storage key of a thumbnail, sharded like blobs: `previews/3a/7f/3a7f...e1.webp` (see PREVIEW_STORAGE_DIR)."""
+    content_hash = preview.blob.content_hash
+    levels = getattr(settings, 'BLOB_SHARD_LEVELS', 2)
+    shards = [content_hash[2 * level:2 * level + 2] for level in range(levels)]
+    return '/'.join([getattr(settings, 'PREVIEW_STORAGE_DIR', 'previews'), *shards, content_hash + '.webp'])
+
+class Preview(models.Model):
+    """What search results show of a blob: the start of its text and a first-page thumbnail (see `previews`)."""
+    blob = models.OneToOneField(Blob, on_delete=models.CASCADE, primary_key=True, related_name='preview')
+    text = models.TextField(blank=True)  # First PREVIEW_TEXT_LENGTH characters of the extracted text, whitespace collapsed
+    has_thumbnail = models.BooleanField(default=False)  # Whether the content type can be rendered
+    thumbnail = models.FileField(upload_to=preview_upload_to, blank=True)  # Empty while evicted (rendered again when asked for)
+    thumbnail_size = models.PositiveIntegerField(default=0)  # Bytes of the stored thumbnail, counted against PREVIEW_CACHE_MAX_BYTES
+    version = models.PositiveIntegerField(default=0)  # previews.PREVIEW_VERSION it was made with
+    last_accessed = models.DateTimeField(default=timezone.now, db_index=True)  # Eviction order, least recently served first
+
+    def __str__(self):
+        return f"Preview of {self.blob}"
+
+class TagSignature(models.Model):
+    """MinHash signature of a blob's tag set, for "more like this" lookups (see `similarity`)."""
+    blob = models.OneToOneField(Blob, on_delete=models.CASCADE, primary_key=True, related_name='tag_signature')
+    data = models.BinaryField()  # similarity.PERMUTATIONS little-endian uint32 minimums
+    version = models.PositiveIntegerField(default=0)  # similarity.SIGNATURE_VERSION it was computed with
+
+    def __str__(self):
+        return f"Signature of {self.blob}"
+
+class SimilarityKey(models.Model):
+    """One LSH band of a blob's signature; blobs sharing a key are candidates for each other's similar files."""
+    blob = models.ForeignKey(Blob, on_delete=models.CASCADE, related_name='similarity_keys')
+    key = models.BigIntegerField()  # Hash of the band's number and values
+
+    class Meta:
+        indexes = [models.Index(fields=['key', 'blob'])]
+
+    def __str__(self):
+        return f"{self.blob} - {self.key}"
+
 class FileTag(models.Model):
     file = models.ForeignKey(File, on_delete=models.CASCADE)
     tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
+    frequency = models.PositiveIntegerField(default=1)  # Occurrences of the tag in the file
+    positions = models.BinaryField(default=b'', blank=True)  # Token positions of the occurrences, see `positions.encode_positions`
+
+    class Meta:
+        # Posting-list order: all files for a tag, read straight from the index.
+        indexes = [models.Index(fields=['tag', 'file'])]
+        constraints = [models.UniqueConstraint(fields=['file', 'tag'], name='unique_file_tag')]
+
+    def __str__(self):
+        return f"{self.file} - {self.tag}"
+
+class IngestJob(models.Model):
+    """A queued extraction/tagging run for an uploaded file, claimed by `ingest_worker`."""
+    class Status(models.TextChoices):
+        QUEUED = 'queued', 'Queued'
+        RUNNING = 'running', 'Running'
+        DONE = 'done', 'Done'
+        FAILED = 'failed', 'Failed'
+
+    file = models.ForeignKey(File, on_delete=models.CASCADE, related_name='ingest_jobs')
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    last_error = models.TextField(blank=True)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=64, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_after'])]
+
+    def __str__(self):
+        return f"{self.file} - {self.status}"
+
+
+class UploadSession(models.Model):
+    """A resumable chunked upload in progress; chunks are appended to `staging_name` in order."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    file_name = models.CharField(max_length=255)
+    size = models.BigIntegerField(null=True, blank=True)  # Total size announced by the client, if any
+    received = models.BigIntegerField(default=0)  # Bytes written so far, i.e. the offset of the next chunk
+    staging_name = models.CharField(max_length=255)  # Partial file, relative to MEDIA_ROOT
+    writer = models.UUIDField(null=True, blank=True)  # Request appending a chunk right now, if any; see uploads.append_chunk
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['updated_at'])]
 
     def __str__(self):
-        return f"{self.file} - {self.tag}"
\ No newline at end of file
+        return f"{self.file_name} ({self.received} bytes)"
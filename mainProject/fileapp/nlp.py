@@ -0,0 +1,121 @@
+"""Tag generation with spaCy.
+
+Only lemmas and the lexical `is_alpha`/`is_stop` flags are used, so the
+pipeline is loaded without the components that don't feed the lemmatizer
+(parser and NER by default). The model is loaded on first use, once per
+process, and long texts are split into chunks below `nlp.max_length` and
+streamed through `nlp.pipe` in batches.
+"""
+import logging
+from array import array
+from collections import Counter
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_nlp = None
+
+
+def get_nlp():
+    """Returns this process's spaCy pipeline, loading it on first use."""
+    global _nlp
+    if _nlp is None:
+        import spacy
+
+        _nlp = spacy.load(
+            getattr(settings, 'NLP_MODEL', 'en_core_web_sm'),
+            exclude=getattr(settings, 'NLP_EXCLUDE', ['parser', 'ner']),
+        )
+    return _nlp
+
+
+def tagger_version():
+    """Version of the tagging rules; files tagged with an older one are re-tagged by `reindex_tags`."""
+    return getattr(settings, 'NLP_TAGGER_VERSION', 2)
+
+
+def split_text(text, size):
+    """Splits text into chunks of at most `size` characters, at whitespace where possible."""
+    start = 0
+    while start < len(text):
+        end = start + size
+        if end < len(text):
+            cut = max(text.rfind(' ', start, end), text.rfind('\n', start, end))
+            if cut > start:
+                end = cut
+        yield text[start:end]
+        start = end
+
+
+def _chunks(texts, size):
+    for text in texts:
+        yield from split_text(text, size)
+
+
+def _docs(content):
+    if isinstance(content, str):
+        content = [content]
+    nlp = get_nlp()
+    chunk_size = min(getattr(settings, 'NLP_CHUNK_CHARS', 100_000), nlp.max_length - 1)
+    return nlp.pipe(
+        _chunks(content, chunk_size),
+        batch_size=getattr(settings, 'NLP_BATCH_SIZE', 32),
+        n_process=getattr(settings, 'NLP_N_PROCESS', 1),
+    )
+
+
+def generate_tag_counts(content):
+    """Generates tags from the content using NLP, with how often each occurs.
+
+    `content` is a string or an iterable of text chunks (e.g. PDF pages), which
+    are tagged as they arrive instead of being joined into one document first.
+    Errors raised while producing the chunks propagate to the caller.
+    """
+    counts = Counter()
+    for doc in _docs(content):
+        counts.update(token.lemma_.lower() for token in doc if token.is_alpha and not token.is_stop)
+    return counts
+
+
+def tag_positions(doc, start=0):
+    """`(lemma, position)` of the tags in a spaCy doc.
+
+    Positions count every token except whitespace, stop words and punctuation
+    included, so the distance between two tags is the same in a document as
+    in a phrase query, however the text was wrapped.
+    """
+    position = start
+    for token in doc:
+        if token.is_space:
+            continue
+        if token.is_alpha and not token.is_stop:
+            yield token.lemma_.lower(), position
+        position += 1
+
+
+def generate_tag_positions(content):
+    """Like `generate_tag_counts`, but with where each tag occurs: `{lemma: array of token positions}`.
+
+    A tag's frequency is the length of its array. Positions run on across
+    chunks, which are tagged as they arrive.
+    """
+    positions = {}
+    start = 0
+    for doc in _docs(content):
+        for lemma, position in tag_positions(doc, start):
+            occurrences = positions.get(lemma)
+            if occurrences is None:
+                occurrences = positions[lemma] = array('I')
+            occurrences.append(position)
+        start += sum(1 for token in doc if not token.is_space)
+    return positions
+
+
+def generate_tags(content):
+    """Generates tags from the content using NLP."""
+    try:
+        return set(generate_tag_counts(content))
+    except Exception:
+        logger.exception("Error generating tags")
+        return set()
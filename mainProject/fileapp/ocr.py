@@ -0,0 +1,242 @@
+"""OCR of images and scanned PDF pages with Tesseract.
+
+Images are normalised before recognition: turned upright (EXIF), scaled down
+to `OCR_TARGET_DPI` and at most `OCR_MAX_PIXELS`, converted to grayscale and
+binarized. Tesseract's run time grows with the pixel count, so a 48 MP phone
+photo brought down to page size at 300 DPI is recognized many times faster
+without losing text. JPEGs are decoded straight at the reduced size.
+
+Images taller than `OCR_TILE_HEIGHT` are cut into bands at blank rows. Every
+image or band is recognized by its own tesseract process, killed after
+`OCR_TIMEOUT` seconds; at most `OCR_WORKERS` of them run at once per Python
+process.
+"""
+import logging
+import math
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from . import metrics
+from .backends import get_backend
+
+logger = logging.getLogger(__name__)
+
+WINDOWS_TESSERACT_CMD = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+
+
+def find_tesseract():
+    """Path of the tesseract binary: `TESSERACT_CMD`, else PATH, else the default Windows install, else None."""
+    configured = getattr(settings, 'TESSERACT_CMD', None)
+    if configured:
+        return configured
+    found = shutil.which('tesseract')
+    if found:
+        return found
+    if os.path.exists(WINDOWS_TESSERACT_CMD):
+        return WINDOWS_TESSERACT_CMD
+    return None
+
+
+def otsu_threshold(histogram):
+    """Gray level that best separates the two classes of a 256-bin histogram (Otsu's method)."""
+    total = sum(histogram)
+    weighted_total = sum(level * count for level, count in enumerate(histogram))
+    background = weighted_background = 0
+    best_level, best_variance = 127, -1.0
+    for level, count in enumerate(histogram):
+        background += count
+        if background == 0:
+            continue
+        foreground = total - background
+        if foreground == 0:
+            break
+        weighted_background += level * count
+        mean_background = weighted_background / background
+        mean_foreground = (weighted_total - weighted_background) / foreground
+        variance = background * foreground * (mean_background - mean_foreground) ** 2
+        if variance > best_variance:
+            best_level, best_variance = level, variance
+    return best_level
+
+
+def _scale_for(size, dpi, target_dpi, max_pixels, tile_height):
+    """Factor (at most 1) that brings an image down to the target DPI and pixel budget.
+
+    Tall images are cut into bands anyway, so for them the budget applies to
+    one band rather than to the whole image.
+    """
+    scale = 1.0
+    if dpi and target_dpi and dpi > target_dpi:
+        scale = target_dpi / dpi
+    width, height = size
+    if max_pixels:
+        budget_scale = math.sqrt(max_pixels / (width * height))
+        if tile_height and height * budget_scale > tile_height:
+            budget_scale = max_pixels / (width * tile_height)
+        scale = min(scale, budget_scale)
+    return scale
+
+
+def _image_dpi(image):
+    dpi = image.info.get('dpi')
+    try:
+        dpi = float(dpi[0])
+    except (TypeError, ValueError, IndexError):
+        return None
+    return dpi if dpi > 96 else None  # 0, 1, 72 and 96 DPI are format defaults, not a scan resolution
+
+
+def preprocess(image, dpi=None):
+    """Prepares an image for tesseract; returns `(image, dpi)`.
+
+    `dpi` overrides the resolution recorded in the image (e.g. for rendered PDF
+    pages). The returned DPI is the one after scaling, or None if unknown.
+    """
+    Image = get_backend('pil')
+    ImageOps = get_backend('pil_ops')
+    dpi = dpi or _image_dpi(image)
+    target_dpi = getattr(settings, 'OCR_TARGET_DPI', 300)
+    max_pixels = getattr(settings, 'OCR_MAX_PIXELS', 9_000_000)
+    tile_height = getattr(settings, 'OCR_TILE_HEIGHT', 4000)
+
+    scale = _scale_for(image.size, dpi, target_dpi, max_pixels, tile_height)
+    if scale < 1:
+        # Lets the JPEG decoder skip most of the work; a no-op for other formats
+        requested = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+        original_width = image.width
+        image.draft('L', requested)
+        if image.width != original_width:
+            if dpi:
+                dpi *= image.width / original_width
+            scale = _scale_for(image.size, dpi, target_dpi, max_pixels, tile_height)
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        # Transparent pixels become white rather than black
+        image = image.convert('RGBA')
+        background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    if image.mode != 'L':
+        image = image.convert('L')
+
+    if scale < 1:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+        if dpi:
+            dpi *= scale
+
+    if getattr(settings, 'OCR_BINARIZE', True):
+        threshold = otsu_threshold(image.histogram())
+        image = image.point([255 if level > threshold else 0 for level in range(256)], mode='1')
+    return image, round(dpi) if dpi else None
+
+
+def _blank_row(image, low, high):
+    """Row between `low` and `high` with the least ink, where a band can be cut without splitting a line."""
+    Image = get_backend('pil')
+    strip = image.crop((0, low, image.width, high))
+    if strip.mode != 'L':
+        strip = strip.convert('L')
+    # Averaging each row down to one pixel gives its brightness
+    brightness = list(strip.resize((1, high - low), Image.Resampling.BOX).getdata())
+    return low + max(range(len(brightness)), key=brightness.__getitem__)
+
+
+def tiles(image):
+    """Cuts a tall image into bands of about `OCR_TILE_HEIGHT` rows at blank rows."""
+    tile_height = getattr(settings, 'OCR_TILE_HEIGHT', 4000)
+    if not tile_height or image.height <= tile_height * 1.25:
+        return [image]
+    bands = []
+    top = 0
+    while image.height - top > tile_height * 1.25:
+        window = tile_height // 10  # Search for a blank row in the last tenth of the band
+        cut = _blank_row(image, top + tile_height - window, top + tile_height)
+        bands.append(image.crop((0, top, image.width, cut)))
+        top = cut
+    bands.append(image.crop((0, top, image.width, image.height)))
+    return bands
+
+
+_pool = None
+_pool_pid = None
+
+
+def limit_tesseract_threads():
+    """Keeps tesseract to one OpenMP thread per process when `OCR_WORKERS` of them run at once.
+
+    Parallel tesseract processes each running several threads oversubscribe
+    the CPUs and end up slower than one at a time. Tesseract reads the limit
+    from the environment it inherits, so this is set once in the extraction
+    processes (see `extraction.init_worker`), not by each OCR call.
+    """
+    if getattr(settings, 'OCR_WORKERS', 2) > 1:
+        os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+
+
+def _executor():
+    """This process's pool of OCR threads, each driving one tesseract process at a time."""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():  # Pools don't survive a fork
+        _pool = ThreadPoolExecutor(max_workers=getattr(settings, 'OCR_WORKERS', 2), thread_name_prefix='ocr')
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def recognize(image, dpi=None):
+    """Runs tesseract on one preprocessed image; raises RuntimeError on timeout."""
+    config = f'--dpi {dpi}' if dpi else ''
+    return get_backend('pytesseract').image_to_string(
+        image,
+        lang=getattr(settings, 'OCR_LANG', 'eng'),
+        config=config,
+        timeout=getattr(settings, 'OCR_TIMEOUT', 120),
+    )
+
+
+def ocr_image(image, dpi=None):
+    """Preprocesses an image and returns its text, recognizing the bands of tall images in parallel."""
+    metrics.count('pages', source='ocr')
+    with metrics.span('ocr', width=image.width, height=image.height):
+        image, dpi = preprocess(image, dpi)
+        bands = tiles(image)
+        if len(bands) == 1:
+            return recognize(image, dpi)
+        return "\n".join(_executor().map(lambda band: recognize(band, dpi), bands))
+
+
+def iter_image_text(file_path):
+    """Yields the OCR text of an image file, one frame at a time (multi-page TIFFs have several)."""
+    Image = get_backend('pil')
+    with Image.open(file_path) as image:
+        for frame in range(getattr(image, 'n_frames', 1)):
+            image.seek(frame)
+            text = ocr_image(image if frame == 0 else image.copy())
+            if text.strip():
+                yield text
+
+
+_warned_missing = False
+
+
+def ocr_pdf_page(page):
+    """OCR text of a pdfplumber page without a text layer, or '' if Tesseract isn't installed."""
+    global _warned_missing
+    if find_tesseract() is None:
+        if not _warned_missing:
+            logger.warning("Tesseract not found; skipping OCR of image-only PDF pages")
+            _warned_missing = True
+        return ''
+    resolution = getattr(settings, 'OCR_PDF_DPI', 300)
+    rendered = page.to_image(resolution=resolution).original
+    try:
+        return ocr_image(rendered, dpi=resolution)
+    except RuntimeError as e:  # Tesseract timed out on this page
+        logger.warning("OCR failed on page %d: %s", page.page_number, e)
+        metrics.count('ocr_failures', source='pdf')
+        return ''
+    finally:
+        rendered.close()
@@ -0,0 +1,36 @@
+"""Compact encoding of token positions for `FileTag.positions`.
+
+Positions are stored sorted, as the gaps between consecutive positions, each
+gap as a varint (7 bits per byte, high bit set on all but the last byte).
+Gaps are small for any tag that matters to a phrase query, so most
+positions take a single byte.
+"""
+
+
+def encode_positions(positions):
+    """Encodes ascending token positions."""
+    out = bytearray()
+    previous = 0
+    for position in positions:
+        gap = position - previous
+        previous = position
+        while gap >= 0x80:
+            out.append((gap & 0x7F) | 0x80)
+            gap >>= 7
+        out.append(gap)
+    return bytes(out)
+
+
+def decode_positions(data):
+    """Decodes positions written by `encode_positions` into a list."""
+    positions = []
+    position = gap = shift = 0
+    for byte in bytes(data):
+        gap |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        position += gap
+        positions.append(position)
+        gap = shift = 0
+    return positions
@@ -0,0 +1,306 @@
+"""Previews of search hits: a first-page thumbnail and a snippet of the text.
+
+Previews belong to blobs, so identical files share one. Both parts are made
+at ingestion, in the worker's child processes (`thumbnails.render_thumbnail`
+and `TextRecorder.lead`), and written by `store_preview` along with the
+job's tags. Search hits carry a short snippet of the stored text with the
+query's words marked, and the URL of the thumbnail for the browser to load
+lazily. That URL names the content's hash and `PREVIEW_VERSION`, so the
+thumbnail behind it never changes and is served cacheable for
+`PREVIEW_MAX_AGE` seconds.
+
+Thumbnails are stored under `PREVIEW_STORAGE_DIR`, bounded to
+`PREVIEW_CACHE_MAX_BYTES` in total: `evict` deletes the least recently
+served ones (`Preview.last_accessed`) until they are back under
+`PREVIEW_CACHE_LOW_WATER` of the limit, and an evicted thumbnail is
+rendered again from its blob the next time it is asked for.
+"""
+import re
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.http import Http404, HttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from . import metrics, search_cache
+from .extraction import sniff_content_type
+from .models import ExtractedText, Preview
+from .text_store import extend_lead
+from .thumbnails import THUMBNAIL_CONTENT_TYPE, render_thumbnail
+
+# Bump when a change to the thumbnails or the stored text would make existing
+# previews look different; `build_previews --rebuild` then remakes them, under
+# new URLs, so browsers don't keep showing the old ones.
+PREVIEW_VERSION = 1
+
+QUERY_WORD_RE = re.compile(r"[\w*]+")
+SUFFIX_SLACK = 3  # Letters a word may have past a query lemma and still be marked ("invoice" marks "invoices")
+
+_last_eviction = 0.0
+
+
+def _storage():
+    return Preview._meta.get_field('thumbnail').storage
+
+
+def _delete_on_commit(names):
+    names = [name for name in names if name]
+    if names:
+        storage = _storage()
+        transaction.on_commit(lambda: [storage.delete(name) for name in names])
+
+
+def _save_thumbnail(preview, data):
+    """Stores thumbnail bytes for `preview` (not saved), replacing its file once the transaction commits."""
+    old_name = preview.thumbnail.name
+    preview.thumbnail.save('thumbnail.webp', ContentFile(data), save=False)
+    preview.thumbnail_size = len(data)
+    if old_name != preview.thumbnail.name:
+        _delete_on_commit([old_name])
+
+
+def _content_type(blob):
+    return blob.content_type or sniff_content_type(blob.file_content.path, blob.file_content.name)
+
+
+def store_preview(blob, text, thumbnail):
+    """Creates or replaces the preview of a blob; `thumbnail` is WebP bytes, or None if there is none."""
+    preview = Preview.objects.filter(blob=blob).first() or Preview(blob=blob)
+    preview.text = text
+    preview.version = PREVIEW_VERSION
+    preview.last_accessed = timezone.now()
+    preview.has_thumbnail = thumbnail is not None
+    if thumbnail is not None:
+        _save_thumbnail(preview, thumbnail)
+    else:
+        _delete_on_commit([preview.thumbnail.name])
+        preview.thumbnail, preview.thumbnail_size = '', 0
+    preview.save()
+    transaction.on_commit(maybe_evict)
+
+
+def build_preview(blob):
+    """Makes a blob's preview from its stored text and content, e.g. for files ingested before previews existed."""
+    stored = ExtractedText.objects.filter(blob=blob).first()
+    lead = ''
+    if stored is not None:
+        for chunk in stored.chunks():
+            lead = extend_lead(lead, chunk, getattr(settings, 'PREVIEW_TEXT_LENGTH', 1000))
+            break  # The first chunk is far longer than the lead
+    store_preview(blob, lead, render_thumbnail(blob.file_content.path, _content_type(blob)))
+
+
+# --- Snippets ----------------------------------------------------------------
+
+def term_marks(words, prefixes=()):
+    """Pattern finding the words to mark in snippets, or None: `words` and their inflections, and `prefixes`.
+
+    Inflections are approximated as up to SUFFIX_SLACK more letters ("invoice"
+    also marks "invoices"), which a single regular expression can match
+    without tagging the snippet.
+    """
+    alternatives = [
+        re.escape(word) + (rf"\w{{0,{SUFFIX_SLACK}}}" if len(word) > 2 else "")
+        for word in sorted(words, key=len, reverse=True)
+    ]
+    alternatives.extend(re.escape(prefix) + r"\w*" for prefix in sorted(prefixes))
+    if not alternatives:
+        return None
+    return re.compile(r"\b(?:" + "|".join(alternatives) + r")\b", re.IGNORECASE)
+
+
+def query_marks(query, advanced=False):
+    """`term_marks` of a query: its words and `prefix*` terms.
+
+    A plain query's lemmas are marked as well; those of an `advanced` query
+    (see `query.is_advanced`) are left out rather than computed again.
+    """
+    words, prefixes = set(), set()
+    for token in QUERY_WORD_RE.findall(query):
+        if token in ('AND', 'OR', 'NOT'):
+            continue
+        if token.endswith('*') and token.rstrip('*'):
+            prefixes.add(token.rstrip('*').lower())
+        elif token.strip('*'):
+            words.add(token.strip('*').lower())
+    if not advanced:
+        words.update(search_cache.query_terms(query))  # Memoized when the query was ranked
+    return term_marks(words, prefixes)
+
+
+def snippet(text, marks, length=None):
+    """HTML excerpt of about `length` (default `PREVIEW_SNIPPET_LENGTH`) characters of `text`.
+
+    The excerpt is the stretch with the most words matching `marks` (see
+    `term_marks`), which are wrapped in `<mark>`; without any, it is the
+    start of the text.
+    """
+    if not text:
+        return ''
+    length = length or getattr(settings, 'PREVIEW_SNIPPET_LENGTH', 200)
+    hits = [match.span() for match in marks.finditer(text)] if marks is not None else []
+
+    start = 0
+    if hits:
+        # The window starting a little before some match that covers the most matches
+        best = 0
+        last = 0
+        for first, (hit_start, _) in enumerate(hits):
+            while last < len(hits) and hits[last][1] <= hit_start + length:
+                last += 1
+            if last - first > best:
+                best, start = last - first, hit_start
+        start = max(0, start - length // 5)
+    if start > 0:
+        space = text.find(' ', start)
+        start = space + 1 if 0 <= space < start + length // 5 else start
+    end = min(len(text), start + length)
+    if end < len(text):
+        space = text.rfind(' ', start, end)
+        end = space if space > start else end
+
+    parts = ["…" if start > 0 else ""]
+    position = start
+    for hit_start, hit_end in hits:
+        if hit_start >= start and hit_end <= end:
+            parts.append(escape(text[position:hit_start]))
+            parts.append(f"<mark>{escape(text[hit_start:hit_end])}</mark>")
+            position = hit_end
+    parts.append(escape(text[position:end]))
+    parts.append("…" if end < len(text) else "")
+    return mark_safe("".join(parts))
+
+
+# --- Thumbnails ----------------------------------------------------------------
+
+def _token(content_hash, version):
+    return f"{content_hash[:16]}.{version}"
+
+
+def thumbnail_url(file_id, content_hash, version):
+    """Versioned URL of a file's thumbnail; it changes whenever the image behind it would."""
+    return f"{reverse('preview_thumbnail', args=[file_id])}?v={_token(content_hash, version)}"
+
+
+def _touch(preview):
+    """Moves a preview to the recent end of the eviction order, at most once per PREVIEW_TOUCH_INTERVAL."""
+    now = timezone.now()
+    if now - preview.last_accessed >= timedelta(seconds=getattr(settings, 'PREVIEW_TOUCH_INTERVAL', 3600)):
+        Preview.objects.filter(blob_id=preview.blob_id).update(last_accessed=now)
+
+
+def _thumbnail_bytes(preview, blob):
+    """The stored thumbnail, rendered again (and stored) if it was evicted; None if it can't be rendered."""
+    if preview.thumbnail.name:
+        try:
+            with preview.thumbnail.open('rb') as f:
+                metrics.count('preview_thumbnails', outcome='hit')
+                return f.read()
+        except FileNotFoundError:
+            pass  # Evicted by another process since the row was read
+    metrics.count('preview_thumbnails', outcome='miss')
+    data = render_thumbnail(blob.file_content.path, _content_type(blob))
+    with transaction.atomic():
+        if data is None:
+            Preview.objects.filter(blob_id=preview.blob_id).update(has_thumbnail=False)
+            return None
+        _save_thumbnail(preview, data)
+        preview.last_accessed = timezone.now()
+        preview.save(update_fields=['thumbnail', 'thumbnail_size', 'last_accessed'])
+        transaction.on_commit(maybe_evict)
+    return data
+
+
+def serve_thumbnail(request, blob):
+    """Response with the thumbnail of `blob`.
+
+    Under the URL from `thumbnail_url` it may be cached for PREVIEW_MAX_AGE
+    seconds without revalidation; under any other (an older version, or no
+    `v`), browsers have to revalidate it. Revalidations are answered with 304.
+    """
+    preview = Preview.objects.filter(blob=blob).first()
+    if preview is None or not preview.has_thumbnail:
+        raise Http404("No thumbnail for this file.")
+    token = _token(blob.content_hash, preview.version)
+    etag = f'"{token}"'
+    if request.GET.get('v') == token:
+        cache_control = f"public, max-age={getattr(settings, 'PREVIEW_MAX_AGE', 365 * 24 * 60 * 60)}, immutable"
+    else:
+        cache_control = 'public, no-cache'
+
+    _touch(preview)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        data = _thumbnail_bytes(preview, blob)
+        if data is None:
+            raise Http404("No thumbnail for this file.")
+        response = HttpResponse(data, content_type=THUMBNAIL_CONTENT_TYPE)
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    return response
+
+
+# --- Eviction ------------------------------------------------------------------
+
+def cache_size():
+    """`(thumbnails, bytes)` currently stored."""
+    totals = Preview.objects.filter(thumbnail_size__gt=0).aggregate(count=Count('blob_id'), size=Sum('thumbnail_size'))
+    return totals['count'] or 0, totals['size'] or 0
+
+
+def evict(max_bytes=None, batch_size=500, dry_run=False):
+    """Deletes the least recently served thumbnails while they take more than `max_bytes`.
+
+    `max_bytes` defaults to PREVIEW_CACHE_MAX_BYTES; once over it, eviction
+    goes down to PREVIEW_CACHE_LOW_WATER of it, so it doesn't run again on
+    the next thumbnail stored. Returns the number of thumbnails and bytes
+    evicted.
+    """
+    max_bytes = getattr(settings, 'PREVIEW_CACHE_MAX_BYTES', 512 * 1024 * 1024) if max_bytes is None else max_bytes
+    _, size = cache_size()
+    if size <= max_bytes:
+        return 0, 0
+    excess = size - int(max_bytes * getattr(settings, 'PREVIEW_CACHE_LOW_WATER', 0.9))
+    stored = Preview.objects.filter(thumbnail_size__gt=0).order_by('last_accessed', 'blob_id')
+    evicted = freed = 0
+    if dry_run:
+        for thumbnail_size in stored.values_list('thumbnail_size', flat=True).iterator():
+            if freed >= excess:
+                break
+            evicted += 1
+            freed += thumbnail_size
+        return evicted, freed
+    while freed < excess:
+        with transaction.atomic():
+            rows = list(stored.select_for_update().values_list('blob_id', 'thumbnail', 'thumbnail_size')[:batch_size])
+            if not rows:
+                break
+            chosen = []
+            for blob_id, name, thumbnail_size in rows:
+                if freed >= excess:
+                    break
+                chosen.append((blob_id, name))
+                freed += thumbnail_size
+            Preview.objects.filter(blob_id__in=[blob_id for blob_id, _ in chosen]).update(thumbnail='', thumbnail_size=0)
+            _delete_on_commit([name for _, name in chosen])
+        evicted += len(chosen)
+    metrics.count('preview_evictions', evicted)
+    return evicted, freed
+
+
+def maybe_evict():
+    """Runs `evict` if this process hasn't in the last PREVIEW_EVICT_INTERVAL seconds."""
+    global _last_eviction
+    now = time.monotonic()
+    if now - _last_eviction < getattr(settings, 'PREVIEW_EVICT_INTERVAL', 60):
+        return
+    _last_eviction = now
+    evict()
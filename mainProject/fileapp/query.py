@@ -0,0 +1,477 @@
+"""Search query language: boolean operators, quoted phrases and prefixes.
+
+    budget report               either word (or both: SEARCH_DEFAULT_OPERATOR)
+    budget AND report           both words
+    budget NOT draft            budget, but not draft; also written budget -draft
+    "annual report"             the words next to each other, in this order
+    report*                     any tag starting with "report"
+    (budget OR forecast) AND "annual report"
+
+AND binds tighter than OR, and operators must be capitalized, so "and", "or"
+and "not" in ordinary text stay words. Unbalanced quotes and parentheses are
+closed at the end of the query rather than rejected, but an operator without
+an operand ("budget AND AND report", "report OR") or a stray closing
+parenthesis raises `QuerySyntaxError`.
+
+Queries run over posting lists instead of one ranking query per search: the
+document frequency of every tag involved is read once, the operands of an AND
+are evaluated rarest first, and each further operand only fetches its
+postings for the files still in the running intersection (none at all once
+it is empty); plain words among the alternatives of an OR, or after the
+first operand of an AND, share one posting query. Phrases are checked
+against the token positions stored with each posting. Matches get the same
+BM25 score as plain searches. The best `SEARCH_RANKED_HITS` hits are cached,
+so further pages don't evaluate the query again.
+"""
+import heapq
+import re
+from bisect import bisect_right
+from collections import Counter
+from functools import lru_cache
+
+from django.conf import settings
+from django.db.models import Avg, Count
+
+from . import search, search_cache, tag_cache
+from .models import File, FileTag, Tag
+from .nlp import get_nlp, tag_positions
+from .positions import decode_positions
+
+TOKEN_RE = re.compile(r'(?P<phrase>-?"[^"]*"?)|(?P<paren>-?\(|\))|(?P<word>[^\s()"]+)')
+ADVANCED_RE = re.compile(r'["()*]|(?:^|\s)-\S|\b(?:AND|OR|NOT)\b')
+RESTRICT_BATCH = 500  # Candidate file ids per IN query when fetching postings for a running intersection
+RESTRICT_RATIO = 8  # Fetch by candidate ids when they are this many times fewer than the postings
+
+
+class QuerySyntaxError(ValueError):
+    """A malformed advanced query; the message says what is wrong."""
+
+
+def is_advanced(query):
+    """Whether a query uses any operator, phrase or prefix (plain queries keep the SQL-ranked path)."""
+    return bool(ADVANCED_RE.search(query))
+
+
+# --- Parsing -----------------------------------------------------------------
+
+def _tokens(query):
+    for match in TOKEN_RE.finditer(query):
+        kind = match.lastgroup
+        text = match.group()
+        if len(text) > 1 and text.startswith('-'):
+            yield ('-', '-')
+            text = text[1:]
+        if kind == 'phrase':
+            yield ('phrase', text.strip('"'))
+        elif kind == 'paren':
+            yield (text, text)
+        elif text in ('AND', 'OR', 'NOT'):
+            yield (text, text)
+        elif text.endswith('*') and text.rstrip('*'):
+            yield ('prefix', text.rstrip('*').lower())
+        elif text.strip('*-'):
+            yield ('word', text)
+
+
+class _Parser:
+    """Recursive descent over the tokens; produces nested tuples such as `('and', [...])`."""
+
+    def __init__(self, query):
+        self.tokens = list(_tokens(query))
+        self.position = 0
+        self.default_and = getattr(settings, 'SEARCH_DEFAULT_OPERATOR', 'OR').upper() == 'AND'
+
+    def peek(self):
+        return self.tokens[self.position][0] if self.position < len(self.tokens) else None
+
+    def take(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def expected_operand(self):
+        before = f"after {self.tokens[self.position - 1][1]}" if self.position else "at the start of the query"
+        found = f"found {self.peek() if self.peek() != 'word' else 'a word'}" if self.peek() else "the query ends"
+        return QuerySyntaxError(f"Expected a word, phrase or group {before}, but {found}.")
+
+    def starts_operand(self):
+        return self.peek() in ('word', 'phrase', 'prefix', '(', '-', 'NOT')
+
+    def parse(self):
+        operands = []
+        while self.position < len(self.tokens):
+            operands.append(self.parse_or())
+            if self.peek() == ')':
+                raise QuerySyntaxError("Closing parenthesis without an opening one.")
+        return self.combine('or', operands)
+
+    @staticmethod
+    def combine(kind, operands):
+        operands = [operand for operand in operands if operand is not None]
+        if not operands:
+            return None
+        return operands[0] if len(operands) == 1 else (kind, operands)
+
+    def parse_or(self):
+        operands = [self.parse_and()]
+        while self.peek() == 'OR' or (not self.default_and and self.starts_operand()):
+            if self.peek() == 'OR':
+                self.take()
+            operands.append(self.parse_and())
+        # A negation on its own among alternatives ("budget report -draft") excludes from all of them
+        excluded = [operand for operand in operands if operand is not None and operand[0] == 'not']
+        alternatives = self.combine('or', [operand for operand in operands if operand not in excluded])
+        if not excluded:
+            return alternatives
+        return ('and', [alternatives] + excluded) if alternatives is not None else excluded[0]
+
+    def parse_and(self):
+        operands = [self.parse_unary()]
+        while self.peek() in ('AND', 'NOT') or (self.default_and and self.starts_operand()):
+            if self.peek() == 'AND':
+                self.take()
+            operands.append(self.parse_unary())
+        return self.combine('and', operands)
+
+    def parse_unary(self):
+        kind = self.peek()
+        if kind in ('NOT', '-'):
+            self.take()
+            return ('not', self.parse_unary())
+        if kind == '(':
+            self.take()
+            node = self.parse_or()
+            if self.peek() == ')':
+                self.take()
+            return node
+        if kind in ('word', 'phrase', 'prefix'):
+            return self.take()
+        raise self.expected_operand()  # End of the query, a closing parenthesis or another operator
+
+
+def parse(query):
+    """Syntax tree of a query, or None if it has no operand; raises `QuerySyntaxError` if it is malformed."""
+    return _Parser(query).parse()
+
+
+# --- Plan --------------------------------------------------------------------
+
+@lru_cache(maxsize=getattr(settings, 'SEARCH_QUERY_CACHE_SIZE', 1024))
+def _lemmas(text):
+    """`(lemma, position)` pairs of a query word or phrase, tagged like documents are."""
+    return tuple(tag_positions(get_nlp()(text)))
+
+
+class TermNode:
+    def __init__(self, lemma):
+        self.lemma = lemma
+
+    def lemmas(self):
+        return {self.lemma}
+
+    def prefixes(self):
+        return set()
+
+    def cost(self, index):
+        return index.doc_freq(index.tag_ids.get(self.lemma))
+
+    def evaluate(self, index, candidates):
+        tag_id = index.tag_ids.get(self.lemma)
+        if tag_id is None:
+            return {}
+        return {file_id: index.weight(tag_id, frequency, length) for file_id, tag_id, frequency, length in index.postings([tag_id], candidates)}
+
+
+class PrefixNode:
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def lemmas(self):
+        return set()
+
+    def prefixes(self):
+        return {self.prefix}
+
+    def cost(self, index):
+        return sum(index.doc_freq(tag_id) for tag_id in index.expansions[self.prefix])
+
+    def evaluate(self, index, candidates):
+        scores = {}
+        for file_id, tag_id, frequency, length in index.postings(index.expansions[self.prefix], candidates):
+            scores[file_id] = scores.get(file_id, 0.0) + index.weight(tag_id, frequency, length)
+        return scores
+
+
+class PhraseNode:
+    """Lemmas at fixed distances from each other: `terms` is a list of `(lemma, offset)`."""
+
+    def __init__(self, terms):
+        self.terms = terms
+
+    def lemmas(self):
+        return {lemma for lemma, _ in self.terms}
+
+    def prefixes(self):
+        return set()
+
+    def cost(self, index):
+        return min(index.doc_freq(index.tag_ids.get(lemma)) for lemma in self.lemmas())
+
+    def evaluate(self, index, candidates):
+        lemmas = sorted(self.lemmas(), key=lambda lemma: index.doc_freq(index.tag_ids.get(lemma)))
+        if any(lemma not in index.tag_ids for lemma in lemmas):
+            return {}
+        # Files containing every lemma, rarest first, with each lemma's weight and positions
+        found = None
+        for lemma in lemmas:
+            tag_id = index.tag_ids[lemma]
+            postings = {
+                file_id: (index.weight(tag_id, frequency, length), positions)
+                for file_id, _, frequency, length, positions in index.postings([tag_id], candidates if found is None else found, positions=True)
+            }
+            if found is None:
+                found = {file_id: [posting] for file_id, posting in postings.items()}
+            else:
+                found = {file_id: found[file_id] + [posting] for file_id, posting in postings.items() if file_id in found}
+            if not found:
+                return {}
+
+        anchor_lemma, anchor_offset = min(self.terms, key=lambda term: lemmas.index(term[0]))
+        others = [(lemmas.index(lemma), offset - anchor_offset) for lemma, offset in self.terms if (lemma, offset) != (anchor_lemma, anchor_offset)]
+        anchor = lemmas.index(anchor_lemma)
+        scores = {}
+        for file_id, postings in found.items():
+            positions = [set(decode_positions(data)) for _, data in postings]
+            if any(all(start + distance in positions[other] for other, distance in others) for start in positions[anchor]):
+                scores[file_id] = sum(weight for weight, _ in postings)
+        return scores
+
+
+def _term_postings(index, terms, candidates):
+    """`{file_id: (score, tags matched)}` over the postings of several term nodes, fetched in one query.
+
+    A lemma given more than once counts once per occurrence, as it would
+    if each node were evaluated on its own.
+    """
+    occurrences = Counter(index.tag_ids[term.lemma] for term in terms if term.lemma in index.tag_ids)
+    found = {}
+    for file_id, tag_id, frequency, length in index.postings(list(occurrences), candidates):
+        score, matched = found.get(file_id, (0.0, 0))
+        found[file_id] = (score + index.weight(tag_id, frequency, length) * occurrences[tag_id], matched + 1)
+    return found
+
+
+class AndNode:
+    def __init__(self, positives, negatives):
+        self.positives = positives
+        self.negatives = negatives
+
+    def lemmas(self):
+        return set().union(*(child.lemmas() for child in self.positives + self.negatives))
+
+    def prefixes(self):
+        return set().union(*(child.prefixes() for child in self.positives + self.negatives))
+
+    def cost(self, index):
+        return min(child.cost(index) for child in self.positives)
+
+    def evaluate(self, index, candidates):
+        children = sorted(self.positives, key=lambda child: child.cost(index))
+        # After the rarest operand, the plain terms among the others are fetched in one query
+        terms = [child for child in children[1:] if isinstance(child, TermNode)]
+        if len(terms) < 2:
+            terms = []
+        result = None
+        for child in children:
+            if child in terms:
+                continue
+            scores = child.evaluate(index, candidates if result is None else result)
+            if result is None:
+                result = scores
+                if result and terms:
+                    wanted = len({index.tag_ids.get(term.lemma) for term in terms})
+                    found = _term_postings(index, terms, result)
+                    result = {file_id: result[file_id] + score for file_id, (score, matched) in found.items() if matched == wanted}
+            else:
+                result = {file_id: result[file_id] + score for file_id, score in scores.items() if file_id in result}
+            if not result:
+                return {}
+        for child in self.negatives:
+            for file_id in child.evaluate(index, result):
+                del result[file_id]
+            if not result:
+                break
+        return result
+
+
+class OrNode:
+    def __init__(self, children):
+        self.children = children
+
+    def lemmas(self):
+        return set().union(*(child.lemmas() for child in self.children))
+
+    def prefixes(self):
+        return set().union(*(child.prefixes() for child in self.children))
+
+    def cost(self, index):
+        return sum(child.cost(index) for child in self.children)
+
+    def evaluate(self, index, candidates):
+        terms = [child for child in self.children if isinstance(child, TermNode)]
+        result = {file_id: score for file_id, (score, _) in _term_postings(index, terms, candidates).items()} if terms else {}
+        for child in self.children:
+            if child in terms:
+                continue
+            for file_id, score in child.evaluate(index, candidates).items():
+                result[file_id] = result.get(file_id, 0.0) + score
+        return result
+
+
+def _word_node(text):
+    terms = _lemmas(text)
+    if not terms:
+        return None  # Only stop words or punctuation
+    if len(terms) == 1:
+        return TermNode(terms[0][0])
+    return PhraseNode(list(terms))
+
+
+def plan(tree):
+    """Turns a syntax tree into executable nodes; None if nothing in it can match.
+
+    Negations only exclude files from an AND: a NOT that isn't combined with
+    anything to match can't be answered from postings, and matches nothing.
+    """
+    if tree is None:
+        return None
+    kind = tree[0]
+    if kind in ('word', 'phrase'):
+        return _word_node(tree[1])
+    if kind == 'prefix':
+        return PrefixNode(tree[1])
+    if kind == 'not':
+        return None
+    if kind == 'or':
+        children = [plan(child) for child in tree[1]]
+        children = [child for child in children if child is not None]
+        if not children:
+            return None
+        return children[0] if len(children) == 1 else OrNode(children)
+    positives, negatives = [], []
+    for child in tree[1]:
+        if child[0] == 'not':
+            node = plan(child[1])
+            if node is not None:
+                negatives.append(node)
+        else:
+            node = plan(child)
+            if node is not None:
+                positives.append(node)
+    if not positives:
+        return None
+    if len(positives) == 1 and not negatives:
+        return positives[0]
+    return AndNode(positives, negatives)
+
+
+# --- Execution ---------------------------------------------------------------
+
+class PostingIndex:
+    """Tag ids, document frequencies and BM25 statistics for one query, read up front."""
+
+    def __init__(self, lemmas, prefixes):
+        self.k1 = getattr(settings, 'SEARCH_BM25_K1', 1.2)
+        self.b = getattr(settings, 'SEARCH_BM25_B', 0.75)
+        prefix_limit = getattr(settings, 'SEARCH_PREFIX_MAX_TERMS', 100)
+        self.tag_ids = tag_cache.lookup(lemmas) if lemmas else {}
+        self.doc_freqs = dict(
+            Tag.objects.filter(id__in=self.tag_ids.values(), doc_freq__gt=0).values_list('id', 'doc_freq')
+        ) if self.tag_ids else {}
+        self.expansions = {}
+        for prefix in prefixes:
+            expanded = list(
+                Tag.objects.filter(tag_name__startswith=prefix, doc_freq__gt=0)
+                .order_by('-doc_freq', 'tag_name')  # The most common expansions, if there are more than the limit
+                .values_list('id', 'doc_freq')[:prefix_limit]
+            )
+            self.expansions[prefix] = [tag_id for tag_id, _ in expanded]
+            self.doc_freqs.update(expanded)
+        corpus = File.objects.filter(ingest_status=File.IngestStatus.DONE).aggregate(
+            doc_count=Count('id'),
+            avg_length=Avg('token_count'),
+        )
+        self.avg_length = corpus['avg_length'] or 1.0
+        self.idf = {tag_id: search.bm25_idf(corpus['doc_count'], df) for tag_id, df in self.doc_freqs.items()}
+
+    def doc_freq(self, tag_id):
+        return self.doc_freqs.get(tag_id, 0)
+
+    def weight(self, tag_id, frequency, length):
+        """BM25 contribution of one posting."""
+        norm = self.k1 * (1 - self.b + self.b * length / self.avg_length)
+        return self.idf[tag_id] * frequency * (self.k1 + 1) / (frequency + norm)
+
+    def postings(self, tag_ids, candidates, positions=False):
+        """Yields `(file_id, tag_id, frequency, token_count[, positions])` for the tags, limited to `candidates` if given.
+
+        A small candidate set is looked up by file id; otherwise the whole
+        posting list is read in index order and filtered here.
+        """
+        tag_ids = [tag_id for tag_id in tag_ids if tag_id in self.doc_freqs]
+        if not tag_ids or (candidates is not None and not candidates):
+            return
+        fields = ['file_id', 'tag_id', 'frequency', 'file__token_count'] + (['positions'] if positions else [])
+        postings = FileTag.objects.filter(tag_id__in=tag_ids).values_list(*fields)
+        if candidates is not None and len(candidates) * RESTRICT_RATIO < sum(self.doc_freqs[tag_id] for tag_id in tag_ids):
+            file_ids = sorted(candidates)
+            for start in range(0, len(file_ids), RESTRICT_BATCH):
+                yield from postings.filter(file_id__in=file_ids[start:start + RESTRICT_BATCH])
+            return
+        for row in postings.order_by('tag_id', 'file_id').iterator(chunk_size=5000):
+            if candidates is None or row[0] in candidates:
+                yield row
+
+
+def _scores(query):
+    """BM25 score of every file matching a query."""
+    node = plan(parse(query))
+    if node is None:
+        return {}
+    index = PostingIndex(node.lemmas(), node.prefixes())
+    return node.evaluate(index, None)
+
+
+def _ranked_hits(query):
+    """The best `SEARCH_RANKED_HITS` `(file_id, score)` hits of a query, best first, and the hit count.
+
+    They are kept in the search cache, so the pages after the first are cut
+    from them instead of matching and scoring every file again.
+    """
+    key = search_cache.results_key(['\0' + query], 'ranked', 0)
+    cached = search_cache.get_results(key)
+    if cached is None:
+        scores = _scores(query)
+        limit = getattr(settings, 'SEARCH_RANKED_HITS', 1000)
+        cached = heapq.nlargest(limit, scores.items(), key=lambda hit: (hit[1], hit[0])), {'value': len(scores), 'relation': 'eq'}
+        search_cache.set_results(key, cached)
+    return cached
+
+
+def rank(query, after, page_size):
+    """`page_size + 1` `(file_id, score)` hits of an advanced query ranked below `after`, and the hit count.
+
+    Returns the same shape as the plain search ranking, so both share
+    pagination and caching. Raises `QuerySyntaxError` for a malformed query.
+    """
+    hits, total = _ranked_hits(query)
+    if after is None:
+        return hits[:page_size + 1], total
+    score, file_id = after
+    start = bisect_right(hits, (-score, -file_id), key=lambda hit: (-hit[1], -hit[0]))
+    page = hits[start:start + page_size + 1]
+    if len(page) > page_size or len(hits) == total['value']:
+        return page, total
+    # Paged past the kept hits: score every match again
+    below = [(hit_id, hit_score) for hit_id, hit_score in _scores(query).items() if hit_score < score or (hit_score == score and hit_id < file_id)]
+    return heapq.nlargest(page_size + 1, below, key=lambda hit: (hit[1], hit[0])), total
@@ -0,0 +1,72 @@
+"""Incremental re-tagging from stored text, used by the `reindex_tags` command.
+
+Files whose `tagger_version` differs from `NLP_TAGGER_VERSION` are read in
+keyset-paginated batches (`id > last id`, never OFFSET, so each batch costs
+the same however far into the table it is). The stored text of each distinct
+blob in a batch is re-tagged once in the process pool, and a batch's tags,
+token counts and versions are replaced in one transaction.
+"""
+from django.db import transaction
+from django.db.models import Q
+
+from . import search_cache
+from .extraction import EXTRACTOR_VERSION
+from .ingest import enqueue_ingest
+from .models import ExtractedText, File
+from .nlp import generate_tag_positions, tagger_version
+from .tags import delete_tags, save_tags_for_files, token_count
+from .text_store import iter_text_chunks
+
+
+def stale_files(batch_size, reextract=False, after_id=0):
+    """Yields batches of `(file_id, blob_id)` for indexed files needing work.
+
+    Files are stale when their tags come from another tagger version, or, with
+    `reextract`, from text of another extractor version.
+    """
+    stale = ~Q(tagger_version=tagger_version())
+    if reextract:
+        stale |= ~Q(extractor_version=EXTRACTOR_VERSION)
+    files = File.objects.filter(stale, ingest_status=File.IngestStatus.DONE).order_by('id')
+    while True:
+        batch = list(files.filter(id__gt=after_id).values_list('id', 'blob_id')[:batch_size])
+        if not batch:
+            return
+        yield batch
+        after_id = batch[-1][0]
+
+
+def stored_texts(blob_ids):
+    """Maps blob ids to `(compressed text, extractor_version)` for the blobs whose text is stored."""
+    return {
+        blob_id: (bytes(data), extractor_version)
+        for blob_id, data, extractor_version in ExtractedText.objects.filter(blob_id__in=blob_ids).values_list(
+            'blob_id', 'data', 'extractor_version'
+        )
+    }
+
+
+def retag_text(data):
+    """Pool task: tags, with their positions, of a stored (compressed) text."""
+    return generate_tag_positions(iter_text_chunks(data))
+
+
+def write_retagged(retagged):
+    """Replaces the tags of `(file_id, tag_positions, extractor_version)` entries, `extractor_version` being the stored text's."""
+    version = tagger_version()
+    files_and_positions = [
+        (File(id=file_id, token_count=token_count(tag_positions), extractor_version=extractor_version, tagger_version=version), tag_positions)
+        for file_id, tag_positions, extractor_version in retagged
+    ]
+    files = [file_instance for file_instance, _ in files_and_positions]
+    with transaction.atomic():
+        delete_tags([file_instance.id for file_instance in files])
+        save_tags_for_files(files_and_positions)
+        File.objects.bulk_update(files, ['token_count', 'extractor_version', 'tagger_version'])
+    search_cache.invalidate()
+
+
+def queue_reextraction(file_ids):
+    """Sends files back to the ingestion worker, which extracts, stores and tags their text again."""
+    for file_id in file_ids:
+        enqueue_ingest(File(id=file_id))
@@ -0,0 +1,247 @@
+"""Ranked tag search over the `FileTag` posting lists.
+
+Scoring is Okapi BM25 computed inside the database: one grouped query over the
+postings of the query's tags returns the already ranked file ids, so the
+number of round trips no longer grows with the number of tags or hits.
+
+Results are paged with a keyset cursor rather than an offset: the cursor
+holds the `(score, file_id)` of the last hit shown, and the next page is the
+hits ranked strictly below it, so the database never ranks and skips the
+pages before it. Hits are returned as lean dicts (see `SearchResults`), and
+the total is exact only up to `SEARCH_COUNT_LIMIT` (see `_count_hits`).
+"""
+import math
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Avg, Case, Count, FloatField, Sum, Value, When
+from django.db.models.functions import Cast
+
+from . import query as query_language
+from . import metrics, previews, search_cache, tag_cache
+from .models import File, FileTag, Tag
+
+TIE_SLACK = 16  # Extra rows fetched past a cursor to skip files scored the same as the last hit shown
+
+
+class SearchResults:
+    """One page of ranked search hits.
+
+    `files` are `{'id', 'file_name', 'score', 'snippet', 'thumbnail'}` dicts,
+    the last two from the file's preview (an HTML excerpt with the query's
+    words marked, and the thumbnail's URL or None); `total` is
+    `{'value': n, 'relation': 'eq' | 'gte'}`, 'gte' meaning there are at least
+    `n` hits.
+    """
+
+    def __init__(self, files, total, next_cursor, page_size):
+        self.files = files
+        self.total = total
+        self.next_cursor = next_cursor
+        self.page_size = page_size
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def as_dict(self):
+        return {'results': self.files, 'total': self.total, 'next_cursor': self.next_cursor}
+
+
+def encode_cursor(score, file_id):
+    """Opaque cursor pointing just after the hit `(score, file_id)`."""
+    return urlsafe_b64encode(f"{score!r}:{file_id}".encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """`(score, file_id)` of a cursor; raises ValueError if it is malformed."""
+    decoded = urlsafe_b64decode(cursor.encode('ascii') + b'=' * (-len(cursor) % 4)).decode('ascii')
+    score, _, file_id = decoded.partition(':')
+    return float(score), int(file_id)
+
+
+def bm25_idf(doc_count, doc_freq):
+    """BM25 inverse document frequency (the non-negative "plus one" variant)."""
+    return math.log(1 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+
+
+def _count_hits(postings, doc_freqs):
+    """Number of files matching any of the tags, counted exactly only up to `SEARCH_COUNT_LIMIT`.
+
+    A single tag's document frequency is already the exact count; for more
+    tags, the largest one is a lower bound, and the distinct count stops after
+    the limit instead of visiting every posting of a common word.
+    """
+    limit = getattr(settings, 'SEARCH_COUNT_LIMIT', 10_000)
+    largest = max(doc_freqs.values())
+    if len(doc_freqs) == 1:
+        return {'value': largest, 'relation': 'eq'}
+    if largest >= limit:
+        return {'value': largest, 'relation': 'gte'}
+    hits = postings.values('file_id').distinct()[:limit + 1].count()
+    if hits > limit:
+        return {'value': limit, 'relation': 'gte'}
+    return {'value': hits, 'relation': 'eq'}
+
+
+def _rank(tag_names, after, page_size):
+    """BM25-ranked `(file_id, score)` pairs following the hit `after` (None for the first page),
+    one more than `page_size` to tell whether there is a next page, and the hit count."""
+    k1 = getattr(settings, 'SEARCH_BM25_K1', 1.2)
+    b = getattr(settings, 'SEARCH_BM25_B', 0.75)
+
+    tag_ids = tag_cache.lookup(tag_names)
+    doc_freqs = dict(
+        Tag.objects.filter(id__in=tag_ids.values(), doc_freq__gt=0).values_list('id', 'doc_freq')
+    ) if tag_ids else {}
+    if not doc_freqs:
+        return [], {'value': 0, 'relation': 'eq'}
+
+    corpus = File.objects.filter(ingest_status=File.IngestStatus.DONE).aggregate(
+        doc_count=Count('id'),
+        avg_length=Avg('token_count'),
+    )
+    doc_count = corpus['doc_count']
+    avg_length = corpus['avg_length'] or 1.0
+
+    idf = Case(
+        *[When(tag_id=tag_id, then=Value(bm25_idf(doc_count, df))) for tag_id, df in doc_freqs.items()],
+        output_field=FloatField(),
+    )
+    tf = Cast('frequency', FloatField())
+    length_norm = Value(k1) * (Value(1 - b) + Value(b) * Cast('file__token_count', FloatField()) / Value(avg_length))
+    postings = FileTag.objects.filter(tag_id__in=doc_freqs)
+
+    ranked = (
+        postings
+        .values('file_id')
+        .annotate(score=Sum(idf * tf * Value(k1 + 1) / (tf + length_norm)))
+        .order_by('-score', '-file_id')
+        .values_list('file_id', 'score')
+    )
+    if after is None:
+        return list(ranked[:page_size + 1]), _count_hits(postings, doc_freqs)
+    return _rank_after(ranked, after, page_size), _count_hits(postings, doc_freqs)
+
+
+def _rank_after(ranked, after, page_size):
+    """The `page_size + 1` hits ranked below `after`.
+
+    The HAVING clause repeats the whole score expression for every condition,
+    so only `score <= last score` is left to the database (one more evaluation
+    per file instead of three for the exact tuple comparison). Files tied with
+    the last hit that were already shown head the result and are dropped
+    here; in the rare case of more ties than the slack, the query is repeated
+    with a larger limit.
+    """
+    score, file_id = after
+    below = ranked.filter(score__lte=score)  # HAVING, after grouping
+    limit = page_size + 1 + TIE_SLACK
+    while True:
+        rows = list(below[:limit])
+        page = [row for row in rows if row[1] < score or row[0] < file_id]
+        if len(page) > page_size or len(rows) < limit:
+            return page[:page_size + 1]
+        limit *= 4
+
+
+def _page_rows(ranked, page_size):
+    """Query for the names and previews of the page's files (only those)."""
+    return File.objects.filter(id__in=[file_id for file_id, _ in ranked[:page_size]]).values_list(
+        'id', 'file_name', 'blob__content_hash', 'blob__preview__text', 'blob__preview__has_thumbnail',
+        'blob__preview__version',
+    )
+
+
+def _load_page(ranked, total, page_size, marks):
+    """Fetches only the names and previews of the page's files and pairs them with their scores."""
+    return _build_page(ranked, total, page_size, {row[0]: row for row in _page_rows(ranked, page_size)}, marks)
+
+
+async def _aload_page(ranked, total, page_size, marks):
+    """`_load_page` through the async ORM."""
+    rows = {row[0]: row async for row in _page_rows(ranked, page_size)}
+    return _build_page(ranked, total, page_size, rows, marks)
+
+
+def _hit(row, score, marks):
+    file_id, file_name, content_hash, text, has_thumbnail, version = row
+    return {
+        'id': file_id,
+        'file_name': file_name,
+        'score': score,
+        'snippet': previews.snippet(text, marks),
+        'thumbnail': previews.thumbnail_url(file_id, content_hash, version) if has_thumbnail else None,
+    }
+
+
+def _build_page(ranked, total, page_size, rows, marks):
+    page = ranked[:page_size]
+    files = [
+        _hit(rows[file_id], score, marks)
+        for file_id, score in page
+        if file_id in rows  # Deleted between the two queries
+    ]
+    next_cursor = encode_cursor(page[-1][1], page[-1][0]) if len(ranked) > page_size else None
+    return SearchResults(files, total, next_cursor, page_size)
+
+
+def rank_files(tag_names, cursor=None, page_size=None):
+    """Ranks files by their BM25 score for the given tags and returns the page after `cursor`."""
+    page_size = page_size or getattr(settings, 'SEARCH_PAGE_SIZE', 20)
+    after = decode_cursor(cursor) if cursor else None
+    with metrics.span('search_lookup', query=" ".join(tag_names), advanced=False, paged=after is not None):
+        ranked, total = _rank(tag_names, after, page_size)
+    with metrics.span('result_fetch', hits=len(ranked)):
+        return _load_page(ranked, total, page_size, previews.term_marks(tag_names))
+
+
+def _cached_rank(query, cursor, page_size):
+    """Ranked hits and total of one page of a query, from the search cache or computed (and cached)."""
+    after = decode_cursor(cursor) if cursor else None
+    advanced = query_language.is_advanced(query)
+    if advanced:
+        query = " ".join(query.split())
+        key = search_cache.results_key(['\0' + query], cursor or '', page_size)  # \0 can't occur in a lemma
+    else:
+        terms = search_cache.query_terms(query)
+        key = search_cache.results_key(terms, cursor or '', page_size)
+    cached = search_cache.get_results(key)
+    metrics.count('searches', cache='hit' if cached is not None else 'miss', kind='advanced' if advanced else 'plain')
+    if cached is None:
+        with metrics.span('search_lookup', query=query, advanced=advanced, paged=after is not None):
+            cached = query_language.rank(query, after, page_size) if advanced else _rank(terms, after, page_size)
+        search_cache.set_results(key, cached)
+    return cached
+
+
+def search(query, cursor=None, page_size=None):
+    """Searches for a free-text query, serving repeated queries from the search cache.
+
+    Queries using operators, phrases or prefixes go through `query`; plain
+    ones are ranked on their lemma set. Raises ValueError for a malformed
+    cursor.
+    """
+    page_size = page_size or getattr(settings, 'SEARCH_PAGE_SIZE', 20)
+    ranked, total = _cached_rank(query, cursor, page_size)
+    with metrics.span('result_fetch', hits=len(ranked)):
+        return _load_page(ranked, total, page_size, previews.query_marks(query, query_language.is_advanced(query)))
+
+
+async def asearch(query, cursor=None, page_size=None):
+    """`search` for async views.
+
+    Lemmatizing the query (spaCy, CPU-bound) and ranking run in a worker
+    thread, off the event loop, along with the words to mark in the
+    snippets; the page's file names and previews are fetched through the
+    async ORM.
+    """
+    page_size = page_size or getattr(settings, 'SEARCH_PAGE_SIZE', 20)
+
+    def rank():
+        return _cached_rank(query, cursor, page_size), previews.query_marks(query, query_language.is_advanced(query))
+
+    (ranked, total), marks = await sync_to_async(rank)()
+    with metrics.span('result_fetch', hits=len(ranked)):
+        return await _aload_page(ranked, total, page_size, marks)
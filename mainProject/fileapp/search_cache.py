@@ -0,0 +1,97 @@
+"""Two-level cache for searches.
+
+1. An in-process LRU memo of normalized query string -> lemma set, so repeated
+   queries skip spaCy.
+2. A result cache in Django's cache framework (`SEARCH_CACHE_ALIAS`), keyed by
+   the lemma set and page cursor. Keys embed a version number; anything that
+   changes search results calls `invalidate()` to bump it, which orphans every
+   cached page at once instead of tracking which pages a change affects.
+
+With several processes, use a shared cache backend (Redis, Memcached,
+database) so a version bump in one process is seen by all of them; with the
+default per-process local-memory cache, `SEARCH_CACHE_TIMEOUT` bounds how long
+another process can serve stale pages.
+"""
+import time
+from collections import Counter
+from functools import lru_cache
+from hashlib import sha1
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .nlp import generate_tag_counts
+
+VERSION_KEY = 'fileapp:search:version'
+
+_stats = Counter()
+
+
+def _cache():
+    return caches[getattr(settings, 'SEARCH_CACHE_ALIAS', 'default')]
+
+
+@lru_cache(maxsize=getattr(settings, 'SEARCH_QUERY_CACHE_SIZE', 1024))
+def _lemmatize(normalized_query):
+    # Errors propagate, so a failed lemmatization isn't memoized as an empty term set
+    return frozenset(generate_tag_counts(normalized_query))
+
+
+def query_terms(query):
+    """Lemma set of a search query, memoized on the whitespace/case-normalized query."""
+    return _lemmatize(" ".join(query.lower().split()))
+
+
+def version():
+    """Current version of the cached results; it changes whenever they are invalidated."""
+    current = _cache().get(VERSION_KEY)
+    if current is None:
+        # Start from the clock rather than 1, so a version key lost to eviction
+        # can never come back as a number that old cached pages still use.
+        current = int(time.time() * 1000)
+        if not _cache().add(VERSION_KEY, current, timeout=None):
+            current = _cache().get(VERSION_KEY, current)
+    return current
+
+
+def results_key(terms, cursor, page_size):
+    digest = sha1(" ".join(sorted(terms)).encode('utf-8')).hexdigest()
+    return f"fileapp:search:{version()}:{digest}:{cursor}:{page_size}"
+
+
+def get_results(key):
+    """Cached `(ranked, total)` for a results key, or None."""
+    cached = _cache().get(key)
+    _stats['result_hits' if cached is not None else 'result_misses'] += 1
+    return cached
+
+
+def set_results(key, results):
+    _cache().set(key, results, timeout=getattr(settings, 'SEARCH_CACHE_TIMEOUT', 300))
+
+
+def _bump_version():
+    try:
+        _cache().incr(VERSION_KEY)
+    except ValueError:  # Key missing or evicted
+        version()
+    _stats['invalidations'] += 1
+
+
+def invalidate():
+    """Drops every cached result page, once the current transaction commits."""
+    transaction.on_commit(_bump_version)
+
+
+def stats():
+    """Hit/miss counters of both cache levels in this process."""
+    query_info = _lemmatize.cache_info()
+    return {
+        'query_hits': query_info.hits,
+        'query_misses': query_info.misses,
+        'query_size': query_info.currsize,
+        'result_hits': _stats['result_hits'],
+        'result_misses': _stats['result_misses'],
+        'invalidations': _stats['invalidations'],
+    }
@@ -0,0 +1,170 @@
+"""Similar-file lookup ("more like this") over MinHash signatures of tag sets.
+
+Whenever a file's tags are written (`tags.save_tags_for_files`), its blob
+gets a signature: for each of `PERMUTATIONS` hash functions, the smallest
+hash of any of its tag ids. The share of positions where two signatures
+agree estimates the Jaccard similarity of the two tag sets. Signatures are
+512 bytes per blob, however many tags the file has.
+
+Signatures are indexed with locality-sensitive hashing: they are cut into
+`BANDS` bands, and each band is stored as one hashed `SimilarityKey`. Blobs
+sharing any key become candidates, which happens with high probability
+above a Jaccard similarity of about (1 / BANDS) ** (1 / rows per band)
+(0.42 with the defaults) and rarely below it. A lookup is thus one indexed
+IN query for the file's keys, one for the candidates' signatures (at most
+`SIMILARITY_MAX_CANDIDATES`, those sharing the most bands first), and a
+vectorized comparison with NumPy, instead of a pass over every file.
+"""
+from hashlib import blake2b
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+
+from . import metrics
+from .backends import get_backend
+from .models import File, FileTag, SimilarityKey, TagSignature
+
+# Bump after changing the hash functions or the banding below; signatures of
+# another version are ignored until `build_signatures --rebuild` remakes them.
+SIGNATURE_VERSION = 1
+PERMUTATIONS = 128  # Hash functions, i.e. uint32 values per signature
+BANDS = 32  # LSH bands of PERMUTATIONS // BANDS values each
+PRIME = 4294967311  # Smallest prime above 2**32: (a * x + b) stays below 2**64 for 32-bit a, b and x
+SEED = 20240901
+
+_coefficients = None
+
+
+def _hash_coefficients():
+    """The `(a, b)` arrays of the hash functions `(a * x + b) mod PRIME`, the same in every process."""
+    global _coefficients
+    if _coefficients is None:
+        np = get_backend('numpy')
+        rng = np.random.default_rng(SEED)
+        _coefficients = (
+            rng.integers(1, 2 ** 32, PERMUTATIONS, dtype=np.uint64)[:, None],
+            rng.integers(0, 2 ** 32, PERMUTATIONS, dtype=np.uint64)[:, None],
+        )
+    return _coefficients
+
+
+def signature(tag_ids):
+    """MinHash signature (uint32 array of PERMUTATIONS values) of a set of tag ids, or None if it is empty."""
+    if not tag_ids:
+        return None
+    np = get_backend('numpy')
+    a, b = _hash_coefficients()
+    values = np.fromiter(tag_ids, dtype=np.uint64, count=len(tag_ids)) & np.uint64(0xFFFFFFFF)
+    # One row per hash function: PERMUTATIONS x tags, reduced to its minimums
+    return ((a * values + b) % np.uint64(PRIME)).min(axis=1).astype('<u4')
+
+
+def band_keys(signature):
+    """The LSH keys of a signature, one signed 64-bit hash per band."""
+    rows = PERMUTATIONS // BANDS
+    data = signature.astype('<u4').tobytes()
+    return [
+        int.from_bytes(blake2b(data[band * rows * 4:(band + 1) * rows * 4], digest_size=8, salt=band.to_bytes(2, 'little')).digest(), 'little', signed=True)
+        for band in range(BANDS)
+    ]
+
+
+def store_signatures(tag_ids_by_blob):
+    """(Re)writes the signatures and LSH keys of blobs: `tag_ids_by_blob` maps blob ids to sets of tag ids.
+
+    Returns the number of signatures stored (blobs without tags get none).
+    """
+    if not tag_ids_by_blob:
+        return 0
+    signatures, keys = [], []
+    for blob_id, tag_ids in tag_ids_by_blob.items():
+        blob_signature = signature(tag_ids)
+        if blob_signature is None:
+            continue  # Nothing to compare; the blob just isn't found similar to anything
+        signatures.append(TagSignature(blob_id=blob_id, data=blob_signature.tobytes(), version=SIGNATURE_VERSION))
+        keys.extend(SimilarityKey(blob_id=blob_id, key=key) for key in band_keys(blob_signature))
+    batch_size = getattr(settings, 'TAG_BATCH_SIZE', 5000)
+    with transaction.atomic():
+        blob_ids = list(tag_ids_by_blob)
+        TagSignature.objects.filter(blob_id__in=blob_ids).delete()
+        SimilarityKey.objects.filter(blob_id__in=blob_ids).delete()
+        TagSignature.objects.bulk_create(signatures, batch_size=batch_size)
+        SimilarityKey.objects.bulk_create(keys, batch_size=batch_size)
+    return len(signatures)
+
+
+def build_signatures(blob_ids):
+    """Computes the signatures of blobs from the stored tags of one indexed file each; see `store_signatures`."""
+    files = dict(
+        File.objects
+        .filter(blob_id__in=blob_ids, ingest_status=File.IngestStatus.DONE)
+        .order_by('id')
+        .values_list('blob_id', 'id')
+    )
+    tag_ids_by_file = {file_id: set() for file_id in files.values()}
+    for file_id, tag_id in FileTag.objects.filter(file_id__in=tag_ids_by_file).values_list('file_id', 'tag_id'):
+        tag_ids_by_file[file_id].add(tag_id)
+    return store_signatures({blob_id: tag_ids_by_file[file_id] for blob_id, file_id in files.items()})
+
+
+def load_signature(blob_id):
+    """The stored signature of a blob, or None if it has none of the current version."""
+    data = TagSignature.objects.filter(blob_id=blob_id, version=SIGNATURE_VERSION).values_list('data', flat=True).first()
+    return None if data is None else get_backend('numpy').frombuffer(bytes(data), dtype='<u4')
+
+
+def candidates(query, blob_id):
+    """Ids of the blobs sharing at least one band with the signature `query` of `blob_id`, most bands first."""
+    return list(
+        SimilarityKey.objects
+        .filter(key__in=band_keys(query))
+        .exclude(blob_id=blob_id)
+        .values('blob_id')
+        .annotate(bands=Count('id'))
+        .order_by('-bands', 'blob_id')
+        .values_list('blob_id', flat=True)[:getattr(settings, 'SIMILARITY_MAX_CANDIDATES', 2000)]
+    )
+
+
+def similar_blobs(blob_id, limit, min_score=None):
+    """`(blob_id, score)` of the blobs most similar to a blob, best first, at most `limit` of them."""
+    min_score = getattr(settings, 'SIMILARITY_MIN_SCORE', 0.2) if min_score is None else min_score
+    query = load_signature(blob_id)
+    if query is None:
+        return []  # Not tagged yet, or no tags
+    blob_ids = candidates(query, blob_id)
+    metrics.count('similarity_candidates', len(blob_ids))
+    if not blob_ids:
+        return []
+    np = get_backend('numpy')
+    rows = list(TagSignature.objects.filter(blob_id__in=blob_ids, version=SIGNATURE_VERSION).values_list('blob_id', 'data'))
+    matrix = np.frombuffer(b"".join(bytes(data) for _, data in rows), dtype='<u4').reshape(len(rows), PERMUTATIONS)
+    scores = (matrix == query).mean(axis=1)
+    order = np.argsort(-scores, kind='stable')[:limit]
+    return [(rows[index][0], float(scores[index])) for index in order if scores[index] >= min_score]
+
+
+def similar_files(file_id, limit=None):
+    """Files most similar to a file by their tags, as `{'id', 'file_name', 'score'}` dicts, best first.
+
+    Other files with the very same content come first, with a score of 1.
+    Returns None if there is no such file.
+    """
+    limit = limit or getattr(settings, 'SIMILARITY_DEFAULT_LIMIT', 10)
+    blob_id = File.objects.filter(id=file_id).values_list('blob_id', flat=True).first()
+    if blob_id is None:
+        return None
+    with metrics.span('similarity_lookup', file_id=file_id):
+        # Other files of the same blob are the closest matches of all
+        scores = dict(similar_blobs(blob_id, limit))
+        scores[blob_id] = 1.0
+        files = (
+            File.objects
+            .filter(blob_id__in=scores, ingest_status=File.IngestStatus.DONE)
+            .exclude(id=file_id)
+            .values_list('id', 'file_name', 'blob_id')
+        )
+        hits = [{'id': hit_id, 'file_name': file_name, 'score': scores[hit_blob_id]} for hit_id, file_name, hit_blob_id in files]
+    hits.sort(key=lambda hit: (-hit['score'], -hit['id']))
+    return hits[:limit]
@@ -0,0 +1,234 @@
+"""Content-addressed blob storage.
+
+Every distinct file content is stored once as a `Blob`, keyed by its sha256.
+`File` rows reference a blob and keep a reference count on it, so re-uploading
+the same bytes neither writes a second copy nor re-runs extraction.
+
+Blobs are stored under their hash, in directories named after its first
+bytes (`models.blob_upload_to`), so no directory grows past a few thousand
+entries. Renaming a file only changes `File.file_name`.
+
+Dropping the last reference doesn't touch storage: the blob stays, and an
+upload of the same content takes it back, until `collect_garbage` (the
+`gc_blobs` command) deletes blobs unreferenced for BLOB_GC_GRACE seconds,
+with their previews. It also removes files no blob or preview points to,
+left behind by a crash between writing a file and committing its row.
+"""
+import os
+import re
+import shutil
+from datetime import timedelta
+from hashlib import sha256
+
+from django.conf import settings
+from django.core.files import File as DjangoFile
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+
+from . import metrics
+from .models import Blob, File, Preview
+
+HASH_NAME = re.compile(r'[0-9a-f]{64}')
+
+
+def hash_file(file_content):
+    """Computes the sha256 of an uploaded file chunk by chunk, without reading it into memory."""
+    with metrics.span('hash', size=file_content.size):
+        hasher = sha256()
+        for chunk in file_content.chunks():
+            hasher.update(chunk)
+    metrics.count('bytes', file_content.size, stage='hash')
+    file_content.seek(0)  # Reset file pointer after reading
+    return hasher.hexdigest()
+
+
+class StagedFile(DjangoFile):
+    """A file already written to disk under MEDIA_ROOT, which storage moves into place instead of copying."""
+
+    def __init__(self, path, name):
+        super().__init__(None, name=name)
+        self.path = path
+        self.size = os.path.getsize(path)
+
+    def temporary_file_path(self):
+        return self.path
+
+
+def acquire_blob(file_content, content_hash):
+    """Returns the blob for `content_hash`, storing `file_content` only if it is new.
+
+    The blob's reference count is incremented; pair every call with `release_blob`.
+    """
+    with transaction.atomic():
+        # Taking the reference first locks the row, so `collect_garbage` can't delete it meanwhile
+        if Blob.objects.filter(content_hash=content_hash).update(ref_count=F('ref_count') + 1):
+            return Blob.objects.get(content_hash=content_hash)
+        blob = Blob(content_hash=content_hash, size=file_content.size, ref_count=1)
+        blob.file_content.save(os.path.basename(file_content.name), file_content, save=False)
+        try:
+            with transaction.atomic():
+                blob.save()
+        except IntegrityError:
+            # Another request stored the same content first; keep theirs.
+            blob.file_content.delete(save=False)
+            Blob.objects.filter(content_hash=content_hash).update(ref_count=F('ref_count') + 1)
+            blob = Blob.objects.get(content_hash=content_hash)
+    return blob
+
+
+def release_blob(blob_id):
+    """Drops one reference to a blob; returns whether nothing references it any more.
+
+    The blob itself is left for `collect_garbage`.
+    """
+    Blob.objects.filter(id=blob_id).update(ref_count=F('ref_count') - 1, released_at=timezone.now())
+    return Blob.objects.filter(id=blob_id, ref_count__lte=0).exists()
+
+
+def _grace_cutoff(grace):
+    return timezone.now() - timedelta(seconds=getattr(settings, 'BLOB_GC_GRACE', 24 * 60 * 60) if grace is None else grace)
+
+
+def collect_garbage(grace=None, batch_size=500, dry_run=False):
+    """Deletes the blobs nothing has referenced for `grace` seconds (default BLOB_GC_GRACE), then their files.
+
+    Each batch locks its rows and checks them again before deleting, so a
+    blob taken back by an upload in the meantime is kept. Returns the
+    number of blobs and bytes collected.
+    """
+    cutoff = _grace_cutoff(grace)
+    unreferenced = (
+        Blob.objects
+        .filter(ref_count__lte=0)
+        .filter(~Exists(File.objects.filter(blob_id=OuterRef('pk'))))  # In case a count went wrong
+        .filter(Q(released_at__lt=cutoff) | Q(released_at__isnull=True, created_at__lt=cutoff))
+        .order_by('id')
+    )
+    if dry_run:
+        totals = unreferenced.values_list('id', 'size')
+        return len(totals), sum(size for _, size in totals)
+    collected = size = 0
+    while True:
+        with transaction.atomic():
+            blobs = list(unreferenced.select_for_update()[:batch_size])
+            if not blobs:
+                return collected, size
+            blob_ids = [blob.id for blob in blobs]
+            names = [blob.file_content.name for blob in blobs]
+            names.extend(Preview.objects.filter(blob_id__in=blob_ids).exclude(thumbnail='').values_list('thumbnail', flat=True))
+            Blob.objects.filter(id__in=blob_ids, ref_count__lte=0).delete()  # Previews and stored text go with them
+            storage = Blob._meta.get_field('file_content').storage
+            # Only remove the bytes once the rows are really gone
+            transaction.on_commit(lambda names=names: [storage.delete(name) for name in names])
+        collected += len(blobs)
+        size += sum(blob.size for blob in blobs)
+
+
+def _stored_names(relative_paths):
+    """The paths among `relative_paths` that some blob is stored at."""
+    hashes = {}
+    others = []
+    for path in relative_paths:
+        name = os.path.basename(path)
+        if HASH_NAME.match(name):
+            hashes[name[:64]] = path
+        else:
+            others.append(path)
+    stored = set(Blob.objects.filter(content_hash__in=hashes).values_list('file_content', flat=True))
+    if others:
+        stored.update(Blob.objects.filter(file_content__in=others).values_list('file_content', flat=True))
+    return stored.intersection(relative_paths)
+
+
+def _stored_thumbnails(relative_paths):
+    """The paths among `relative_paths` that some preview's thumbnail is stored at."""
+    return set(Preview.objects.filter(thumbnail__in=relative_paths).values_list('thumbnail', flat=True))
+
+
+def unsharded_blobs():
+    """Number of blobs still stored outside BLOB_STORAGE_DIR, e.g. in the flat layout `shard_blobs` moves."""
+    blob_dir = getattr(settings, 'BLOB_STORAGE_DIR', 'blobs')
+    return Blob.objects.exclude(file_content='').exclude(file_content__startswith=f"{blob_dir}/").count()
+
+
+def sweep_orphans(grace=None, batch_size=1000, dry_run=False):
+    """Deletes files under the blob and preview directories that nothing points to and that are older than `grace`.
+
+    Sharded blob names are checked through the (indexed) content hash they
+    start with. The flat `uploaded_files/` directory (copies an interrupted
+    `shard_blobs` left there) is only swept once no blob is stored outside
+    BLOB_STORAGE_DIR any more, i.e. once `shard_blobs` has completed; until
+    then it holds live content under the old naming. Only local storage can
+    be listed this way. Returns the number of files and bytes removed.
+    """
+    storage = Blob._meta.get_field('file_content').storage
+    cutoff = _grace_cutoff(grace).timestamp()
+    removed = size = 0
+
+    def sweep(batch, stored_names):
+        nonlocal removed, size
+        stored = stored_names([relative for relative, _ in batch])
+        for relative, stat in batch:
+            if relative not in stored:
+                if not dry_run:
+                    storage.delete(relative)
+                removed += 1
+                size += stat.st_size
+
+    directories = [
+        (getattr(settings, 'BLOB_STORAGE_DIR', 'blobs'), _stored_names),
+        (getattr(settings, 'PREVIEW_STORAGE_DIR', 'previews'), _stored_thumbnails),
+    ]
+    if not unsharded_blobs():
+        directories.append(('uploaded_files', _stored_names))  # The flat layout, left with stray copies only
+    for directory, stored_names in directories:
+        root = storage.path(directory)
+        batch = []
+        for parent, _, file_names in os.walk(root):
+            for file_name in file_names:
+                path = os.path.join(parent, file_name)
+                stat = os.stat(path)
+                if stat.st_mtime >= cutoff:
+                    continue  # May belong to a row not committed yet
+                batch.append((os.path.relpath(path, storage.location).replace(os.sep, '/'), stat))
+                if len(batch) >= batch_size:
+                    sweep(batch, stored_names)
+                    batch = []
+        sweep(batch, stored_names)
+    return removed, size
+
+
+def sharded_name(blob):
+    """The key a blob should move to, or None if it is already in its shard directory."""
+    old_name = blob.file_content.name
+    new_name = Blob._meta.get_field('file_content').generate_filename(blob, old_name)
+    return None if os.path.dirname(new_name) == os.path.dirname(old_name) else new_name
+
+
+def shard(blob):
+    """Moves a blob stored under another key to its sharded one; returns False if it was already there.
+
+    The file is linked (or copied) to the new key before the row is updated
+    and the old file removed, so an interruption leaves at most a stray
+    copy, which `sweep_orphans` removes.
+    """
+    storage = Blob._meta.get_field('file_content').storage
+    old_name = blob.file_content.name
+    new_name = sharded_name(blob)
+    if new_name is None:
+        return False
+    old_path, new_path = storage.path(old_name), storage.path(new_name)
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    if os.path.exists(new_path) and not os.path.samefile(old_path, new_path):
+        new_name = storage.get_available_name(new_name)  # Something else is there; don't overwrite it
+        new_path = storage.path(new_name)
+    if not os.path.exists(new_path):
+        try:
+            os.link(old_path, new_path)
+        except OSError:  # No hard links on this filesystem
+            shutil.copyfile(old_path, new_path)
+    Blob.objects.filter(id=blob.id, file_content=old_name).update(file_content=new_name)
+    storage.delete(old_name)
+    blob.file_content.name = new_name
+    return True
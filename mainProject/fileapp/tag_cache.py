@@ -0,0 +1,137 @@
+"""Process-local cache of tag ids.
+
+Tags are never renamed or deleted, so a name's id can be kept for the life of
+the process: resolving the lemmas of a document or a query only asks the
+database about names it hasn't seen yet, all of them in one IN query per
+batch. The cache is an LRU bounded by `TAG_CACHE_SIZE` names, filled on first
+use with the `TAG_CACHE_WARM_UP` most frequent tags (by `Tag.doc_freq`).
+
+Names looked up and not found are remembered as well, so a search for an
+unknown word doesn't query the database each time. Those entries belong to a
+generation, the search cache version (see `search_cache`), which every write
+adding tagged files bumps: a new generation forgets them. With the default
+per-process local-memory cache, they also expire after `SEARCH_CACHE_TIMEOUT`
+seconds, like result pages another process may still serve.
+
+Ids are only cached once the transaction that read or created them commits,
+so a rolled-back insert never leaves an id behind.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+
+from . import metrics, search_cache
+from .models import Tag
+
+_lock = threading.Lock()
+_ids = OrderedDict()  # Tag name -> id, least recently used first
+_missing = {}  # Tag name -> (generation, expiry) of a lookup that found no such tag
+_warmed = False
+
+
+def _reset_after_fork():
+    global _lock
+    _lock = threading.Lock()  # The cached ids stay valid in the child
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _size():
+    return getattr(settings, 'TAG_CACHE_SIZE', 100_000)
+
+
+def _store(pairs):
+    size = _size()
+    with _lock:
+        for name, tag_id in pairs:
+            _ids[name] = tag_id
+            _ids.move_to_end(name)
+            _missing.pop(name, None)
+        while len(_ids) > size:
+            _ids.popitem(last=False)
+
+
+def remember(tag_ids):
+    """Caches `{name: id}` pairs once the current transaction commits."""
+    if tag_ids:
+        pairs = list(tag_ids.items())
+        transaction.on_commit(lambda: _store(pairs))
+
+
+def warm_up(limit=None):
+    """Loads the `limit` (default `TAG_CACHE_WARM_UP`) most frequent tags."""
+    global _warmed
+    _warmed = True
+    limit = getattr(settings, 'TAG_CACHE_WARM_UP', 10_000) if limit is None else min(limit, _size())
+    if limit <= 0:
+        return
+    tags = list(Tag.objects.order_by('-doc_freq').values_list('tag_name', 'id')[:limit])
+    tags.reverse()  # The most frequent end up most recently used
+    remember(dict(tags))
+
+
+def clear():
+    """Forgets every cached id (needed after switching databases, e.g. in benchmarks)."""
+    global _warmed
+    with _lock:
+        _ids.clear()
+        _missing.clear()
+    _warmed = False
+
+
+def lookup(tag_names):
+    """Maps the names that are existing tags to their ids, querying only names not cached."""
+    if not _warmed:
+        warm_up()
+    names = set(tag_names)
+    found, unknown, maybe_missing = {}, [], []
+    with _lock:
+        for name in names:
+            tag_id = _ids.get(name)
+            if tag_id is not None:
+                _ids.move_to_end(name)
+                found[name] = tag_id
+            elif name in _missing:
+                maybe_missing.append((name, _missing[name]))
+            else:
+                unknown.append(name)
+    generation = now = None
+    if maybe_missing:
+        generation, now = search_cache.version(), time.monotonic()
+        unknown.extend(
+            name for name, (seen_generation, expiry) in maybe_missing
+            if seen_generation != generation or expiry < now
+        )
+    metrics.count('tag_cache_lookups', len(names) - len(unknown), outcome='hit')
+    if not unknown:
+        return found
+
+    metrics.count('tag_cache_lookups', len(unknown), outcome='miss')
+    read = {}
+    batch_size = getattr(settings, 'TAG_BATCH_SIZE', 5000)
+    for start in range(0, len(unknown), batch_size):
+        read.update(Tag.objects.filter(tag_name__in=unknown[start:start + batch_size]).values_list('tag_name', 'id'))
+    remember(read)
+    found.update(read)
+    missing = [name for name in unknown if name not in read]
+    if missing:
+        if generation is None:
+            generation, now = search_cache.version(), time.monotonic()
+        entry = (generation, now + getattr(settings, 'SEARCH_CACHE_TIMEOUT', 300))
+        size = _size()
+        with _lock:
+            for name in missing:
+                _missing[name] = entry
+            while len(_missing) > size:
+                del _missing[next(iter(_missing))]  # Oldest first
+    return found
+
+
+def stats():
+    """Number of cached ids and of names remembered as missing in this process."""
+    return {'size': len(_ids), 'missing': len(_missing)}
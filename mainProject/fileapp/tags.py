@@ -0,0 +1,151 @@
+"""Batched tag persistence.
+
+A document produces thousands of distinct tags; they are resolved and written
+with a constant number of queries per batch instead of two per tag, and tag
+names already seen by the process are resolved from `tag_cache` without any.
+
+Every write of postings here also updates `Tag.doc_freq`, the number of files
+with each tag, so ranking reads it instead of counting postings. Postings
+must therefore only be added and removed through these functions. Saving
+tags also (re)writes the tag signatures of the files' blobs, which
+`similarity` looks similar files up by.
+"""
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from . import similarity, tag_cache
+from .models import File, FileTag, Tag
+from .positions import encode_positions
+
+TAG_NAME_MAX_LENGTH = Tag._meta.get_field('tag_name').max_length
+
+
+def _batch_size():
+    return getattr(settings, 'TAG_BATCH_SIZE', 5000)
+
+
+def _batches(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def resolve_tag_ids(tag_names):
+    """Maps tag names to ids, creating the tags that don't exist yet.
+
+    Known tags come from `tag_cache`, which reads the others with one IN
+    query per batch; missing ones are inserted in bulk, ignoring rows a
+    concurrent writer created first, and then read back.
+    """
+    # Longer lemmas can't be stored and would fail the whole batch
+    names = [name for name in set(tag_names) if len(name) <= TAG_NAME_MAX_LENGTH]
+    batch_size = _batch_size()
+    tag_ids = tag_cache.lookup(names)
+
+    missing = [name for name in names if name not in tag_ids]
+    if missing:
+        Tag.objects.bulk_create([Tag(tag_name=name) for name in missing], batch_size=batch_size, ignore_conflicts=True)
+        created = {}
+        for batch in _batches(missing, batch_size):
+            created.update(Tag.objects.filter(tag_name__in=batch).values_list('tag_name', 'id'))
+        tag_cache.remember(created)
+        tag_ids.update(created)
+    return tag_ids
+
+
+def _add_doc_freqs(files_per_tag, sign=1):
+    """Adds (or with `sign=-1` subtracts) `{tag_id: files}` to the tags' document frequencies.
+
+    Tags are updated with one query per distinct count and batch, in id order
+    so concurrent writers lock the rows in the same order.
+    """
+    tag_ids_by_count = {}
+    for tag_id, files in sorted(files_per_tag.items()):
+        tag_ids_by_count.setdefault(files, []).append(tag_id)
+    for files, tag_ids in tag_ids_by_count.items():
+        for batch in _batches(tag_ids, _batch_size()):
+            Tag.objects.filter(id__in=batch).update(doc_freq=F('doc_freq') + sign * files)
+
+
+def delete_tags(file_ids):
+    """Removes every tag of the given files, lowering the tags' document frequencies to match."""
+    with transaction.atomic():
+        postings = FileTag.objects.filter(file_id__in=file_ids)
+        files_per_tag = dict(postings.values('tag_id').annotate(files=Count('id')).values_list('tag_id', 'files'))
+        if files_per_tag:
+            postings.delete()
+            _add_doc_freqs(files_per_tag, -1)
+
+
+def recount_doc_freqs():
+    """Recomputes every tag's document frequency from its postings (after writing postings directly)."""
+    postings = FileTag.objects.filter(tag_id=OuterRef('pk')).values('tag_id').annotate(files=Count('id')).values('files')
+    Tag.objects.update(doc_freq=Coalesce(Subquery(postings), 0))
+
+
+def token_count(tag_positions):
+    """Number of tagged tokens in a document, given its tags as for `save_tags`."""
+    return sum(value if isinstance(value, int) else len(value) for value in tag_positions.values())
+
+
+def _file_tag(file_instance, tag_id, value):
+    if isinstance(value, int):  # A bare frequency, without positions
+        return FileTag(file=file_instance, tag_id=tag_id, frequency=value)
+    return FileTag(file=file_instance, tag_id=tag_id, frequency=len(value), positions=encode_positions(value))
+
+
+def save_tags(file_instance, tag_positions):
+    """Associates the provided tags with a file.
+
+    `tag_positions` maps each tag to the sorted token positions where it
+    occurs (see `nlp.generate_tag_positions`), or just to its frequency.
+    """
+    save_tags_for_files([(file_instance, tag_positions)])
+
+
+def save_tags_for_files(files_and_positions):
+    """Stores the tags of many files at once: `files_and_positions` is a list of `(file, tag_positions)`.
+
+    The tag names of all files are resolved together, so a batch of similar
+    documents costs about as many queries as one of them.
+    """
+    with transaction.atomic():
+        tag_ids = resolve_tag_ids(name for _, tag_positions in files_and_positions for name in tag_positions)
+        rows = [
+            _file_tag(file_instance, tag_ids[tag_name], value)
+            for file_instance, tag_positions in files_and_positions
+            for tag_name, value in tag_positions.items()
+            if tag_name in tag_ids
+        ]
+        FileTag.objects.bulk_create(rows, batch_size=_batch_size())
+        _add_doc_freqs(Counter(row.tag_id for row in rows))
+        _save_signatures(files_and_positions, tag_ids)
+
+
+def _save_signatures(files_and_positions, tag_ids):
+    """Stores the tag signatures of the files' blobs (see `similarity`)."""
+    # Files built from an id alone (reindexing) don't know their blob
+    unknown = [file_instance.id for file_instance, _ in files_and_positions if file_instance.blob_id is None]
+    blob_ids = dict(File.objects.filter(id__in=unknown).values_list('id', 'blob_id')) if unknown else {}
+    tag_ids_by_blob = {}
+    for file_instance, tag_positions in files_and_positions:
+        blob_id = file_instance.blob_id or blob_ids.get(file_instance.id)
+        if blob_id is not None:
+            tag_ids_by_blob[blob_id] = {tag_ids[name] for name in tag_positions if name in tag_ids}
+    similarity.store_signatures(tag_ids_by_blob)
+
+
+def copy_tags(source_file_id, target_file):
+    """Gives `target_file` the same tags, frequencies and positions as another file."""
+    rows = [
+        FileTag(file=target_file, tag_id=tag_id, frequency=frequency, positions=positions)
+        for tag_id, frequency, positions in (
+            FileTag.objects.filter(file_id=source_file_id).values_list('tag_id', 'frequency', 'positions')
+        )
+    ]
+    with transaction.atomic():
+        FileTag.objects.bulk_create(rows, batch_size=_batch_size())
+        _add_doc_freqs(Counter(row.tag_id for row in rows))
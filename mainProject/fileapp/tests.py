@@ -1,3 +1,853 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from hashlib import sha256
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import extraction, ingest, nlp, reindex, search_cache, similarity, tag_cache, tags, uploads
+from .downloads import parse_range_header
+from .models import Blob, ExtractedText, File, FileTag, IngestJob, Tag, UploadSession
+from .positions import decode_positions, encode_positions
+from .query import QuerySyntaxError, parse
+from .search import decode_cursor, encode_cursor
+
+
+class ParseQueryTests(SimpleTestCase):
+    def test_words_default_to_or(self):
+        self.assertEqual(parse('budget report'), ('or', [('word', 'budget'), ('word', 'report')]))
+
+    @override_settings(SEARCH_DEFAULT_OPERATOR='AND')
+    def test_default_operator_setting(self):
+        self.assertEqual(parse('budget report'), ('and', [('word', 'budget'), ('word', 'report')]))
+
+    def test_and_binds_tighter_than_or(self):
+        self.assertEqual(
+            parse('a OR b AND c'),
+            ('or', [('word', 'a'), ('and', [('word', 'b'), ('word', 'c')])]),
+        )
+
+    def test_parentheses_group(self):
+        self.assertEqual(
+            parse('(a OR b) AND c'),
+            ('and', [('or', [('word', 'a'), ('word', 'b')]), ('word', 'c')]),
+        )
+
+    def test_phrase_prefix_and_negation(self):
+        self.assertEqual(
+            parse('"annual report" fin* -draft'),
+            ('and', [('or', [('phrase', 'annual report'), ('prefix', 'fin')]), ('not', ('word', 'draft'))]),
+        )
+
+    def test_lowercase_operators_are_words(self):
+        self.assertEqual(parse('salt and pepper'), ('or', [('word', 'salt'), ('word', 'and'), ('word', 'pepper')]))
+
+    def test_unbalanced_quotes_and_parentheses_are_closed(self):
+        self.assertEqual(parse('"annual report'), ('phrase', 'annual report'))
+        self.assertEqual(parse('a AND (b OR c'), ('and', [('word', 'a'), ('or', [('word', 'b'), ('word', 'c')])]))
+
+    def test_no_operand(self):
+        self.assertIsNone(parse(''))
+        self.assertIsNone(parse('*'))
+
+    def test_malformed_queries_are_rejected(self):
+        for query in ['a AND AND b', 'a OR', 'AND a', 'a NOT', '()', 'a)']:
+            with self.subTest(query=query), self.assertRaises(QuerySyntaxError):
+                parse(query)
+
+    def test_syntax_error_is_a_value_error(self):
+        with self.assertRaises(ValueError):
+            parse('a AND AND b')
+
+
+class PositionsTests(SimpleTestCase):
+    def test_round_trip(self):
+        for positions in [[], [0], [1, 2, 3], [5, 200, 201, 20_000, 3_000_000]]:
+            with self.subTest(positions=positions):
+                self.assertEqual(decode_positions(encode_positions(positions)), positions)
+
+    def test_small_gaps_take_one_byte(self):
+        self.assertEqual(encode_positions([3, 10, 137]), bytes([3, 7, 127]))
+
+    def test_large_gap_is_a_varint(self):
+        self.assertEqual(encode_positions([300]), bytes([0xAC, 0x02]))
+
+    def test_decodes_memoryview(self):
+        self.assertEqual(decode_positions(memoryview(encode_positions([4, 1000]))), [4, 1000])
+
+
+class MediaTestCase(TestCase):
+    """Runs each test with an empty MEDIA_ROOT and caches of its own.
+
+    The helpers run what commits trigger (cached tag ids, search cache
+    invalidation), which a test's transaction never does by itself.
+    """
+
+    def setUp(self):
+        cache.clear()
+        tag_cache.clear()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def upload(self, file_name, content):
+        """Uploads a file through the upload form and returns its `File`."""
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/upload/', {'action': 'upload', 'file': SimpleUploadedFile(file_name, content)})
+        self.assertEqual(response.status_code, 200)
+        return File.objects.filter(file_name=file_name).latest('id')
+
+    def ingest(self):
+        """Runs the ingestion worker over everything queued; returns its stdout and stderr."""
+        stdout, stderr = StringIO(), StringIO()
+        with override_settings(INGEST_PRELOAD=False), self.captureOnCommitCallbacks(execute=True):
+            call_command('ingest_worker', '--once', '--workers', '1', stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+
+@override_settings(INGEST_MAX_ATTEMPTS=2, INGEST_JOB_TIMEOUT=60)
+class IngestQueueTests(MediaTestCase):
+    def test_upload_queues_a_job(self):
+        file_instance = self.upload('notes.txt', b'quarterly budget review')
+        self.assertEqual(file_instance.ingest_status, File.IngestStatus.PENDING)
+        job = IngestJob.objects.get(file=file_instance)
+        self.assertEqual((job.status, job.attempts, job.max_attempts), (IngestJob.Status.QUEUED, 0, 2))
+
+    def test_claim_takes_each_job_once(self):
+        file_instance = self.upload('notes.txt', b'quarterly budget review')
+        [job] = ingest.claim_jobs('worker-a', 5)
+        self.assertEqual((job.status, job.locked_by, job.attempts), (IngestJob.Status.RUNNING, 'worker-a', 1))
+        self.assertEqual(File.objects.get(id=file_instance.id).ingest_status, File.IngestStatus.PROCESSING)
+        self.assertEqual(ingest.claim_jobs('worker-b', 5), [])
+
+    def test_failures_are_retried_with_backoff_until_max_attempts(self):
+        file_instance = self.upload('notes.txt', b'quarterly budget review')
+        [job] = ingest.claim_jobs('worker', 1)
+        ingest.fail_job(job, ValueError('unreadable'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.last_error), (IngestJob.Status.QUEUED, 'unreadable'))
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertEqual(ingest.claim_jobs('worker', 1), [])  # Not due yet
+
+        IngestJob.objects.filter(id=job.id).update(run_after=timezone.now())
+        [job] = ingest.claim_jobs('worker', 1)
+        ingest.fail_job(job, ValueError('still unreadable'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (IngestJob.Status.FAILED, 2))
+        file_instance.refresh_from_db()
+        self.assertEqual((file_instance.ingest_status, file_instance.ingest_error), (File.IngestStatus.FAILED, 'still unreadable'))
+
+    def test_stale_jobs_are_requeued_as_an_attempt(self):
+        self.upload('notes.txt', b'quarterly budget review')
+        [job] = ingest.claim_jobs('worker', 1)
+        self.assertEqual(ingest.requeue_stale_jobs(), 0)
+
+        IngestJob.objects.filter(id=job.id).update(locked_at=timezone.now() - timedelta(minutes=5))
+        ingest.heartbeat('worker')
+        self.assertEqual(ingest.requeue_stale_jobs(), 0)  # The heartbeat showed the worker is alive
+
+        IngestJob.objects.filter(id=job.id).update(locked_at=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(ingest.requeue_stale_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_by, job.attempts), (IngestJob.Status.QUEUED, '', 1))
+
+        IngestJob.objects.filter(id=job.id).update(run_after=timezone.now())
+        [job] = ingest.claim_jobs('worker', 1)
+        IngestJob.objects.filter(id=job.id).update(locked_at=timezone.now() - timedelta(minutes=5))
+        ingest.requeue_stale_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestJob.Status.FAILED)
+
+    def test_release_returns_jobs_to_the_queue(self):
+        file_instance = self.upload('notes.txt', b'quarterly budget review')
+        ingest.claim_jobs('worker', 1)
+        ingest.release_jobs('worker')
+        job = IngestJob.objects.get(file=file_instance)
+        self.assertEqual((job.status, job.locked_by), (IngestJob.Status.QUEUED, ''))
+        self.assertEqual(File.objects.get(id=file_instance.id).ingest_status, File.IngestStatus.PENDING)
+
+
+class IngestWorkerTests(MediaTestCase):
+    def test_indexes_uploads(self):
+        file_instance = self.upload('notes.txt', b'The committee approved the budget.')
+        stdout, _ = self.ingest()
+        self.assertIn('indexed', stdout)
+        file_instance.refresh_from_db()
+        self.assertEqual(file_instance.ingest_status, File.IngestStatus.DONE)
+        self.assertTrue(FileTag.objects.filter(file=file_instance, tag__tag_name='budget').exists())
+
+    def test_duplicate_reuses_tags(self):
+        first = self.upload('notes.txt', b'The committee approved the budget.')
+        self.ingest()
+        second = self.upload('copy.txt', b'The committee approved the budget.')
+        stdout, _ = self.ingest()
+        self.assertIn('reused the tags', stdout)
+        self.assertEqual(
+            set(FileTag.objects.filter(file=second).values_list('tag_id', flat=True)),
+            set(FileTag.objects.filter(file=first).values_list('tag_id', flat=True)),
+        )
+
+    def test_failed_store_does_not_stop_the_worker(self):
+        failing = self.upload('a.txt', b'The committee approved the budget.')
+        other = self.upload('b.txt', b'Shipments leave on Monday.')
+        complete_job = ingest.complete_job
+
+        def fail_first(job, *args):
+            if job.file_id == failing.id:
+                raise IntegrityError('FOREIGN KEY constraint failed')
+            return complete_job(job, *args)
+
+        with mock.patch('fileapp.management.commands.ingest_worker.complete_job', fail_first):
+            _, stderr = self.ingest()
+        self.assertIn('FOREIGN KEY constraint failed', stderr)
+        job = IngestJob.objects.get(file=failing)
+        self.assertEqual((job.status, job.last_error), (IngestJob.Status.QUEUED, 'FOREIGN KEY constraint failed'))
+        self.assertEqual(File.objects.get(id=other.id).ingest_status, File.IngestStatus.DONE)
+
+    def test_skips_files_deleted_while_queued(self):
+        deleted = self.upload('a.txt', b'The committee approved the budget.')
+        other = self.upload('b.txt', b'Shipments leave on Monday.')
+        claim_jobs = ingest.claim_jobs
+
+        def claim_then_delete(worker_id, limit):
+            jobs = claim_jobs(worker_id, limit)
+            File.objects.filter(id=deleted.id).delete()  # Deleted by a user meanwhile
+            return jobs
+
+        with mock.patch('fileapp.management.commands.ingest_worker.claim_jobs', claim_then_delete):
+            stdout, stderr = self.ingest()
+        self.assertIn('skipped: the file was deleted', stdout)
+        self.assertEqual(stderr, '')
+        self.assertEqual(File.objects.get(id=other.id).ingest_status, File.IngestStatus.DONE)
+
+
+class RankingTests(MediaTestCase):
+    def search(self, query):
+        response = self.client.get('/api/search/results/', {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [hit['file_name'] for hit in response.json()['results']]
+
+    def test_bm25_ranking(self):
+        self.upload('dense.txt', b'Budget budget budget for the committee.')
+        self.upload('sparse.txt', b'The budget was mentioned once in a long report about shipments, schedules and campaigns.')
+        self.upload('both.txt', b'The budget of the shipment.')
+        self.upload('other.txt', b'Campaign schedules for the spring.')
+        self.ingest()
+        self.assertEqual(self.search('budget'), ['dense.txt', 'both.txt', 'sparse.txt'])
+        self.assertEqual(self.search('budget shipment')[0], 'both.txt')
+        self.assertEqual(self.search('nothing'), [])
+
+
+class DeduplicationTests(MediaTestCase):
+    def rename(self, file_instance, new_name_base):
+        response = self.client.post(
+            f'/api/rename/{file_instance.id}/', json.dumps({'new_name_base': new_name_base}), content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def delete(self, file_instance):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/api/delete/{file_instance.id}/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_same_content_is_stored_once(self):
+        first = self.upload('report.txt', b'Annual budget report')
+        second = self.upload('copy of report.txt', b'Annual budget report')
+        self.assertEqual(first.blob_id, second.blob_id)
+        blob = Blob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(len(os.listdir(os.path.dirname(blob.file_content.path))), 1)
+
+        self.upload('other.txt', b'Something else')
+        self.assertEqual(Blob.objects.count(), 2)
+
+    def test_rename_only_changes_the_name(self):
+        file_instance = self.upload('report.txt', b'Annual budget report')
+        path = file_instance.blob.file_content.path
+        self.assertEqual(self.rename(file_instance, 'budget 2024'), {'success': True, 'new_name': 'budget 2024.txt'})
+        file_instance.refresh_from_db()
+        self.assertEqual(file_instance.file_name, 'budget 2024.txt')
+        self.assertEqual(file_instance.blob.file_content.path, path)
+        self.assertEqual(file_instance.blob.ref_count, 1)
+        self.assertTrue(os.path.exists(path))
+
+    def test_delete_releases_references(self):
+        first = self.upload('report.txt', b'Annual budget report')
+        second = self.upload('copy.txt', b'Annual budget report')
+        self.ingest()
+        path = first.blob.file_content.path
+
+        self.delete(first)
+        self.assertFalse(File.objects.filter(id=first.id).exists())
+        self.assertFalse(FileTag.objects.filter(file_id=first.id).exists())
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+
+        self.delete(second)
+        blob = Blob.objects.get()
+        self.assertEqual(blob.ref_count, 0)
+        self.assertTrue(os.path.exists(path))  # Left for gc_blobs
+
+        again = self.upload('again.txt', b'Annual budget report')
+        self.assertEqual(again.blob_id, blob.id)
+        self.assertEqual(Blob.objects.get().ref_count, 1)
+
+
+def make_file(file_name):
+    """A `File` with a blob of its own, without any stored content."""
+    blob = Blob.objects.create(content_hash=f"{Blob.objects.count() + 1:064x}", file_content=f"blobs/{file_name}", ref_count=1)
+    return File.objects.create(file_name=file_name, blob=blob)
+
+
+class TagWriteTests(MediaTestCase):
+    def save(self, *files_and_positions):
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as queries:
+            tags.save_tags_for_files(list(files_and_positions))
+        return len(queries)
+
+    def test_tags_and_postings_are_written(self):
+        file_instance = make_file('a.txt')
+        self.save((file_instance, {'budget': [0, 7], 'review': [3]}))
+        postings = {
+            tag_name: (frequency, bytes(positions))
+            for tag_name, frequency, positions in FileTag.objects.filter(file=file_instance).values_list('tag__tag_name', 'frequency', 'positions')
+        }
+        self.assertEqual(postings, {'budget': (2, encode_positions([0, 7])), 'review': (1, encode_positions([3]))})
+
+    def test_existing_tags_are_reused(self):
+        self.save((make_file('a.txt'), {'budget': [0]}))
+        self.save((make_file('b.txt'), {'budget': [0], 'review': [1]}))
+        self.assertEqual(sorted(Tag.objects.values_list('tag_name', flat=True)), ['budget', 'review'])
+        self.assertEqual(FileTag.objects.filter(tag__tag_name='budget').count(), 2)
+
+    def test_query_count_does_not_grow_with_tags_or_files(self):
+        self.save((make_file('warm.txt'), {'warm': [0]}))  # Loads the tag cache
+        few = self.save((make_file('few.txt'), {f'few{i}': [i] for i in range(3)}))
+        # Kept below SQLite's 999 parameters per statement, past which Django splits bulk inserts
+        many = self.save(*[(make_file(f'many{n}.txt'), {f'many{i}': [i] for i in range(30)}) for n in range(5)])
+        self.assertEqual(few, many)
+        known = self.save((make_file('known.txt'), {f'many{i}': [i] for i in range(30)}))
+        self.assertLessEqual(known, few)  # Cached names need no lookup or insert
+
+    def test_overlong_names_are_skipped(self):
+        file_instance = make_file('a.txt')
+        self.save((file_instance, {'x' * 300: [0], 'budget': [1]}))
+        self.assertEqual(list(FileTag.objects.filter(file=file_instance).values_list('tag__tag_name', flat=True)), ['budget'])
+
+
+class SearchCacheTests(MediaTestCase):
+    def search(self, query):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.get('/api/search/results/', {'q': query})
+        return [hit['file_name'] for hit in response.json()['results']]
+
+    def test_lemmatization_errors_are_not_cached(self):
+        search_cache._lemmatize.cache_clear()
+        with mock.patch('fileapp.search_cache.generate_tag_counts', side_effect=RuntimeError('model not loaded')):
+            with self.assertRaises(RuntimeError):
+                search_cache.query_terms('Budgets reviewed')
+        self.assertEqual(search_cache.query_terms('Budgets reviewed'), {'budget', 'review'})
+
+    def test_queries_are_normalized(self):
+        self.assertIs(search_cache.query_terms('Budget  Review'), search_cache.query_terms('budget review'))
+
+    def test_result_pages_are_cached_until_invalidated(self):
+        self.upload('a.txt', b'The budget was approved.')
+        self.ingest()
+        self.assertEqual(self.search('budget'), ['a.txt'])
+        hits = search_cache.stats()['result_hits']
+        self.assertEqual(self.search('budget'), ['a.txt'])
+        self.assertEqual(search_cache.stats()['result_hits'], hits + 1)
+
+        self.upload('b.txt', b'Another budget.')
+        self.ingest()  # Indexing invalidates the cached pages
+        self.assertEqual(sorted(self.search('budget')), ['a.txt', 'b.txt'])
+
+
+class ExtractionTests(SimpleTestCase):
+    def write(self, content, suffix):
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+            f.write(content)
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+    def test_content_type_is_sniffed_from_the_bytes(self):
+        self.assertEqual(extraction.sniff_content_type(self.write(b'%PDF-1.7\n', '.txt')), 'application/pdf')
+        self.assertEqual(extraction.sniff_content_type(self.write(b'# Title\n', '.md')), 'text/markdown')
+        self.assertEqual(extraction.sniff_content_type(self.write(b'\x00\x01\x02\xff', '.txt')), 'application/octet-stream')
+
+    def test_exact_types_come_before_catch_alls(self):
+        names = [extractor.name for extractor in extraction.extractors_for('application/vnd.openxmlformats-officedocument.wordprocessingml.document')]
+        self.assertEqual(names, ['docx2txt', 'textract'])
+        self.assertEqual([extractor.name for extractor in extraction.extractors_for('text/csv')], ['csv', 'text'])
+
+    def test_failed_extractor_falls_back_to_the_next(self):
+        def broken(file_path, content_type):
+            raise OSError('corrupt')
+            yield
+
+        def working(file_path, content_type):
+            yield 'recovered text'
+
+        registry = [extraction.Extractor('broken', ['text/plain'], 1, broken), extraction.Extractor('working', ['text/plain'], 2, working)]
+        report = extraction.ExtractionReport()
+        with mock.patch.object(extraction, '_extractors', registry), self.assertLogs('fileapp.extraction', 'WARNING'):
+            text = list(extraction.iter_text(self.write(b'anything', '.txt'), report=report))
+        self.assertEqual(text, ['recovered text'])
+        self.assertEqual((report.extractor, report.failed_extractors), ('working', ['broken']))
+        self.assertEqual(str(report), extraction.format_report(report.as_dict()))
+        self.assertIn('text/plain via working (after broken failed): 8 bytes -> 14 characters', str(report))
+
+
+class RangeHeaderTests(SimpleTestCase):
+    def test_absent_or_malformed(self):
+        for header in [None, '', 'items=0-1', 'bytes=', 'bytes=abc', 'bytes=5-2', 'bytes=1-x']:
+            with self.subTest(header=header):
+                self.assertIsNone(parse_range_header(header, 100))
+
+    def test_single_ranges(self):
+        self.assertEqual(parse_range_header('bytes=0-9', 100), [(0, 9)])
+        self.assertEqual(parse_range_header('bytes=90-', 100), [(90, 99)])
+        self.assertEqual(parse_range_header('bytes=-10', 100), [(90, 99)])
+        self.assertEqual(parse_range_header('bytes=50-500', 100), [(50, 99)])
+        self.assertEqual(parse_range_header('bytes=-500', 100), [(0, 99)])
+
+    def test_unsatisfiable(self):
+        self.assertEqual(parse_range_header('bytes=100-', 100), [])
+        self.assertEqual(parse_range_header('bytes=-0', 100), [])
+        self.assertEqual(parse_range_header('bytes=0-', 0), [])
+
+    def test_overlapping_and_adjacent_ranges_are_merged(self):
+        self.assertEqual(parse_range_header('bytes=20-29, 0-9, 10-14, 25-40', 100), [(0, 14), (20, 40)])
+
+    @override_settings(DOWNLOAD_MAX_RANGES=2)
+    def test_too_many_ranges(self):
+        self.assertIsNone(parse_range_header('bytes=0-1,3-4,6-7', 100))
+
+
+class DownloadTests(MediaTestCase):
+    content = bytes(range(256)) * 4
+
+    def setUp(self):
+        super().setUp()
+        self.file = self.upload('data.bin', self.content)
+        self.url = f'/api/download/{self.file.id}/'
+
+    def test_whole_file_with_validators(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['ETag'], f'"{self.file.blob.content_hash}"')
+        self.assertIn('data.bin', response['Content-Disposition'])
+
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_single_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.content)}')
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:20])
+
+    def test_multiple_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-1,100-101')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges'))
+        body = b''.join(response.streaming_content)
+        self.assertEqual(len(body), int(response['Content-Length']))
+        self.assertIn(self.content[100:102], body)
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.content)}')
+
+    def test_stale_if_range_serves_the_whole_file(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+
+@override_settings(UPLOAD_MAX_SIZE=1000, UPLOAD_MAX_CHUNK_SIZE=100)
+class ChunkedUploadTests(MediaTestCase):
+    def start(self, file_name='big.txt', size=None):
+        payload = {'file_name': file_name} if size is None else {'file_name': file_name, 'size': size}
+        return self.client.post('/api/upload/sessions/', json.dumps(payload), content_type='application/json')
+
+    def put(self, upload_id, offset, data):
+        return self.client.put(
+            f'/api/upload/sessions/{upload_id}/', data, content_type='application/octet-stream', HTTP_UPLOAD_OFFSET=str(offset),
+        )
+
+    def finish(self, upload_id):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(f'/api/upload/sessions/{upload_id}/finish/')
+
+    def test_upload_in_chunks(self):
+        content = b'budget review ' * 12
+        response = self.start(size=len(content))
+        self.assertEqual(response.status_code, 201)
+        upload_id = response.json()['upload_id']
+        for offset in range(0, len(content), 50):
+            response = self.put(upload_id, offset, content[offset:offset + 50])
+            self.assertEqual(response.json(), {'success': True, 'offset': min(offset + 50, len(content))})
+        self.assertEqual(self.client.get(f'/api/upload/sessions/{upload_id}/').json()['offset'], len(content))
+
+        response = self.finish(upload_id)
+        self.assertEqual(response.status_code, 201)
+        file_instance = File.objects.get(id=response.json()['file_id'])
+        self.assertEqual(file_instance.file_name, 'big.txt')
+        with file_instance.blob.file_content.open('rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(file_instance.blob.content_hash, sha256(content).hexdigest())
+        self.assertEqual(IngestJob.objects.get(file=file_instance).status, IngestJob.Status.QUEUED)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_wrong_offset_is_rejected_with_the_current_one(self):
+        upload_id = self.start().json()['upload_id']
+        self.put(upload_id, 0, b'x' * 10)
+        response = self.put(upload_id, 5, b'y' * 10)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 10)
+
+    def test_size_limits(self):
+        self.assertEqual(self.start(size=1001).status_code, 413)
+        upload_id = self.start(size=20).json()['upload_id']
+        self.assertEqual(self.put(upload_id, 0, b'x' * 101).status_code, 413)  # Over UPLOAD_MAX_CHUNK_SIZE
+        response = self.put(upload_id, 0, b'x' * 21)  # Past the announced size
+        self.assertEqual((response.status_code, response.json()['offset']), (413, 0))
+
+    def test_incomplete_upload_cannot_finish(self):
+        upload_id = self.start(size=20).json()['upload_id']
+        self.put(upload_id, 0, b'x' * 10)
+        response = self.finish(upload_id)
+        self.assertEqual((response.status_code, response.json()['offset']), (409, 10))
+
+    def test_chunk_being_written_blocks_others(self):
+        upload_id = self.start().json()['upload_id']
+        test, responses = self, []
+
+        class Body:
+            def read(self, size):
+                if not responses:
+                    # Other requests arrive while this chunk is still streaming
+                    responses.append(test.put(upload_id, 0, b'y' * 5))
+                    responses.append(test.finish(upload_id))
+                return b'x' * size
+
+        self.assertEqual(uploads.append_chunk(upload_id, 0, Body(), 10), 10)
+        self.assertEqual([response.status_code for response in responses], [409, 409])
+        self.assertIsNone(UploadSession.objects.get(id=upload_id).writer)
+
+    def test_stalled_writer_is_taken_over(self):
+        upload_id = self.start().json()['upload_id']
+        UploadSession.objects.filter(id=upload_id).update(writer=uuid.uuid4(), updated_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(self.put(upload_id, 0, b'x' * 10).status_code, 200)
+
+    def test_cancel(self):
+        upload_id = self.start().json()['upload_id']
+        self.put(upload_id, 0, b'x' * 10)
+        self.assertEqual(self.client.delete(f'/api/upload/sessions/{upload_id}/').status_code, 200)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(self.put(upload_id, 10, b'x').status_code, 404)
+
+    def test_known_content_reuses_the_blob(self):
+        existing = self.upload('small.txt', b'same bytes')
+        upload_id = self.start().json()['upload_id']
+        self.put(upload_id, 0, b'same bytes')
+        file_instance = File.objects.get(id=self.finish(upload_id).json()['file_id'])
+        self.assertEqual(file_instance.blob_id, existing.blob_id)
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+
+
+class ImportDirectoryTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source)
+        self.checkpoint = os.path.join(self.source, 'import.log')
+
+    def write(self, name, content):
+        with open(os.path.join(self.source, name), 'wb') as f:
+            f.write(content)
+
+    def run_import(self):
+        stdout = StringIO()
+        call_command(
+            'import_directory', self.source, '--workers', '1', '--no-preload', '--extensions', '.txt',
+            '--checkpoint', self.checkpoint, stdout=stdout, stderr=StringIO(),
+        )
+        return stdout.getvalue()
+
+    def test_resumes_from_the_checkpoint(self):
+        self.write('a.txt', b'quarterly budget review')
+        self.write('b.txt', b'quarterly budget review')
+        output = self.run_import()
+        self.assertNotIn('Resuming', output)
+        self.assertIn('Done: 2 files imported (1 duplicates', output)
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+
+        self.write('c.txt', b'annual holiday schedule')
+        output = self.run_import()
+        self.assertIn('Resuming: 2 files already imported', output)
+        self.assertIn('Done: 1 files imported', output)
+        self.assertEqual(sorted(File.objects.values_list('file_name', flat=True)), ['a.txt', 'b.txt', 'c.txt'])
+        self.assertTrue(FileTag.objects.filter(file__file_name='c.txt', tag__tag_name='holiday').exists())
+
+
+class ReindexTests(MediaTestCase):
+    def reindex(self, *args):
+        stdout = StringIO()
+        call_command('reindex_tags', '--workers', '1', '--no-preload', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_selects_stale_files(self):
+        current, old_tagger, old_extractor = (
+            self.upload(f'{name}.txt', f'{name} quarterly budget review'.encode()) for name in ('current', 'tagger', 'extractor')
+        )
+        self.ingest()
+        File.objects.filter(id=old_tagger.id).update(tagger_version=0)
+        File.objects.filter(id=old_extractor.id).update(extractor_version=0)
+        FileTag.objects.filter(file=old_tagger).delete()
+
+        self.assertEqual([file_id for batch in reindex.stale_files(10) for file_id, _ in batch], [old_tagger.id])
+        self.assertEqual(
+            [file_id for batch in reindex.stale_files(1, reextract=True) for file_id, _ in batch],
+            [old_tagger.id, old_extractor.id],
+        )
+
+        self.assertIn('1 files re-tagged, 0 queued for extraction', self.reindex())
+        old_tagger.refresh_from_db()
+        self.assertEqual(old_tagger.tagger_version, nlp.tagger_version())
+        self.assertTrue(FileTag.objects.filter(file=old_tagger, tag__tag_name='budget').exists())
+        self.assertEqual(list(reindex.stale_files(10)), [])
+
+        ExtractedText.objects.filter(blob=old_extractor.blob).update(extractor_version=0)
+        self.assertIn('0 files re-tagged, 1 queued for extraction', self.reindex('--reextract'))
+        self.assertEqual(IngestJob.objects.filter(file=old_extractor, status=IngestJob.Status.QUEUED).count(), 1)
+        current.refresh_from_db()
+        self.assertEqual(current.ingest_status, File.IngestStatus.DONE)
+
+
+class CursorTests(SimpleTestCase):
+    def test_round_trip(self):
+        for score, file_id in [(0.0, 1), (12.345678901234567, 42), (1e-12, 10 ** 12)]:
+            with self.subTest(score=score, file_id=file_id):
+                self.assertEqual(decode_cursor(encode_cursor(score, file_id)), (score, file_id))
+
+    def test_cursor_is_url_safe(self):
+        cursor = encode_cursor(3.5, 7)
+        self.assertNotRegex(cursor, r'[+/=]')
+
+    def test_malformed_cursor(self):
+        for cursor in ['not a cursor', encode_cursor(1.0, 2)[:-3], '%%%']:
+            with self.subTest(cursor=cursor), self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+
+class SearchPagingTests(MediaTestCase):
+    def test_pages_follow_next_cursor(self):
+        for index in range(5):
+            self.upload(f'{index}.txt', f"{'budget ' * (index + 1)}report".encode())
+        self.ingest()
+
+        seen, cursor = [], None
+        while True:
+            params = {'q': 'budget', 'limit': 2, **({'cursor': cursor} if cursor else {})}
+            page = self.client.get('/api/search/results/', params).json()
+            self.assertEqual(page['total'], {'value': 5, 'relation': 'eq'})
+            self.assertLessEqual(len(page['results']), 2)
+            seen += [hit['file_name'] for hit in page['results']]
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(seen, ['4.txt', '3.txt', '2.txt', '1.txt', '0.txt'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/search/results/', {'q': 'budget', 'cursor': 'not a cursor'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['message'], 'Invalid cursor.')
+
+
+class DocFreqTests(MediaTestCase):
+    def doc_freqs(self):
+        return dict(Tag.objects.filter(doc_freq__gt=0).values_list('tag_name', 'doc_freq'))
+
+    def test_kept_up_to_date_by_tag_writes(self):
+        first, second, copy = make_file('first.txt'), make_file('second.txt'), make_file('copy.txt')
+        tags.save_tags_for_files([(first, {'budget': [0, 3], 'report': [1]}), (second, {'budget': 2})])
+        self.assertEqual(self.doc_freqs(), {'budget': 2, 'report': 1})
+
+        tags.copy_tags(first.id, copy)
+        self.assertEqual(self.doc_freqs(), {'budget': 3, 'report': 2})
+
+        tags.delete_tags([first.id, second.id])
+        self.assertEqual(self.doc_freqs(), {'budget': 1, 'report': 1})
+        tags.delete_tags([first.id])  # Nothing left to remove
+        self.assertEqual(self.doc_freqs(), {'budget': 1, 'report': 1})
+
+    def test_maintained_through_ingestion_and_deletion(self):
+        kept = self.upload('kept.txt', b'budget review')
+        deleted = self.upload('deleted.txt', b'budget schedule')
+        self.ingest()
+        self.assertEqual(Tag.objects.get(tag_name='budget').doc_freq, 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post(f'/api/delete/{deleted.id}/').status_code, 200)
+        self.assertEqual(Tag.objects.get(tag_name='budget').doc_freq, 1)
+        self.assertEqual(Tag.objects.get(tag_name='schedule').doc_freq, 0)
+        self.assertTrue(FileTag.objects.filter(file=kept).exists())
+
+    def test_recount(self):
+        file_instance = make_file('direct.txt')
+        tags.save_tags(file_instance, {'budget': 1})
+        Tag.objects.update(doc_freq=7)
+        Tag.objects.create(tag_name='unused', doc_freq=3)
+        tags.recount_doc_freqs()
+        self.assertEqual(dict(Tag.objects.values_list('tag_name', 'doc_freq')), {'budget': 1, 'unused': 0})
+
+
+class BlobStorageTests(MediaTestCase):
+    def gc(self, *args):
+        stdout = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('gc_blobs', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def write_media(self, name, content, age=0):
+        path = os.path.join(settings.MEDIA_ROOT, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        if age:
+            os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    def test_gc_waits_for_the_grace_period(self):
+        kept = self.upload('kept.txt', b'kept content')
+        deleted = self.upload('deleted.txt', b'deleted content')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/api/delete/{deleted.id}/')
+        path = deleted.blob.file_content.path
+
+        self.assertIn('Deleted 0 unreferenced blobs', self.gc('--grace', '3600'))
+        self.assertIn('Would delete 1 unreferenced blobs', self.gc('--grace', '0', '--dry-run'))
+        self.assertTrue(os.path.exists(path))
+        self.assertIn('Deleted 1 unreferenced blobs', self.gc('--grace', '0'))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(list(Blob.objects.values_list('id', flat=True)), [kept.blob_id])
+        self.assertTrue(os.path.exists(kept.blob.file_content.path))
+
+    def test_gc_sweeps_orphaned_files(self):
+        kept = self.upload('kept.txt', b'kept content')
+        os.utime(kept.blob.file_content.path, (time.time() - 7200, time.time() - 7200))
+        old = self.write_media('blobs/ab/cd/stray.txt', b'left behind', age=7200)
+        recent = self.write_media('blobs/ab/cd/recent.txt', b'being uploaded')
+        self.assertIn('Deleted 1 files without a blob or preview', self.gc('--grace', '3600'))
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(recent))
+        self.assertTrue(os.path.exists(kept.blob.file_content.path))
+
+    def test_shard_blobs_moves_flat_blobs(self):
+        content = b'stored before sharding'
+        content_hash = sha256(content).hexdigest()
+        self.write_media('uploaded_files/old.txt', content)
+        blob = Blob.objects.create(content_hash=content_hash, file_content='uploaded_files/old.txt', size=len(content), ref_count=1)
+        File.objects.create(file_name='old.txt', blob=blob)
+
+        self.assertIn('Run shard_blobs first', self.gc())
+        call_command('shard_blobs', stdout=StringIO())
+        blob.refresh_from_db()
+        self.assertTrue(blob.file_content.name.startswith(f'blobs/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}'))
+        with blob.file_content.open('rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, 'uploaded_files/old.txt')))
+        self.assertNotIn('Run shard_blobs first', self.gc())
+        call_command('shard_blobs', stdout=StringIO())  # Nothing left to move
+        self.assertEqual(Blob.objects.get().file_content.name, blob.file_content.name)
+
+
+class SignatureTests(SimpleTestCase):
+    def test_empty_tag_set_has_no_signature(self):
+        self.assertIsNone(similarity.signature(set()))
+
+    def test_signature_is_deterministic(self):
+        first = similarity.signature({1, 2, 3})
+        self.assertEqual(len(first), similarity.PERMUTATIONS)
+        self.assertEqual(first.tolist(), similarity.signature({3, 2, 1}).tolist())
+
+    def test_band_keys(self):
+        keys = similarity.band_keys(similarity.signature(set(range(1, 50))))
+        self.assertEqual(len(keys), similarity.BANDS)
+        self.assertTrue(all(-2 ** 63 <= key < 2 ** 63 for key in keys))
+        self.assertEqual(keys, similarity.band_keys(similarity.signature(set(range(1, 50)))))
+
+    def test_similar_sets_share_bands(self):
+        tags = set(range(1, 201))
+        near = similarity.band_keys(similarity.signature(tags - {1, 2, 3} | {1001, 1002, 1003}))
+        far = similarity.band_keys(similarity.signature(set(range(5000, 5200))))
+        keys = similarity.band_keys(similarity.signature(tags))
+        self.assertTrue(set(keys) & set(near))
+        self.assertFalse(set(keys) & set(far))
+
+    def test_signature_agreement_estimates_jaccard(self):
+        first = similarity.signature(set(range(0, 1000)))
+        second = similarity.signature(set(range(500, 1500)))  # Jaccard 1/3
+        self.assertAlmostEqual(float((first == second).mean()), 1 / 3, delta=0.12)
+
+
+class SimilarFilesTests(MediaTestCase):
+    def test_similar_files_api(self):
+        words = [f'word{index}' for index in range(200)]
+        base, near, far = make_file('base.txt'), make_file('near.txt'), make_file('far.txt')
+        copy = File.objects.create(file_name='copy.txt', blob=base.blob)
+        tags.save_tags_for_files([
+            (base, dict.fromkeys(words, 1)),
+            (near, dict.fromkeys(words[3:] + ['other0', 'other1', 'other2'], 1)),
+            (far, {f'unrelated{index}': 1 for index in range(200)}),
+        ])
+        File.objects.update(ingest_status=File.IngestStatus.DONE)
+
+        response = self.client.get(f'/api/similar/{base.id}/')
+        self.assertEqual(response.status_code, 200)
+        hits = response.json()['results']
+        self.assertEqual([hit['file_name'] for hit in hits], ['copy.txt', 'near.txt'])
+        self.assertEqual(hits[0]['score'], 1.0)
+        self.assertGreater(hits[1]['score'], 0.8)
+        self.assertEqual(len(self.client.get(f'/api/similar/{base.id}/', {'limit': 1}).json()['results']), 1)
+        self.assertEqual(self.client.get(f'/api/similar/{copy.id + 100}/').status_code, 404)
+
+
+class AdvancedSearchTests(MediaTestCase):
+    def search(self, query):
+        response = self.client.get('/api/search/results/', {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return sorted(hit['file_name'] for hit in response.json()['results'])
+
+    def test_operators_and_phrases(self):
+        self.upload('plan.txt', b'The budget review is scheduled for Monday.')
+        self.upload('review.txt', b'Review the new budget before the meeting.')
+        self.upload('holiday.txt', b'Holiday schedule for the whole team.')
+        self.ingest()
+        self.assertEqual(self.search('budget AND review'), ['plan.txt', 'review.txt'])
+        self.assertEqual(self.search('"budget review"'), ['plan.txt'])
+        self.assertEqual(self.search('budget -meeting'), ['plan.txt'])
+        self.assertEqual(self.search('holi*'), ['holiday.txt'])
+        self.assertEqual(self.search('(holiday OR meeting) NOT budget'), ['holiday.txt'])
+
+    def test_malformed_query(self):
+        response = self.client.get('/api/search/results/', {'q': 'budget AND'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.json()['success'])
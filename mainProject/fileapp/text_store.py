@@ -0,0 +1,71 @@
+"""Compressed storage of extracted text.
+
+The text of each stored blob is kept zlib-compressed in `ExtractedText`, so
+changing the tagging rules only needs re-tagging (`reindex_tags`) instead of
+re-running OCR and PDF parsing. Compression happens as the extractor streams
+chunks, and stored text is decompressed back into chunks, so neither side
+holds a second full copy of a long document. Like `extraction`, this module
+must not import models: it runs in the worker's child processes.
+"""
+import codecs
+import zlib
+
+COMPRESSION_LEVEL = 6
+DECOMPRESS_SIZE = 1024 * 1024  # Compressed bytes inflated at a time when reading text back
+
+
+def extend_lead(lead, chunk, length):
+    """`lead` followed by the start of `chunk`, whitespace collapsed, cut at `length` characters."""
+    if len(lead) >= length:
+        return lead
+    return " ".join(f"{lead} {chunk[:2 * length]}".split())[:length]
+
+
+class TextRecorder:
+    """Passes text chunks through while compressing them; `data` holds the result once exhausted.
+
+    The first `lead_length` characters (whitespace collapsed) are kept in
+    `lead`, for search result previews.
+    """
+
+    def __init__(self, chunks, lead_length=0):
+        self.chunks = chunks
+        self.characters = 0
+        self.data = None
+        self.lead = ''
+        self.lead_length = lead_length
+
+    def __iter__(self):
+        compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        parts = []
+        first = True
+        for chunk in self.chunks:
+            if not first:
+                parts.append(compressor.compress(b"\n"))  # Chunks are joined like `extract_text` joins them
+            first = False
+            parts.append(compressor.compress(chunk.encode('utf-8', 'surrogatepass')))
+            self.characters += len(chunk)
+            self.lead = extend_lead(self.lead, chunk, self.lead_length)
+            yield chunk
+        parts.append(compressor.flush())
+        self.data = b"".join(parts)
+
+
+def iter_text_chunks(data):
+    """Yields stored text back in chunks, inflating `DECOMPRESS_SIZE` compressed bytes at a time.
+
+    Chunks end at whitespace, so no word is cut in two for the tagger.
+    """
+    decompressor = zlib.decompressobj()
+    decoder = codecs.getincrementaldecoder('utf-8')('surrogatepass')
+    view = memoryview(data)
+    pending = ''
+    for start in range(0, len(view), DECOMPRESS_SIZE):
+        pending += decoder.decode(decompressor.decompress(view[start:start + DECOMPRESS_SIZE]))
+        cut = max(pending.rfind(' '), pending.rfind('\n'))
+        if cut > 0:
+            yield pending[:cut]
+            pending = pending[cut:]
+    pending += decoder.decode(decompressor.flush(), final=True)
+    if pending:
+        yield pending
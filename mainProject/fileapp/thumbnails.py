@@ -0,0 +1,82 @@
+"""First-page thumbnails of stored files, rendered during ingestion.
+
+Runs in the ingestion worker's child processes along with extraction, so
+like `extraction` this module must not import models. PDFs get their first
+page rendered by pdfium directly, skipping pdfplumber's layout parsing, at
+just the resolution the thumbnail needs; images are decoded at a reduced
+scale where the format allows it (JPEG draft mode) and scaled down.
+Thumbnails are small WebP images; other content types have none, only a
+text snippet (see `previews`).
+"""
+import io
+import logging
+
+from django.conf import settings
+
+from . import metrics
+from .backends import get_backend
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_CONTENT_TYPE = 'image/webp'
+
+
+def has_thumbnail(content_type):
+    """Whether files of a content type get a thumbnail."""
+    return content_type == 'application/pdf' or content_type.startswith('image/')
+
+
+def _first_pdf_page(file_path, box):
+    pdf = get_backend('pdfium').PdfDocument(file_path)
+    try:
+        if len(pdf) == 0:
+            return None
+        page = pdf[0]
+        scale = box / max(*page.get_size(), 1)  # The longest side at about `box` pixels
+        return page.render(scale=scale).to_pil()
+    finally:
+        pdf.close()
+
+
+def _first_image_frame(file_path, box):
+    Image = get_backend('pil')
+    ImageOps = get_backend('pil_ops')
+    with Image.open(file_path) as image:
+        image.draft('RGB', (box, box))  # Lets the JPEG decoder skip most of the work
+        return ImageOps.exif_transpose(image)  # A loaded copy, usable once the file is closed
+
+
+def _flatten(image):
+    """RGB copy of an image, transparent pixels turned white."""
+    Image = get_backend('pil')
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    return image.convert('RGB') if image.mode != 'RGB' else image
+
+
+def render_thumbnail(file_path, content_type):
+    """WebP bytes of a thumbnail of a file's first page, or None if it has none or can't be rendered.
+
+    The thumbnail fits in a square of `PREVIEW_THUMBNAIL_SIZE` pixels.
+    """
+    if not has_thumbnail(content_type):
+        return None
+    box = getattr(settings, 'PREVIEW_THUMBNAIL_SIZE', 256)
+    render = _first_pdf_page if content_type == 'application/pdf' else _first_image_frame
+    try:
+        with metrics.span('thumbnail', content_type=content_type):
+            image = render(file_path, box)
+            if image is None:
+                return None
+            image = _flatten(image)
+            image.thumbnail((box, box), get_backend('pil').Resampling.LANCZOS, reducing_gap=2.0)
+            output = io.BytesIO()
+            image.save(output, 'WEBP', quality=getattr(settings, 'PREVIEW_THUMBNAIL_QUALITY', 60), method=4)
+    except Exception:
+        # A preview is not worth failing the job over; the file is still indexed
+        logger.warning("Thumbnail of %s failed", file_path, exc_info=True)
+        metrics.count('thumbnail_failures', content_type=content_type)
+        return None
+    return output.getvalue()
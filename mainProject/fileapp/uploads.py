@@ -0,0 +1,248 @@
+"""Resumable chunked uploads.
+
+A client starts a session, appends the file in chunks at explicit offsets and
+finishes it. Each chunk is streamed from the request straight into a staging
+file inside MEDIA_ROOT and into a running sha256, so every byte is read from
+the network and written to disk exactly once: finishing only renames the
+staging file into blob storage (or drops it if the content is already
+stored) and queues ingestion.
+
+sha256 state can't be saved, so running hashes live in a per-process cache.
+When a chunk arrives at a process that doesn't hold the session's hash (after
+a restart, or behind a load balancer), the bytes received so far are re-read
+from the staging file once to rebuild it.
+"""
+import os
+import time
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+from hashlib import sha256
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+
+from . import metrics
+from .ingest import enqueue_ingest
+from .models import File, UploadSession
+from .storage import StagedFile, acquire_blob, release_blob
+
+STAGING_DIR = 'uploads'
+READ_SIZE = 1024 * 1024  # Bytes read from the request (and the staging file) at a time
+
+
+class UploadError(Exception):
+    """A rejected upload request; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# Session id -> (offset, running sha256 of the bytes before offset), least recently used first
+_hashers = OrderedDict()
+
+
+def _cache_hasher(session_id, offset, hasher):
+    _hashers[session_id] = (offset, hasher)
+    _hashers.move_to_end(session_id)
+    while len(_hashers) > _setting('UPLOAD_HASHER_CACHE_SIZE', 256):
+        _hashers.popitem(last=False)
+
+
+def _hasher_at(session, path):
+    """The running sha256 of the session's first `received` bytes, rebuilt from disk if not cached."""
+    cached = _hashers.pop(session.id, None)
+    if cached is not None and cached[0] == session.received:
+        return cached[1]
+    hasher = sha256()
+    remaining = session.received
+    with open(path, 'rb') as f:
+        while remaining:
+            data = f.read(min(READ_SIZE, remaining))
+            if not data:
+                raise UploadError("Staged upload data is missing.", status=410)
+            hasher.update(data)
+            remaining -= len(data)
+    return hasher
+
+
+def _staging_path(session):
+    return default_storage.path(session.staging_name)
+
+
+def expire_sessions():
+    """Deletes sessions idle for longer than `UPLOAD_SESSION_TTL`, with their partial files."""
+    cutoff = timezone.now() - timedelta(seconds=_setting('UPLOAD_SESSION_TTL', 24 * 60 * 60))
+    for session in UploadSession.objects.filter(updated_at__lt=cutoff):
+        abort_session(session)
+
+
+def start_session(file_name, size=None):
+    """Opens an upload session, rejecting announced sizes over `UPLOAD_MAX_SIZE` right away."""
+    max_size = _setting('UPLOAD_MAX_SIZE', None)
+    if size is not None and (size < 0 or (max_size and size > max_size)):
+        raise UploadError(f"Files may be at most {max_size} bytes.", status=413)
+    expire_sessions()
+    session = UploadSession(file_name=file_name, size=size)
+    session.staging_name = f"{STAGING_DIR}/{session.id.hex}.part"
+    path = _staging_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    session.save()
+    _cache_hasher(session.id, 0, sha256())
+    return session
+
+
+def _claim_timeout():
+    return timedelta(seconds=_setting('UPLOAD_CHUNK_TIMEOUT', 10 * 60))
+
+
+def _being_written(session):
+    """Whether a chunk request holds the session and has made progress within `UPLOAD_CHUNK_TIMEOUT`."""
+    return session.writer is not None and session.updated_at >= timezone.now() - _claim_timeout()
+
+
+def _claim(session_id, offset, length):
+    """Checks a chunk against the session and marks the session as written by this request.
+
+    Holds the row lock only for the checks, so the body is streamed without
+    it; a second request for the session meanwhile is answered 409.
+    """
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().filter(id=session_id).first()
+        if session is None:
+            raise UploadError("Unknown upload session.", status=404)
+        if _being_written(session):
+            raise UploadError("Another chunk is being written to this upload.", status=409, offset=session.received)
+        if offset != session.received:
+            raise UploadError("Chunk does not start at the current offset.", status=409, offset=session.received)
+        limit = session.size if session.size is not None else _setting('UPLOAD_MAX_SIZE', None)
+        if limit and offset + length > limit:
+            raise UploadError(f"Upload would exceed {limit} bytes.", status=413, offset=session.received)
+        session.writer = uuid.uuid4()
+        session.save(update_fields=['writer', 'updated_at'])
+    return session
+
+
+def _still_claimed(session):
+    """Renews the session's claim; False if it was taken over or the session is gone."""
+    return UploadSession.objects.filter(id=session.id, writer=session.writer).update(updated_at=timezone.now()) == 1
+
+
+def _commit(session, offset, written):
+    """Records the bytes written and releases the claim, if the session is still this request's at `offset`."""
+    with transaction.atomic():
+        current = UploadSession.objects.select_for_update().filter(id=session.id).first()
+        if current is None:
+            raise UploadError("Unknown upload session.", status=404)
+        if current.writer != session.writer or current.received != offset:
+            raise UploadError("Upload was taken over while the chunk was written.", status=409, offset=current.received)
+        current.received = offset + written
+        current.writer = None
+        current.save(update_fields=['received', 'writer', 'updated_at'])
+    return current
+
+
+def append_chunk(session_id, offset, stream, length):
+    """Appends `length` bytes read from `stream` at `offset`; returns the new offset.
+
+    The offset must equal the bytes received so far (409 with the current
+    offset otherwise), so clients resume by asking for the offset and sending
+    from there. If the stream breaks mid-chunk, the bytes written up to that
+    point are kept.
+
+    The session is locked twice, briefly: to check the offset and claim the
+    session before the body is read, and to record the new offset after it.
+    A claim without progress for `UPLOAD_CHUNK_TIMEOUT` (a stalled client)
+    may be taken over by the next request.
+    """
+    max_chunk = _setting('UPLOAD_MAX_CHUNK_SIZE', None)
+    if max_chunk and length > max_chunk:
+        raise UploadError(f"Chunks may be at most {max_chunk} bytes.", status=413)
+
+    with metrics.span('upload_chunk', size=length):
+        session = _claim(session_id, offset, length)
+        committed = False
+        try:
+            path = _staging_path(session)
+            hasher = _hasher_at(session, path)
+            renew_every = _claim_timeout().total_seconds() / 2
+            last_renewal = time.monotonic()
+            written = 0
+            with open(path, 'r+b') as f:
+                f.seek(offset)
+                f.truncate()  # Drop bytes of an earlier attempt that were never acknowledged
+                while written < length:
+                    try:
+                        data = stream.read(min(READ_SIZE, length - written))
+                    except OSError:  # Client disconnected; keep what arrived
+                        break
+                    if not data:
+                        break
+                    # Checked before writing, so a client that stalled past the timeout can't overwrite a takeover
+                    if time.monotonic() - last_renewal >= renew_every:
+                        if not _still_claimed(session):
+                            raise UploadError("Upload was taken over while the chunk was written.", status=409)
+                        last_renewal = time.monotonic()
+                    f.write(data)
+                    hasher.update(data)
+                    written += len(data)
+            metrics.count('bytes', written, stage='upload')
+            session = _commit(session, offset, written)
+            committed = True
+        finally:
+            if not committed:
+                # Bytes past `received` are dropped by the next chunk's truncate
+                UploadSession.objects.filter(id=session.id, writer=session.writer).update(writer=None)
+        _cache_hasher(session.id, session.received, hasher)
+    if written < length:
+        raise UploadError("Chunk ended early; resume from the returned offset.", status=400, offset=session.received)
+    return session.received
+
+
+def finish_session(session_id):
+    """Moves the uploaded file into blob storage, creates its `File` and queues ingestion."""
+    with transaction.atomic(), metrics.span('store', upload_id=str(session_id)):
+        session = UploadSession.objects.select_for_update().filter(id=session_id).first()
+        if session is None:
+            raise UploadError("Unknown upload session.", status=404)
+        if _being_written(session):
+            raise UploadError("A chunk is still being written to this upload.", status=409, offset=session.received)
+        if session.size is not None and session.received != session.size:
+            raise UploadError("Upload is incomplete.", status=409, offset=session.received)
+        path = _staging_path(session)
+        content_hash = _hasher_at(session, path).hexdigest()
+
+        blob = acquire_blob(StagedFile(path, os.path.basename(session.file_name)), content_hash)
+        try:
+            file_instance = File.objects.create(
+                file_name=session.file_name,
+                blob=blob,
+                ingest_status=File.IngestStatus.PENDING,
+            )
+        except Exception:
+            release_blob(blob.id)
+            raise
+        if os.path.exists(path):  # Content was already stored, so the staged copy wasn't moved
+            transaction.on_commit(lambda: os.remove(path))
+        session.delete()
+        enqueue_ingest(file_instance)
+    return file_instance
+
+
+def abort_session(session):
+    """Deletes a session and its partial file."""
+    _hashers.pop(session.id, None)
+    session.delete()
+    try:
+        os.remove(_staging_path(session))
+    except FileNotFoundError:
+        pass
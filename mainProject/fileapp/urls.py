@@ -1,11 +1,24 @@
+from django.conf import settings
 from django.urls import path
 from . import views  # Import views from the current directory
 
+# Under ASGI, the read-heavy endpoints are served by their async versions
+ASYNC_VIEWS = getattr(settings, 'ASYNC_VIEWS', False)
+
 urlpatterns = [
     path('upload/', views.upload_and_search, name='upload_and_search'),  # For uploading files and searching
     path('search/', views.upload_and_search, name='search'),  # For searching files
-    path('download/<int:file_id>/', views.download_file, name='download_file'),  # For downloading files
+    path('search/results/', views.asearch_files if ASYNC_VIEWS else views.search_files, name='search_files'),  # JSON search with cursor pagination
+    path('search/cache-stats/', views.search_cache_stats, name='search_cache_stats'),  # Search cache hit/miss counters
+    path('upload/sessions/', views.start_upload, name='start_upload'),  # Start a resumable chunked upload
+    path('upload/sessions/<uuid:upload_id>/', views.upload_chunk, name='upload_chunk'),  # Query, append to or cancel an upload
+    path('upload/sessions/<uuid:upload_id>/finish/', views.finish_upload, name='finish_upload'),  # Complete an upload
+    path('download/<int:file_id>/', views.adownload_file if ASYNC_VIEWS else views.download_file, name='download_file'),  # For downloading files
+    path('preview/<int:file_id>/thumbnail/', views.preview_thumbnail, name='preview_thumbnail'),  # First-page thumbnail shown with search hits
+    path('similar/<int:file_id>/', views.similar_files, name='similar_files'),  # Files with the most similar tags
     path('delete/<int:file_id>/', views.delete_file, name='delete_file'),  # For deleting files
     path('rename/<int:file_id>/', views.rename_file, name='rename_file'),  # For renaming files
+    path('status/<int:file_id>/', views.aingest_status if ASYNC_VIEWS else views.ingest_status, name='ingest_status'),  # For polling ingestion progress
+    path('metrics/', views.metrics_endpoint, name='metrics'),  # Prometheus text-format metrics
     path('files/', views.upload_and_search, name='files'),  # To fetch the list of files
 ]
@@ -1,74 +1,28 @@
-from django.shortcuts import render, get_object_or_404, redirect
-from django.http import HttpResponse, FileResponse, JsonResponse
-from .models import File, Tag, FileTag
+from django.shortcuts import aget_object_or_404, render, get_object_or_404, redirect
+from django.urls import reverse
+from django.http import Http404, HttpResponse, JsonResponse
+from .models import File, UploadSession
 from .forms import UploadFileForm, SearchForm
-from hashlib import sha256
-import pdfplumber
-import textract
-import docx2txt
-import spacy
-from PIL import Image
-import pytesseract
+from .downloads import serve_blob
+from .ingest import aingest_state, enqueue_ingest, ingest_state
+from . import metrics, previews, search_cache, similarity
+from .query import QuerySyntaxError
+from .search import asearch, search
+from .storage import acquire_blob, hash_file, release_blob
+from .tags import delete_tags
+from .uploads import UploadError, abort_session, append_chunk, finish_session, start_session
+import asyncio
 import os
 import uuid
 from django.views.decorators.http import require_http_methods
+from django.db import transaction
 from django.db.models import Count
-from collections import defaultdict
 import re  # Import for regex validation
 import json  # Import for handling JSON data
+import logging
 from django.conf import settings
 
-# Configure pytesseract path for Windows
-pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
-
-# Load spaCy NLP model
-nlp = spacy.load('en_core_web_sm')
-
-
-def extract_text_from_image(image_path):
-    """Extracts text from an image file using OCR."""
-    try:
-        img = Image.open(image_path)
-        extracted_text = pytesseract.image_to_string(img)
-        return extracted_text
-    except Exception as e:
-        return f"Error extracting text from image: {e}"
-
-
-def pdf_reader(file_path):
-    """Extracts text from a PDF file."""
-    try:
-        with pdfplumber.open(file_path) as pdf:
-            all_text = ""
-            for page in pdf.pages:
-                text = page.extract_text()
-                all_text += text + "\n" if text else ""
-            return all_text
-    except Exception as e:
-        return f"Error reading PDF: {e}"
-
-
-def doc_reader(file_path):
-    """Extracts text from DOC and DOCX files."""
-    try:
-        if file_path.name.endswith('.doc'):
-            text = textract.process(file_path).decode('utf-8')
-        else:
-            text = docx2txt.process(file_path)
-        return text
-    except Exception as e:
-        return f"Error reading document: {e}"
-
-
-def generate_tags(content):
-    """Generates tags from the content using NLP."""
-    try:
-        doc = nlp(content)
-        tags = {token.lemma_.lower() for token in doc if token.is_alpha and not token.is_stop}
-        return tags
-    except Exception as e:
-        print(f"Error generating tags: {e}")
-        return set()
+logger = logging.getLogger(__name__)
 
 
 def rename_file_if_too_long(file_name, max_length=50):
@@ -80,97 +34,232 @@ def rename_file_if_too_long(file_name, max_length=50):
     return file_name
 
 
-def save_file(file_name, file_content, tags):
-    """Saves the file and associates it with the provided tags."""
+def save_file(file_name, file_content):
+    """Saves the uploaded file; tags are added later by the ingestion worker."""
     try:
         file_name = rename_file_if_too_long(file_name, max_length=50)
-        content_hash = sha256(file_content.read()).hexdigest()
-        file_content.seek(0)  # Reset file pointer after reading
-        
-        # Save the file instance
-        file_instance = File(file_name=file_name, file_content=file_content, content_hash=content_hash)
-        file_instance.save()
+        content_hash = hash_file(file_content)
+
+        # Reuse the stored copy if this content was uploaded before
+        with metrics.span('store', file_name=file_name):
+            blob = acquire_blob(file_content, content_hash)
+            try:
+                file_instance = File.objects.create(
+                    file_name=file_name,
+                    blob=blob,
+                    ingest_status=File.IngestStatus.PENDING,
+                )
+            except Exception:
+                release_blob(blob.id)
+                raise
+
+        saved_file_path = blob.file_content.path
+        logger.debug("File %d saved at %s", file_instance.id, saved_file_path)
 
-        # Debugging: Log the saved file path
-        saved_file_path = file_instance.file_content.path
-        print(f"File saved at: {saved_file_path}")  # Debugging print
-        
         # Verify that the file exists after saving
         if not os.path.exists(saved_file_path):
-            print(f"Error: File was saved but does not exist at path: {saved_file_path}")  # Debugging print
-            return  # Return early if file does not exist
-        
-        # Associate tags with the file
-        for tag_name in tags:
-            tag, created = Tag.objects.get_or_create(tag_name=tag_name)
-            FileTag.objects.create(file=file_instance, tag=tag)
-    except Exception as e:
-        print(f"Error saving file: {e}")
-
-
-def perform_search(query):
-    """Performs a search on files based on the provided query."""
-    search_tags = generate_tags(query)
-    file_hit_count = defaultdict(int)
-    for tag in search_tags:
-        tag_file_hits = (
-            FileTag.objects
-            .filter(tag__tag_name=tag)
-            .values_list('file', flat=True)
-            .distinct()
-        )
-        for file_hit in tag_file_hits:
-            file_hit_count[file_hit] += 1
-    sorted_file_hits = sorted(
-        file_hit_count.items(),
-        key=lambda x: x[1],
-        reverse=True
-    )
-    files = [File.objects.get(id=file_id) for file_id, _ in sorted_file_hits]
-    return files
+            logger.error("File %d was saved but does not exist at %s", file_instance.id, saved_file_path)
+            return None  # Return early if file does not exist
+        return file_instance
+    except Exception:
+        logger.exception("Error saving %s", file_name)
+        return None
+
+
+FIRST_PAGE = '~'  # Stands for the first page's (empty) cursor in the pagination history
+
+
+def perform_search(query, cursor=None):
+    """Performs a search on files based on the provided query; a malformed cursor restarts at the first page."""
+    try:
+        return search(query, cursor=cursor)
+    except QuerySyntaxError:
+        return None  # The search form reports it
+    except ValueError:
+        return search(query)
 
 
 def upload_and_search(request):
     """Handles file uploads and search queries."""
     upload_form = UploadFileForm()
     search_form = SearchForm()
-    files = []
+    results = None
     query = ""
+    uploaded_file = None
+    cursor = None
+    history = []  # Cursors of the pages before this one, so "Previous" can go back
 
     if request.method == 'POST':
         query = request.POST.get('query', '')
+        cursor = request.POST.get('cursor') or None
+        history = [entry for entry in request.POST.get('history', '').split(',') if entry]
         if request.POST.get('action') == 'upload':
             upload_form = UploadFileForm(request.POST, request.FILES)
             if upload_form.is_valid():
                 file = request.FILES['file']
-                if file.name.endswith('.pdf'):
-                    text = pdf_reader(file)
-                elif file.name.endswith(('.doc', '.docx')):
-                    text = doc_reader(file)
-                elif file.name.endswith(('.jpg', 'png', 'jpeg')):
-                    text = extract_text_from_image(file)
 
-                # Generate tags and save file
-                tags = generate_tags(text)
-                save_file(file.name, file, tags)
+                # Persist the file and hand extraction/tagging to the ingestion worker
+                uploaded_file = save_file(file.name, file)
+                if uploaded_file is not None:
+                    enqueue_ingest(uploaded_file)
 
                 # Re-check saved files
-                files = perform_search(query)
+                results = perform_search(query)
+                cursor, history = None, []
             else:
-                print("Invalid upload form.")  # Debugging print
+                logger.info("Invalid upload form: %s", upload_form.errors.as_json())
         elif request.POST.get('action') == 'search':
             search_form = SearchForm(request.POST)
             if search_form.is_valid():
                 query = search_form.cleaned_data['query']
-                files = perform_search(query)
+                results = perform_search(query, cursor)
 
+    previous_cursor = history[-1] if history else None
     return render(request, 'fileapp/upload_and_search.html', {
         'upload_form': upload_form,
-        'search_form': SearchForm(initial={'query': query}),
-        'files': files,
+        'search_form': search_form if search_form.errors else SearchForm(initial={'query': query}),
+        'files': results.files if results else [],
+        'results': results,
         'query': query,
+        'uploaded_file': uploaded_file,
+        'page_number': len(history) + 1,
+        'has_previous': previous_cursor is not None,
+        'previous_cursor': '' if previous_cursor == FIRST_PAGE else previous_cursor,
+        'previous_history': ','.join(history[:-1]),
+        'next_history': ','.join(history + [cursor or FIRST_PAGE]),
     })
 
+
+def _search_arguments(request):
+    """`(query, cursor, page_size)` of a JSON search request; the query is empty if missing."""
+    limit = request.GET.get('limit', '')
+    max_limit = getattr(settings, 'SEARCH_MAX_PAGE_SIZE', 100)
+    page_size = min(int(limit), max_limit) if limit.isdigit() and int(limit) > 0 else None
+    return request.GET.get('q', '').strip(), request.GET.get('cursor') or None, page_size
+
+
+def search_files(request):
+    """JSON search API: `q`, optional `cursor` (from `next_cursor`) and `limit`; returns one page of hits."""
+    query, cursor, page_size = _search_arguments(request)
+    if not query:
+        return JsonResponse({'success': False, 'message': 'Query is required.'}, status=400)
+    try:
+        results = search(query, cursor=cursor, page_size=page_size)
+    except QuerySyntaxError as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+    except ValueError:
+        return JsonResponse({'success': False, 'message': 'Invalid cursor.'}, status=400)
+    return JsonResponse({'success': True, 'query': query, **results.as_dict()})
+
+
+async def asearch_files(request):
+    """`search_files` for ASGI (routed with ASYNC_VIEWS)."""
+    query, cursor, page_size = _search_arguments(request)
+    if not query:
+        return JsonResponse({'success': False, 'message': 'Query is required.'}, status=400)
+    try:
+        results = await asearch(query, cursor=cursor, page_size=page_size)
+    except QuerySyntaxError as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+    except ValueError:
+        return JsonResponse({'success': False, 'message': 'Invalid cursor.'}, status=400)
+    return JsonResponse({'success': True, 'query': query, **results.as_dict()})
+
+
+def _upload_error(error):
+    data = {'success': False, 'message': str(error)}
+    if error.offset is not None:
+        data['offset'] = error.offset
+    return JsonResponse(data, status=error.status)
+
+
+@require_http_methods(["POST"])
+def start_upload(request):
+    """Starts a resumable chunked upload; expects JSON with `file_name` and optionally `size`."""
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'success': False, 'message': 'Invalid JSON.'}, status=400)
+    file_name = os.path.basename(str(data.get('file_name') or ''))
+    size = data.get('size')
+    if not file_name:
+        return JsonResponse({'success': False, 'message': 'File name is required.'}, status=400)
+    if size is not None and not isinstance(size, int):
+        return JsonResponse({'success': False, 'message': 'Size must be a number of bytes.'}, status=400)
+
+    try:
+        session = start_session(rename_file_if_too_long(file_name, max_length=50), size)
+    except UploadError as e:
+        return _upload_error(e)
+    return JsonResponse({
+        'success': True,
+        'upload_id': str(session.id),
+        'offset': 0,
+        'max_chunk_size': getattr(settings, 'UPLOAD_MAX_CHUNK_SIZE', None),
+    }, status=201)
+
+
+@require_http_methods(["GET", "PUT", "DELETE"])
+def upload_chunk(request, upload_id):
+    """Reports an upload's offset (GET), appends the request body at `Upload-Offset` (PUT) or cancels it (DELETE)."""
+    if request.method == 'GET':
+        session = get_object_or_404(UploadSession, id=upload_id)
+        return JsonResponse({'success': True, 'offset': session.received, 'size': session.size})
+    if request.method == 'DELETE':
+        abort_session(get_object_or_404(UploadSession, id=upload_id))
+        return JsonResponse({'success': True})
+
+    offset = request.headers.get('Upload-Offset', '')
+    length = request.headers.get('Content-Length', '')
+    if not offset.isdigit():
+        return JsonResponse({'success': False, 'message': 'Upload-Offset header is required.'}, status=400)
+    if not length.isdigit():
+        return JsonResponse({'success': False, 'message': 'Content-Length header is required.'}, status=411)
+    try:
+        # The body is streamed from the request to disk, never loaded whole
+        new_offset = append_chunk(upload_id, int(offset), request, int(length))
+    except UploadError as e:
+        return _upload_error(e)
+    return JsonResponse({'success': True, 'offset': new_offset})
+
+
+@require_http_methods(["POST"])
+def finish_upload(request, upload_id):
+    """Completes a chunked upload and queues the file for ingestion."""
+    try:
+        file_instance = finish_session(upload_id)
+    except UploadError as e:
+        return _upload_error(e)
+    return JsonResponse({
+        'success': True,
+        'file_id': file_instance.id,
+        'status_url': reverse('ingest_status', args=[file_instance.id]),
+    }, status=201)
+
+
+def search_cache_stats(request):
+    """Reports the search cache hit/miss counters of this process."""
+    return JsonResponse(search_cache.stats())
+
+
+def metrics_endpoint(request):
+    """Serves the stage timings and counters of all processes in the Prometheus text format."""
+    if not metrics.ENABLED:
+        raise Http404("Metrics are disabled.")
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def ingest_status(request, file_id):
+    """Reports the ingestion state of an uploaded file."""
+    file_instance = get_object_or_404(File, id=file_id)
+    return JsonResponse(ingest_state(file_instance))
+
+
+async def aingest_status(request, file_id):
+    """`ingest_status` for ASGI (routed with ASYNC_VIEWS)."""
+    file_instance = await aget_object_or_404(File, id=file_id)
+    return JsonResponse(await aingest_state(file_instance))
+
 @require_http_methods(["POST"])
 def rename_file(request, file_id):
     """Renames a file based on user input."""
@@ -189,7 +278,7 @@ def rename_file(request, file_id):
             return JsonResponse({'success': False, 'message': 'Invalid new name. It must not contain special characters.'}, status=400)
         
         # Extract current extension from the existing file name
-        old_ext = os.path.splitext(file_instance.file_content.name)[1]
+        old_ext = os.path.splitext(file_instance.file_name)[1]
 
         # Generate the new file name with the correct extension
         new_file_name = rename_file_if_too_long(new_name_base + old_ext)
@@ -202,57 +291,13 @@ def rename_file(request, file_id):
             # The new name is the same as the current name; no changes needed
             return JsonResponse({'success': True, 'new_name': file_instance.file_name})
 
-        old_file_path = file_instance.file_content.path
-        new_file_path = os.path.join(os.path.dirname(old_file_path), new_file_name)
-
-        # Debugging: Print file paths
-        print(f"Old path: {old_file_path}, New path: {new_file_path}")
-
-        # Check if the old file path exists
-        if not os.path.exists(old_file_path):
-            print(f"Old file path does not exist: {old_file_path}. Attempting to refresh from DB.")  # Debugging print
-
-            # Attempt to reload the file instance from the database in case of concurrent changes
-            file_instance.refresh_from_db()
-            old_file_path = file_instance.file_content.path  # Refresh the file path after reload
-
-            # Check again if the refreshed old file path exists
-            if not os.path.exists(old_file_path):
-                print(f"File path still does not exist after refresh: {old_file_path}")  # Debugging print
-                return JsonResponse({'success': False, 'message': f'Original file path does not exist: {old_file_path}'}, status=400)
-
-        # Ensure the directory for new_file_path exists
-        new_dir = os.path.dirname(new_file_path)
-        if not os.path.exists(new_dir):
-            os.makedirs(new_dir)
-
-        # Check if new file path already exists to avoid conflicts
-        if os.path.exists(new_file_path):
-            return JsonResponse({'success': False, 'message': 'File with the new name already exists.'}, status=400)
-
-        # Rename the file in the filesystem
-        os.rename(old_file_path, new_file_path)
-        print(f"File renamed successfully from {old_file_path} to {new_file_path}")  # Debugging print
-
-        # Update the file instance in the database
-        file_instance.file_name = new_file_name
-        
-        # Update the file content name with the correct relative path
-        file_instance.file_content.name = os.path.relpath(new_file_path, settings.MEDIA_ROOT)
-        file_instance.save()
-
-        # Refresh the instance from the database to ensure correct paths
-        file_instance.refresh_from_db()
-
-        # Check if the file exists at the new location after saving
-        if not os.path.exists(file_instance.file_content.path):
-            print(f"Error: File was saved but does not exist at new path: {file_instance.file_content.path}")  # Debugging print
-            return JsonResponse({'success': False, 'message': 'File not found after renaming.'}, status=500)
+        # The stored content may be shared with other files, so only the display name changes
+        File.objects.filter(id=file_instance.id).update(file_name=new_file_name)
+        search_cache.invalidate()
 
         return JsonResponse({'success': True, 'new_name': new_file_name})
     except Exception as e:
-        # Log the error for debugging
-        print(f"Error renaming file: {e}")
+        logger.exception("Error renaming file %d", file_id)
         return JsonResponse({'success': False, 'message': str(e)}, status=500)
 
 
@@ -260,29 +305,23 @@ def rename_file(request, file_id):
 def delete_file(request, file_id):
     """Deletes a specified file."""
     try:
-        # Fetch the file instance from the database
-        file_instance = get_object_or_404(File, id=file_id)
-        file_path = file_instance.file_content.path  # Get the file path from the file field
+        with transaction.atomic():
+            # Fetch the file instance from the database
+            file_instance = get_object_or_404(File.objects.select_for_update(), id=file_id)
+            blob_id = file_instance.blob_id
 
-        # Check if the file exists in the filesystem before attempting to delete
-        if os.path.exists(file_path):
-            # Remove the file from the filesystem
-            try:
-                os.remove(file_path)
-                print(f"File deleted from filesystem: {file_path}")  # Debugging print
-            except Exception as e:
-                print(f"Error deleting file from filesystem: {e}")  # Debugging print
-                return JsonResponse({'success': False, 'message': f"Error deleting file from filesystem: {str(e)}"}, status=500)
-        else:
-            print(f"File does not exist in filesystem: {file_path}")  # Debugging print
-
-        # Delete the file instance from the database
-        file_instance.delete()
-        print(f"File record deleted from database for file_id: {file_id}")  # Debugging print
+            # Delete the file instance from the database, with its tags
+            delete_tags([file_id])
+            file_instance.delete()
+            search_cache.invalidate()
+
+            # The stored content is removed by gc_blobs once no file has referenced it for a while
+            if release_blob(blob_id):
+                logger.info("Blob %d is no longer referenced; left for garbage collection", blob_id)
 
         return JsonResponse({'success': True})
     except Exception as e:
-        print(f"Error deleting file: {e}")
+        logger.exception("Error deleting file %d", file_id)
         return JsonResponse({'success': False, 'message': str(e)}, status=500)
 
 
@@ -290,17 +329,42 @@ def delete_file(request, file_id):
 def download_file(request, file_id):
     """Handles file download requests."""
     try:
-        file_instance = get_object_or_404(File, id=file_id)
-        file_path = file_instance.file_content.path
+        file_instance = get_object_or_404(File.objects.select_related('blob'), id=file_id)
+        file_path = file_instance.blob.file_content.path
         file_name = file_instance.file_name
         
         # Check if file exists before serving it
         if not os.path.exists(file_path):
             return HttpResponse(f"Error: The requested file does not exist at path: {file_path}", status=404)
 
-        response = FileResponse(open(file_path, 'rb'))
-        response['Content-Disposition'] = f'attachment; filename="{file_name}"'
-        return response
+        # Conditional requests, byte ranges and sendfile/proxy hand-off
+        return serve_blob(request, file_instance.blob, file_name)
     except Exception as e:
-        print(f"Error downloading file: {e}")
-        return HttpResponse(f"Error downloading file: {str(e)}", status=500)
\ No newline at end of file
+        logger.exception("Error downloading file %d", file_id)
+        return HttpResponse(f"Error downloading file: {str(e)}", status=500)
+
+
+async def adownload_file(request, file_id):
+    """`download_file` for ASGI (routed with ASYNC_VIEWS): the file is streamed without holding a thread."""
+    file_instance = await aget_object_or_404(File.objects.select_related('blob'), id=file_id)
+    file_path = file_instance.blob.file_content.path
+    if not await asyncio.to_thread(os.path.exists, file_path):
+        return HttpResponse(f"Error: The requested file does not exist at path: {file_path}", status=404)
+    return serve_blob(request, file_instance.blob, file_instance.file_name, asynchronous=True)
+
+
+def preview_thumbnail(request, file_id):
+    """Serves the first-page thumbnail of a file, long-cacheable under the URL given with search hits."""
+    file_instance = get_object_or_404(File.objects.select_related('blob'), id=file_id)
+    return previews.serve_thumbnail(request, file_instance.blob)
+
+
+def similar_files(request, file_id):
+    """JSON API: the files most similar to a file by their tags, with optional `limit`."""
+    limit = request.GET.get('limit', '')
+    max_limit = getattr(settings, 'SIMILARITY_MAX_LIMIT', 100)
+    limit = min(int(limit), max_limit) if limit.isdigit() and int(limit) > 0 else None
+    results = similarity.similar_files(file_id, limit)
+    if results is None:
+        raise Http404("File not found.")
+    return JsonResponse({'success': True, 'file_id': file_id, 'results': results})
@@ -0,0 +1,12 @@
+"""Settings for running the benchmarks against SQLite instead of the configured MySQL server:
+
+    python manage.py benchmark --settings myproject.benchmark_settings pipeline
+"""
+from .settings import *  # noqa: F401,F403
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'benchmark.sqlite3',  # Never written: benchmarks run in an in-memory test database
+    }
+}
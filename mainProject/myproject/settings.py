@@ -67,6 +67,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'myproject.wsgi.application'
+ASYNC_VIEWS = False  # Route search, download and status to their async views; turn on when serving myproject.asgi (uvicorn, daphne)
 
 # Database configuration
 DATABASES = {
@@ -110,6 +111,139 @@ STATICFILES_DIRS = [BASE_DIR / 'fileapp/static']
 # Media files (for file uploads)
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+BLOB_STORAGE_DIR = 'blobs'  # Stored content goes to MEDIA_ROOT/<this>/<hash[0:2]>/<hash[2:4]>/<sha256><ext>
+BLOB_SHARD_LEVELS = 2  # Directory levels of two hex digits each: 65,536 leaf directories
+BLOB_GC_GRACE = 24 * 60 * 60  # Seconds unreferenced content is kept before gc_blobs deletes it; longer than any import
+
+# Backends imported when the WSGI/ASGI application loads instead of on first use:
+# any of 'pdfplumber', 'textract', 'docx2txt', 'pil', 'pil_ops', 'pytesseract' and 'nlp' (the
+# spaCy model, used by search to lemmatize queries). Management commands never preload.
+PRELOAD_BACKENDS = []
+
+# Background ingestion (run with `python manage.py ingest_worker`)
+INGEST_PRELOAD = True  # Load all backends before forking the process pool so children share them
+INGEST_WORKERS = os.cpu_count() or 1  # Extraction/tagging processes per worker
+INGEST_MAX_ATTEMPTS = 3  # Attempts per file before it is marked as failed
+INGEST_RETRY_BACKOFF = 30  # Seconds before the first retry, doubled on each further retry
+INGEST_JOB_TIMEOUT = 5 * 60  # Seconds without a heartbeat after which a running job is assumed abandoned and retried
+INGEST_HEARTBEAT_INTERVAL = 30  # Seconds between a worker's heartbeats for the jobs it is running
+INGEST_POLL_INTERVAL = 2  # Seconds between queue polls when idle
+
+# Bulk import (`python manage.py import_directory <dir>`)
+IMPORT_BATCH_SIZE = 500  # Files (with all their tags) written per transaction
+
+# PDF extraction
+PDF_MAX_PAGES = None  # Ignore pages past this many (None: no cap)
+PDF_EXTRACT_TIMEOUT = 10 * 60  # Seconds; extraction stops and keeps the pages read so far
+PDF_PARALLEL_MIN_PAGES = 50  # Documents with at least this many pages are split across PDF_WORKERS processes
+PDF_PAGES_PER_TASK = 25  # Pages per process-pool task
+PDF_WORKERS = 1  # Processes used for one large PDF; each ingestion/import process starts this many, so raise it only with few of those
+
+# OCR (Tesseract)
+TESSERACT_CMD = None  # Path to the tesseract binary (None: search PATH, then the default Windows install location)
+OCR_LANG = 'eng'  # Tesseract language(s), e.g. 'eng+deu'
+OCR_TARGET_DPI = 300  # Images scanned at a higher resolution are scaled down to this
+OCR_MAX_PIXELS = 9_000_000  # Larger images (bands of tall ones) are scaled down to this many pixels, about an A4 page at 300 DPI
+OCR_BINARIZE = True  # Convert to black and white (Otsu threshold) before recognition
+OCR_TILE_HEIGHT = 4000  # Taller images are cut into bands of about this many rows, recognized in parallel
+OCR_WORKERS = 2  # Tesseract processes run at once per extraction process
+OCR_TIMEOUT = 120  # Seconds before a tesseract process is killed
+OCR_PDF_FALLBACK = True  # OCR PDF pages that have images but no text layer (scans)
+OCR_PDF_MIN_CHARS = 20  # Pages with fewer characters of text than this count as having no text layer
+OCR_PDF_DPI = 300  # Resolution scanned PDF pages are rendered at for OCR
+
+# Tag generation (spaCy)
+NLP_MODEL = 'en_core_web_sm'
+NLP_EXCLUDE = ['parser', 'ner']  # Components not needed for lemmas; never loaded
+NLP_CHUNK_CHARS = 100_000  # Long texts are split into chunks of this size (capped below nlp.max_length)
+NLP_BATCH_SIZE = 32  # Chunks per nlp.pipe batch
+NLP_N_PROCESS = 1  # Processes per nlp.pipe call; ingestion already runs one tagger per worker process
+NLP_TAGGER_VERSION = 2  # Bump after changing NLP_MODEL/NLP_EXCLUDE or the tagging rules, then run `manage.py reindex_tags` (2: token positions)
+REINDEX_BATCH_SIZE = 200  # Files re-tagged per transaction by reindex_tags
+
+# Chunked uploads (api/upload/sessions/)
+UPLOAD_MAX_SIZE = 2 * 1024 ** 3  # Bytes per file; larger announced sizes and chunks past it are refused up front
+UPLOAD_MAX_CHUNK_SIZE = 64 * 1024 ** 2  # Bytes per chunk request
+UPLOAD_SESSION_TTL = 24 * 60 * 60  # Seconds an idle session (and its partial file) is kept
+UPLOAD_CHUNK_TIMEOUT = 10 * 60  # Seconds a chunk request may go without progress before another may take the session over
+UPLOAD_HASHER_CACHE_SIZE = 256  # Running hashes kept per process; others are rebuilt from the partial file
+
+# Downloads
+DOWNLOAD_OFFLOAD = None  # 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache/lighttpd) to let the front server send files
+DOWNLOAD_ACCEL_REDIRECT_PREFIX = '/protected-media/'  # nginx `internal` location aliased to MEDIA_ROOT
+DOWNLOAD_MAX_RANGES = 16  # Range requests with more ranges than this get the whole file
+DOWNLOAD_CACHE_CONTROL = 'private, no-cache'  # Browsers keep downloads but revalidate them (answered with 304)
+
+# Search result previews (first-page thumbnails and text snippets)
+PREVIEW_STORAGE_DIR = 'previews'  # Thumbnails go to MEDIA_ROOT/<this>/<hash[0:2]>/<hash[2:4]>/<sha256>.webp
+PREVIEW_THUMBNAIL_SIZE = 256  # Pixels of a thumbnail's longest side
+PREVIEW_THUMBNAIL_QUALITY = 60  # WebP quality (0-100)
+PREVIEW_TEXT_LENGTH = 1000  # Characters from the start of the extracted text kept per blob for snippets
+PREVIEW_SNIPPET_LENGTH = 200  # Characters of that text shown with a search hit
+PREVIEW_CACHE_MAX_BYTES = 512 * 1024 ** 2  # Thumbnails stored at most; the least recently served are evicted past it
+PREVIEW_CACHE_LOW_WATER = 0.9  # Share of that limit eviction brings the total down to
+PREVIEW_EVICT_INTERVAL = 60  # Seconds between a process's checks of the total after storing thumbnails
+PREVIEW_TOUCH_INTERVAL = 60 * 60  # Seconds between recording that the same thumbnail was served again
+PREVIEW_MAX_AGE = 365 * 24 * 60 * 60  # Seconds browsers may keep a thumbnail fetched under its versioned URL
+
+# Similar-file lookup (MinHash signatures of tag sets, see fileapp/similarity.py)
+SIMILARITY_MAX_CANDIDATES = 2000  # Files sharing a signature band that a lookup scores at most
+SIMILARITY_MIN_SCORE = 0.2  # Estimated Jaccard similarity of the tag sets below which files aren't returned
+SIMILARITY_DEFAULT_LIMIT = 10  # Similar files returned when no `limit` is given
+SIMILARITY_MAX_LIMIT = 100  # Largest `limit` accepted
+
+# Search ranking (Okapi BM25)
+SEARCH_PAGE_SIZE = 20  # Results per page
+SEARCH_MAX_PAGE_SIZE = 100  # Largest `limit` accepted by the JSON search API
+SEARCH_COUNT_LIMIT = 10_000  # Hit counts above this are reported as "at least" instead of counted exactly
+SEARCH_DEFAULT_OPERATOR = 'OR'  # How words without an operator between them combine in advanced queries ('OR' or 'AND')
+SEARCH_PREFIX_MAX_TERMS = 100  # Tags a `prefix*` query expands to at most (the most common ones)
+SEARCH_RANKED_HITS = 1000  # Best hits of an advanced query kept in the search cache for its next pages
+SEARCH_BM25_K1 = 1.2  # Term-frequency saturation
+SEARCH_BM25_B = 0.75  # Document-length normalisation
+
+# Tag persistence
+TAG_BATCH_SIZE = 5000  # Tags per IN lookup / bulk insert statement
+TAG_CACHE_SIZE = 100_000  # Tag name -> id entries kept per process (LRU)
+TAG_CACHE_WARM_UP = 10_000  # Most frequent tags loaded into that cache on first use
+
+# Caches; the search result cache lives in SEARCH_CACHE_ALIAS. Local memory is per
+# process: with several web/ingestion processes, point this at a shared backend
+# (Redis, Memcached, database) so invalidations reach every process.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'fileapp',
+    }
+}
+
+# Search caching
+SEARCH_CACHE_ALIAS = 'default'
+SEARCH_CACHE_TIMEOUT = 300  # Seconds a cached result page is kept
+SEARCH_QUERY_CACHE_SIZE = 1024  # Query strings whose lemma sets are memoized per process
+
+# Instrumentation (served at /metrics/ in the Prometheus text format)
+METRICS_ENABLED = False  # Time the ingestion and search stages and count bytes, pages, tags and queries
+METRICS_DIR = BASE_DIR / 'metrics'  # Where the ingestion worker, imports and web workers leave snapshots for /metrics/ to add up
+METRICS_FLUSH_INTERVAL = 10  # Seconds between a process's snapshots
+METRICS_SPAN_LOG = None  # File that sampled spans are appended to as JSON lines (None: no span log)
+METRICS_SPAN_SAMPLE_RATE = 0.01  # Share of spans written to METRICS_SPAN_LOG
+
+# Logging: the app's warnings (failed extractors, OCR, thumbnails, unreadable
+# directories) and errors go to stderr; set 'level' to 'DEBUG' for more detail
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {'format': '{asctime} {levelname} {name}: {message}', 'style': '{'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'simple'},
+    },
+    'loggers': {
+        'fileapp': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
 
 # CORS settings
 CORS_ALLOWED_ORIGINS = [
@@ -14,3 +14,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'myproject.settings')
 
 application = get_wsgi_application()
+
+# Load the backends listed in PRELOAD_BACKENDS now rather than on the first
+# request; with `gunicorn --preload` the workers then share them copy-on-write.
+from fileapp.backends import preload_from_settings  # noqa: E402
+from fileapp import metrics  # noqa: E402
+
+preload_from_settings()
+metrics.publish()  # Let the process serving /metrics/ include this one's metrics